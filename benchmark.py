@@ -0,0 +1,214 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+from synthetic_data import write_dataset
+
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000, 10_000_000]
+# Stages in dependency order, each run in its own process so its peak memory is measured alone
+BENCHMARK_STAGES = ['merge', 'psps', 'filter', 'merge_vri', 'analyze_spans', 'feeder_analysis']
+# Libraries whose import cost the startup benchmark reports
+HEAVY_MODULES = ['pandas', 'pyarrow', 'scipy', 'shapely', 'pyproj', 'geopandas', 'networkx']
+# Run in a fresh interpreter: time importing run.py, then the modules of a target and its dependencies
+STARTUP_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import run
+startup = time.perf_counter() - start
+from pipeline import resolve_stages
+from stages import STAGES, ALL_TARGETS
+start = time.perf_counter()
+for name in resolve_stages(STAGES, ALL_TARGETS if sys.argv[1] == 'all' else [sys.argv[1]]):
+    STAGES[name].load()
+print(json.dumps({'startup_seconds': startup, 'import_seconds': time.perf_counter() - start,
+                  'modules': [module for module in json.loads(sys.argv[-1]) if module in sys.modules]}))
+'''
+
+
+def prepare_scale(work_dir, n_spans, seed=0):
+    """
+    Generate the synthetic dataset of a scale unless it already exists.
+
+    Cached Parquet copies and checkpoints of earlier runs are removed, so each benchmark
+    run starts from the CSV files.
+
+    Args:
+        work_dir (str): Benchmark directory.
+        n_spans (int): Number of spans.
+        seed (int): Random seed.
+
+    Returns:
+        str: Directory of the scale, holding its data-params.json.
+    """
+    scale_dir = os.path.join(work_dir, str(n_spans))
+    if not os.path.exists(os.path.join(scale_dir, 'data-params.json')):
+        write_dataset(scale_dir, n_spans, seed=seed)
+    for stale in ('cache', 'data', 'profile'):
+        shutil.rmtree(os.path.join(scale_dir, stale), ignore_errors=True)
+    return scale_dir
+
+
+def run_stage(scale_dir, stage):
+    """
+    Run one stage with profiling in a separate process.
+
+    Args:
+        scale_dir (str): Directory of the scale.
+        stage (str): Stage name.
+
+    Returns:
+        dict: The stage's profile record.
+    """
+    params_path = os.path.join(scale_dir, 'data-params.json')
+    with open(params_path, 'r') as fh:
+        config = json.load(fh)
+    profile_dir = os.path.join(scale_dir, 'profile', stage)
+    config['parameters']['profile_dir'] = profile_dir
+    with open(params_path, 'w') as fh:
+        json.dump(config, fh, indent=4)
+
+    run_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+    completed = subprocess.run([sys.executable, run_py, stage, '--profile', '--jobs', '1'], cwd=scale_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    with open(os.path.join(scale_dir, f"{stage}.log"), 'w') as fh:
+        fh.write(completed.stdout)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed; see {os.path.join(scale_dir, stage + '.log')}")
+
+    report_path = sorted(glob.glob(os.path.join(profile_dir, 'report-*.json')))[-1]
+    with open(report_path, 'r') as fh:
+        record = json.load(fh)['stages'][stage]
+    return {
+        'wall_seconds': record['wall_seconds'],
+        'cpu_seconds': record['cpu_seconds'],
+        'peak_rss_mb': record['peak_rss_mb'],
+        'output_rows': record['output_rows'],
+        'functions': record['functions'],
+    }
+
+
+def run_benchmark(scales, work_dir, stages=BENCHMARK_STAGES, seed=0):
+    """
+    Run the pipeline stages on synthetic data of each scale.
+
+    Args:
+        scales (list): Numbers of spans.
+        work_dir (str): Directory for the generated data and logs.
+        stages (list): Stages to run, in dependency order.
+        seed (int): Random seed of the generated data.
+
+    Returns:
+        dict: Stage records by scale (as a string) and stage name.
+    """
+    results = dict()
+    for n_spans in scales:
+        scale_dir = prepare_scale(work_dir, n_spans, seed)
+        results[str(n_spans)] = dict()
+        for stage in stages:
+            record = run_stage(scale_dir, stage)
+            results[str(n_spans)][stage] = record
+            print(f"{n_spans:>10} {stage:<16} {record['wall_seconds']:9.2f}s {record['peak_rss_mb'] or 0:9.0f} MB")
+    return results
+
+
+def measure_startup(targets, repeat=5):
+    """
+    Measure the import overhead of each target in fresh processes.
+
+    Each run times `import run` and then the imports of the target and the stages it
+    depends on, as when it runs without checkpoints. The fastest of `repeat` runs is kept.
+
+    Args:
+        targets (list): Target names, or 'all'.
+        repeat (int): Runs per target.
+
+    Returns:
+        dict: Target -> 'startup_seconds', 'import_seconds' and the HEAVY_MODULES loaded.
+    """
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    results = dict()
+    for target in targets:
+        runs = []
+        for _ in range(repeat):
+            completed = subprocess.run([sys.executable, '-c', STARTUP_PROBE, target, json.dumps(HEAVY_MODULES)],
+                                       cwd=code_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        record = {
+            'startup_seconds': min(run['startup_seconds'] for run in runs),
+            'import_seconds': min(run['import_seconds'] for run in runs),
+            'modules': runs[0]['modules'],
+        }
+        results[target] = record
+        print(f"{target:<16} {record['startup_seconds']:9.3f}s {record['import_seconds']:9.3f}s "
+              f"{record['startup_seconds'] + record['import_seconds']:9.3f}s  {', '.join(record['modules'])}")
+    return results
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Print each stage's time and memory next to the stored baseline.
+
+    Args:
+        results (dict): Output of run_benchmark.
+        baseline (dict): Earlier output of run_benchmark.
+    """
+    print(f"{'spans':>10} {'stage':<16} {'seconds':>9} {'baseline':>9} {'ratio':>6} {'MB':>7} {'baseline':>9} {'ratio':>6}")
+    for scale, stages in results.items():
+        for stage, record in stages.items():
+            before = baseline.get(scale, {}).get(stage)
+            if before is None:
+                print(f"{scale:>10} {stage:<16} {record['wall_seconds']:9.2f} {'-':>9} {'-':>6}")
+                continue
+            time_ratio = record['wall_seconds'] / before['wall_seconds'] if before['wall_seconds'] else float('nan')
+            memory = record['peak_rss_mb'] or 0
+            memory_before = before['peak_rss_mb'] or 0
+            memory_ratio = memory / memory_before if memory_before else float('nan')
+            print(f"{scale:>10} {stage:<16} {record['wall_seconds']:9.2f} {before['wall_seconds']:9.2f} {time_ratio:6.2f} "
+                  f"{memory:7.0f} {memory_before:9.0f} {memory_ratio:6.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES),
+                        help="Comma-separated numbers of spans.")
+    parser.add_argument('--work-dir', default='./data/benchmark')
+    parser.add_argument('--baseline', default='./data/benchmark/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup', action='store_true',
+                        help="Only measure the import overhead of each target instead of running them.")
+    parser.add_argument('--targets', help="Comma-separated targets for --startup; every stage and 'all' by default.")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per target for --startup.")
+    args = parser.parse_args()
+
+    if args.startup:
+        from stages import STAGES
+        targets = args.targets.split(',') if args.targets else list(STAGES) + ['all']
+        print(f"{'target':<16} {'run.py':>10} {'imports':>10} {'total':>10}  libraries")
+        startup = measure_startup(targets, args.repeat)
+        os.makedirs(args.work_dir, exist_ok=True)
+        startup_path = os.path.join(args.work_dir, 'startup.json')
+        with open(startup_path, 'w') as fh:
+            json.dump(startup, fh, indent=2)
+        print(f"Startup results saved to {startup_path}")
+        sys.exit(0)
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    work_dir = os.path.abspath(args.work_dir)
+    results = run_benchmark(scales, work_dir, seed=args.seed)
+
+    results_path = os.path.join(work_dir, 'results.json')
+    with open(results_path, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print(f"Benchmark results saved to {results_path}")
+
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as fh:
+            compare_to_baseline(results, json.load(fh))
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        shutil.copyfile(results_path, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
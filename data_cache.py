@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+CACHE_DIR_NAME = 'cache'
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_fingerprint(file_path, with_hash=False):
+    """
+    Describe the current state of a source file.
+
+    Args:
+        file_path (str): Path to the source file.
+        with_hash (bool): Whether to include a SHA-256 digest of the file contents.
+
+    Returns:
+        dict: Source path, size in bytes, modification time and (optionally) content hash.
+    """
+    stat = os.stat(file_path)
+    fingerprint = {
+        'source': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    if with_hash:
+        fingerprint['sha256'] = file_hash(file_path)
+    return fingerprint
+
+
+def file_hash(file_path):
+    """
+    Compute the SHA-256 digest of a file, reading it in blocks.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_paths(file_path, cache_dir=None, variant=None):
+    """
+    Get the columnar cache file and its metadata sidecar for a source CSV.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        cache_dir (str): Cache directory. Defaults to a `cache` folder next to the source file.
+        variant (str): Optional tag for derived copies of the same source, such as reprojected geometries.
+
+    Returns:
+        tuple: Paths of the Parquet cache file and its JSON metadata file.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR_NAME)
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    if variant:
+        base_name = f"{base_name}.{variant}"
+    return os.path.join(cache_dir, f"{base_name}.parquet"), os.path.join(cache_dir, f"{base_name}.meta.json")
+
+
+def is_cache_valid(file_path, meta_path):
+    """
+    Check whether a cached copy still matches its source file.
+
+    Size and modification time are compared first. When only the modification
+    time differs, the content hash decides, so touching a file does not force a rebuild.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        meta_path (str): Path to the cache metadata file.
+
+    Returns:
+        bool: True if the cache can be used.
+    """
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as fh:
+        cached = json.load(fh)
+
+    current = file_fingerprint(file_path)
+    if current['size'] != cached.get('size'):
+        return False
+    if current['mtime_ns'] == cached.get('mtime_ns'):
+        return True
+    if file_hash(file_path) != cached.get('sha256'):
+        return False
+
+    # Same contents under a new mtime: remember it so the hash is not recomputed next time
+    cached['mtime_ns'] = current['mtime_ns']
+    write_meta(meta_path, cached)
+    return True
+
+
+def temporary_path(path):
+    """
+    Per-process temporary name for a file that is written and then renamed into place.
+
+    Stages running in parallel may build the same cache. Each process writes its own
+    temporary file and `os.replace` swaps it in, so readers never see a partial file.
+
+    Args:
+        path (str): Final path of the file.
+
+    Returns:
+        str: Temporary path in the same directory, with the same extension (np.savez adds one otherwise).
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{os.getpid()}.tmp{extension}"
+
+
+def write_meta(meta_path, meta):
+    """
+    Write a cache metadata file atomically.
+
+    Args:
+        meta_path (str): Path to the cache metadata file.
+        meta (dict): Metadata to store.
+    """
+    temporary = temporary_path(meta_path)
+    with open(temporary, 'w') as fh:
+        json.dump(meta, fh, indent=2)
+    os.replace(temporary, meta_path)
+
+
+def build_cache(file_path, parquet_path, meta_path):
+    """
+    Parse a CSV file once and store it as a typed Parquet file.
+
+    The Parquet file is renamed into place before its metadata is written, so a valid
+    metadata file always describes a complete cache. A file that cannot be written as
+    Parquet gets metadata marked `csv_only`, and is read from the CSV until it changes.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        parquet_path (str): Destination Parquet file.
+        meta_path (str): Destination metadata file.
+
+    Returns:
+        DataFrame: The parsed CSV data.
+    """
+    df = pd.read_csv(file_path, low_memory=False)
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    temporary = temporary_path(parquet_path)
+    try:
+        df.to_parquet(temporary, index=False)
+    except (TypeError, ValueError, ImportError) as e:
+        # Columns with mixed python types cannot be written to Parquet; serve the CSV directly,
+        # and remember it so later loads do not parse the file and try again
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        print(f"Could not cache {file_path} as Parquet ({e}). Reading from CSV.")
+        write_cache_meta(file_path, meta_path, csv_only=True)
+        return df
+
+    os.replace(temporary, parquet_path)
+    write_cache_meta(file_path, meta_path)
+    return df
+
+
+def write_cache_meta(file_path, meta_path, csv_only=False):
+    """
+    Record the fingerprint of the source file a cached copy was built from.
+
+    Args:
+        file_path (str): Path to the source file.
+        meta_path (str): Path to the cache metadata file.
+        csv_only (bool): Whether the file could not be cached and is read from the CSV.
+    """
+    meta = file_fingerprint(file_path, with_hash=True)
+    if csv_only:
+        meta['csv_only'] = True
+    write_meta(meta_path, meta)
+
+
+def read_cached_csv(file_path, columns=None, cache_dir=None):
+    """
+    Read a CSV file through the columnar cache, building the cache on first use.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        columns (list): Optional subset of columns to read.
+        cache_dir (str): Cache directory. Defaults to a `cache` folder next to the source file.
+
+    Returns:
+        DataFrame: The CSV data.
+    """
+    if not PARQUET_AVAILABLE:
+        return pd.read_csv(file_path, usecols=columns, low_memory=False)
+
+    parquet_path, meta_path = cache_paths(file_path, cache_dir)
+    if is_cache_valid(file_path, meta_path):
+        with open(meta_path, 'r') as fh:
+            csv_only = json.load(fh).get('csv_only', False)
+        if csv_only:
+            return pd.read_csv(file_path, usecols=columns, low_memory=False)
+        if os.path.exists(parquet_path):
+            return pd.read_parquet(parquet_path, columns=columns)
+
+    df = build_cache(file_path, parquet_path, meta_path)
+    return df[columns] if columns is not None else df
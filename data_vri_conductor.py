@@ -1,53 +1,72 @@
+import os
 from etl import load_data, merge_weather_data, save_data
+from geo_store import geometry_from_wkt, load_geometry_store
+from spatial_join import parallel_sjoin
+from snapshot_diff import incremental_sjoin
+from schema import apply_schema
 import geopandas as gpd
-from shapely import wkt
 import pandas as pd
+from profiling import instrument
 
-def process_vri_data(vri_path):
+@instrument
+def process_vri_data(vri_path, target_crs=None):
     """
     Load and process the VRI dataset.
+
+    Geometries are decoded once and stored as GeoParquet next to the source file,
+    so later calls load the ready-made GeoDataFrame.
     
     Args:
         vri_path (str): Path to the VRI dataset.
+        target_crs: Optional CRS to reproject the polygons to.
     
     Returns:
         GeoDataFrame: Processed VRI GeoDataFrame.
     """
-    src_vri_snapshot = load_data(vri_path)
-    src_vri_snapshot['geometry'] = src_vri_snapshot['shape'].apply(wkt.loads)
-    src_vri_snapshot_gpd = gpd.GeoDataFrame(src_vri_snapshot, geometry='geometry', crs=f"EPSG:{src_vri_snapshot['shape_srid'][0]}")
-    
+    def build():
+        src_vri_snapshot = load_data(vri_path, schema='src_vri_snapshot')
+        src_vri_snapshot['geometry'] = geometry_from_wkt(src_vri_snapshot['shape'])
+        src_vri_snapshot_gpd = gpd.GeoDataFrame(src_vri_snapshot, geometry='geometry', crs=f"EPSG:{src_vri_snapshot['shape_srid'][0]}")
+        return src_vri_snapshot_gpd.to_crs(target_crs) if target_crs is not None else src_vri_snapshot_gpd
+
     #print(f"Processed VRI CRS: {src_vri_snapshot_gpd.crs}")
-    return src_vri_snapshot_gpd
+    return apply_schema(load_geometry_store(vri_path, 'vri', build, target_crs), 'src_vri_snapshot')
 
 
-def process_conductor_data(conductor_path):
+@instrument
+def process_conductor_data(conductor_path, target_crs=None):
     """
     Load and process the conductor dataset.
+
+    Geometries are decoded once and stored as GeoParquet next to the source file,
+    so later calls load the ready-made GeoDataFrame.
     
     Args:
         conductor_path (str): Path to the conductor dataset.
+        target_crs: Optional CRS to reproject the spans to.
     
     Returns:
         GeoDataFrame: Processed conductor GeoDataFrame.
     """
-    dev_wings_agg_span = load_data(conductor_path)
-    dev_wings_agg_span = dev_wings_agg_span.drop(columns=['Unnamed: 0'], errors='ignore')
-    
-    # Drop rows where 'shape' is NaN or not a string
-    dev_wings_agg_span = dev_wings_agg_span[pd.notna(dev_wings_agg_span['shape'])]
-    
-    # Apply wkt.loads safely
-    dev_wings_agg_span['geometry'] = dev_wings_agg_span['shape'].apply(
-        lambda x: wkt.loads(x) if isinstance(x, str) else None
-    )
-    return gpd.GeoDataFrame(
-        dev_wings_agg_span, geometry='geometry', crs=f"EPSG:{dev_wings_agg_span['shape_srid'].iloc[0]}"
-    )
+    def build():
+        dev_wings_agg_span = load_data(conductor_path, schema='dev_wings_agg_span')
+        dev_wings_agg_span = dev_wings_agg_span.drop(columns=['Unnamed: 0'], errors='ignore')
+
+        # Drop rows where 'shape' is NaN or not a string
+        dev_wings_agg_span = dev_wings_agg_span[pd.notna(dev_wings_agg_span['shape'])]
+
+        dev_wings_agg_span['geometry'] = geometry_from_wkt(dev_wings_agg_span['shape'])
+        dev_wings_agg_span_gpd = gpd.GeoDataFrame(
+            dev_wings_agg_span, geometry='geometry', crs=f"EPSG:{dev_wings_agg_span['shape_srid'].iloc[0]}"
+        )
+        return dev_wings_agg_span_gpd.to_crs(target_crs) if target_crs is not None else dev_wings_agg_span_gpd
 
+    return apply_schema(load_geometry_store(conductor_path, 'conductor', build, target_crs), 'dev_wings_agg_span')
 
 
-def merge_psps_conductor_vri(conductor_path, vri_path, weather_station_psps):
+
+@instrument
+def merge_psps_conductor_vri(conductor_path, vri_path, weather_station_psps, n_workers=None, state_dir=None, verify=False):
     """
     Merges PSPS weather station data, VRI polygons, and conductor span data into a unified GeoDataFrame 
     based on spatial relationships.
@@ -57,40 +76,44 @@ def merge_psps_conductor_vri(conductor_path, vri_path, weather_station_psps):
         vri_path (str): Path to the VRI snapshot data file.
         weather_station_psps (pd.DataFrame): DataFrame with PSPS weather station data, including 'shape' 
             (geometries in WKT format) and 'shape_srid' (spatial reference system).
+        n_workers (int): Number of processes for the spatial joins. Defaults to the number of CPUs.
+        state_dir (str): Directory keeping the join results of the previous snapshots. When given,
+            the joins are patched for the features that changed instead of being redone.
+        verify (bool): Check patched joins against a full rejoin.
 
     Returns:
         gpd.GeoDataFrame: GeoDataFrame containing merged data from VRI polygons and conductor spans.
     """
-    dev_wings_agg_span = process_conductor_data(conductor_path)
-    #dev_wings_agg_span = dev_wings_agg_span.drop(columns=['Unnamed: 0'])
-    src_vri_snapshot = process_vri_data(vri_path)
+    # VRI polygons define the target CRS; spans are decoded and reprojected once and loaded from the geometry store
+    src_vri_snapshot_gpd = process_vri_data(vri_path)
+    dev_wings_agg_span_gpd = process_conductor_data(conductor_path, target_crs=src_vri_snapshot_gpd.crs)
 
-    weather_station_psps['geometry'] = weather_station_psps['shape'].apply(wkt.loads)
+    weather_station_psps['geometry'] = geometry_from_wkt(weather_station_psps['shape'])
     weather_station_psps_gpd = gpd.GeoDataFrame(weather_station_psps, geometry='geometry', crs=f"EPSG:{weather_station_psps['shape_srid'][0]}")
-
-    src_vri_snapshot['geometry'] = src_vri_snapshot['shape'].apply(wkt.loads)
-    src_vri_snapshot_gpd = gpd.GeoDataFrame(src_vri_snapshot, geometry='geometry', crs=f"EPSG:{src_vri_snapshot['shape_srid'][0]}")
-
-    dev_wings_agg_span['geometry'] = dev_wings_agg_span['shape'].apply(wkt.loads)
-    dev_wings_agg_span_gpd = gpd.GeoDataFrame(dev_wings_agg_span, geometry='geometry', crs=f"EPSG:{dev_wings_agg_span['shape_srid'][0]}")
-    
-    # print(f"Weather Station CRS:    {weather_station_psps_gpd.crs}")
-    # print(f"VRI Polygon CRS:        {src_vri_snapshot_gpd.crs}")
-    # print(f"Conductor Span CRS:     {dev_wings_agg_span_gpd.crs}")
-
     weather_station_psps_gpd = weather_station_psps_gpd.to_crs(src_vri_snapshot_gpd.crs)
-    dev_wings_agg_span_gpd = dev_wings_agg_span_gpd.to_crs(src_vri_snapshot_gpd.crs)
 
     # print(f"Weather Station CRS:    {weather_station_psps_gpd.crs}")
     # print(f"VRI Polygon CRS:        {src_vri_snapshot_gpd.crs}")
     # print(f"Conductor Span CRS:     {dev_wings_agg_span_gpd.crs}")
 
-    merged_station_vri_gpd = gpd.sjoin(weather_station_psps_gpd, src_vri_snapshot_gpd, predicate="within", how="inner")
+    if state_dir is not None:
+        merged_station_vri_gpd = incremental_sjoin(weather_station_psps_gpd, src_vri_snapshot_gpd, "within",
+                                                   os.path.join(state_dir, 'station_vri.pkl'), left_id='weatherstationcode',
+                                                   n_workers=n_workers, partition="left", verify=verify)
+    else:
+        merged_station_vri_gpd = parallel_sjoin(weather_station_psps_gpd, src_vri_snapshot_gpd, predicate="within",
+                                                n_workers=n_workers, partition="left")
     merged_station_vri_gpd = merged_station_vri_gpd.sort_index()
 
     # print(merged_station_vri_gpd.head())
     
-    merged_station_vri_spans_gpd = gpd.sjoin(src_vri_snapshot_gpd, dev_wings_agg_span_gpd, how="inner", predicate="intersects")
+    if state_dir is not None:
+        merged_station_vri_spans_gpd = incremental_sjoin(src_vri_snapshot_gpd, dev_wings_agg_span_gpd, "intersects",
+                                                         os.path.join(state_dir, 'vri_spans.pkl'),
+                                                         n_workers=n_workers, partition="right", verify=verify)
+    else:
+        merged_station_vri_spans_gpd = parallel_sjoin(src_vri_snapshot_gpd, dev_wings_agg_span_gpd, predicate="intersects",
+                                                      n_workers=n_workers, partition="right")
     merged_station_vri_spans_gpd = merged_station_vri_spans_gpd
 
     # print(merged_station_vri_spans_gpd.head())
@@ -1,56 +1,87 @@
 import pandas as pd
+import numpy as np
 import os
-from psps import calculate_psps_probability
-import geopandas as gpd
-from shapely import wkt
+import pickle
+import shutil
+import tempfile
+from data_cache import read_cached_csv
+from table_store import TableWriter, iter_table, read_table, write_table
+from schema import apply_schema, align_frame_categories, restore_dtypes
+from profiling import instrument
 
-def load_data(file_path):
-    """Loads data from a CSV file into a pandas DataFrame."""
-    return pd.read_csv(file_path, low_memory = False)
+@instrument
+def load_data(file_path, columns=None, use_cache=True, schema=None):
+    """
+    Loads data from a CSV file into a pandas DataFrame.
+
+    The first read of a CSV converts it to a Parquet file in a `cache` folder next to it.
+    Later reads use that file until the CSV changes. Parquet files and partitioned tables
+    written by save_data are read directly.
+
+    Args:
+        file_path (str): Path to the CSV file, or to a table written by save_data.
+        columns (list): Optional subset of columns to load.
+        use_cache (bool): Whether to read through the columnar cache.
+        schema (str or dict): Optional schema from schema.SCHEMAS applied to the columns.
+
+    Returns:
+        DataFrame: Loaded data.
+    """
+    if file_path.endswith('.parquet') or os.path.isdir(file_path):
+        data = read_table(file_path, columns=columns)
+    elif not use_cache:
+        data = pd.read_csv(file_path, usecols=columns, low_memory=False)
+    else:
+        data = read_cached_csv(file_path, columns=columns)
+    return apply_schema(data, schema) if schema is not None else data
 
-def get_gis_data(gis_path):
+def get_gis_data(gis_path, compact=True):
     """
     Loads and returns the GIS data.
     
     Args:
         gis_path (str): Path to the GIS data file.
+        compact (bool): Whether to apply the compact dtypes of schema.SCHEMAS.
     
     Returns:
         DataFrame: Loaded GIS data.
     """
-    gis_data = load_data(gis_path)
+    gis_data = load_data(gis_path, schema='gis_weatherstation' if compact else None)
     print(f"GIS Data loaded with {gis_data.shape[0]} rows and {gis_data.shape[1]} columns.")
     return gis_data
 
-def get_station_summary_data(station_summary_path):
+def get_station_summary_data(station_summary_path, compact=True):
     """
     Loads and returns the station summary data.
     
     Args:
         station_summary_path (str): Path to the station summary data file.
+        compact (bool): Whether to apply the compact dtypes of schema.SCHEMAS.
     
     Returns:
         DataFrame: Loaded station summary data.
     """
-    station_summary = load_data(station_summary_path)
+    station_summary = load_data(station_summary_path, schema='station_summary_snapshot' if compact else None)
     print(f"Station Summary Data loaded with {station_summary.shape[0]} rows and {station_summary.shape[1]} columns.")
     return station_summary
 
-def get_windspeed_data(windspeed_path):
+def get_windspeed_data(windspeed_path, compact=True):
     """
     Loads and returns the windspeed data.
     
     Args:
         windspeed_path (str): Path to the windspeed data file.
+        compact (bool): Whether to apply the compact dtypes of schema.SCHEMAS.
     
     Returns:
         DataFrame: Loaded windspeed data.
     """
-    windspeed_data = load_data(windspeed_path)
+    windspeed_data = load_data(windspeed_path, schema='windspeed_snapshot' if compact else None)
     print(f"Windspeed Data loaded with {windspeed_data.shape[0]} rows and {windspeed_data.shape[1]} columns.")
     return windspeed_data
 
-def merge_weather_data(gis_path, station_summary_path, windspeed_path):
+@instrument
+def merge_weather_data(gis_path, station_summary_path, windspeed_path, compact=True):
     """
     Merge GIS, station summary, and windspeed datasets into a single DataFrame.
 
@@ -58,35 +89,208 @@ def merge_weather_data(gis_path, station_summary_path, windspeed_path):
         gis_path (str): Path to the GIS dataset.
         station_summary_path (str): Path to the station summary dataset.
         windspeed_path (str): Path to the windspeed snapshot dataset.
+        compact (bool): Whether to load the datasets with the compact dtypes of schema.SCHEMAS.
 
     Returns:
         pd.DataFrame: Merged dataset with wind speed threshold calculations.
     """
     # Load datasets
-    gis_data = get_gis_data(gis_path)
-    station_summary = get_station_summary_data(station_summary_path)
-    windspeed_snapshot = get_windspeed_data(windspeed_path)
+    gis_data = get_gis_data(gis_path, compact)
+    station_summary = get_station_summary_data(station_summary_path, compact)
+    windspeed_snapshot = get_windspeed_data(windspeed_path, compact)
     windspeed_snapshot = windspeed_snapshot[(windspeed_snapshot['wind_speed'] < max(windspeed_snapshot['wind_speed']))]
+    if compact:
+        # Shared categories keep the station codes categorical through the merges
+        align_frame_categories([(gis_data, 'weatherstationcode'), (station_summary, 'station'), (windspeed_snapshot, 'station')])
 
     # Merging logic
     merged_data = gis_data.merge(station_summary, left_on='weatherstationcode', right_on='station').drop(columns=['station'])
     final_merged_data = merged_data.merge(windspeed_snapshot, left_on='weatherstationcode', right_on='station').drop(columns=['station'])
-    final_merged_data['exceed_threshold'] = final_merged_data.apply(lambda row: int(row['wind_speed'] > row['alert']), axis=1)
+    final_merged_data['exceed_threshold'] = (final_merged_data['wind_speed'] > final_merged_data['alert']).astype('int8' if compact else int)
     return final_merged_data
 
-def save_data(df, output_path, file_name):
+def running_max(current, values):
+    """
+    Update a running maximum the way the builtin max() scans a column: a NaN first value wins.
+
+    Args:
+        current (float): Maximum so far, or None before the first chunk.
+        values (pd.Series): Next chunk of values.
+
+    Returns:
+        float: Updated maximum.
+    """
+    if values.empty:
+        return current
+    if current is None:
+        current = values.iloc[0]
+    if pd.isna(current):
+        return current
+    chunk_max = values.max()
+    return chunk_max if chunk_max > current else current
+
+def combine_dtypes(first, second):
+    """
+    Pick a dtype that can hold the values of two chunks of the same CSV column.
+
+    Args:
+        first (np.dtype): Dtype inferred for one chunk.
+        second (np.dtype): Dtype inferred for another chunk.
+
+    Returns:
+        np.dtype or str: Common dtype, or 'object' if the chunks disagree on kind.
+    """
+    if first == second:
+        return first
+    if pd.api.types.is_numeric_dtype(first) and pd.api.types.is_numeric_dtype(second):
+        return np.result_type(first, second)
+    return 'object'
+
+def estimate_chunk_rows(windspeed_path, station_info, memory_budget_mb, sample_rows=10000):
+    """
+    Estimate how many windspeed rows can be processed at once within a memory budget.
+
+    Args:
+        windspeed_path (str): Path to the windspeed snapshot dataset.
+        station_info (pd.DataFrame): Merged GIS and station summary data joined onto each row.
+        memory_budget_mb (float): Memory budget in megabytes.
+        sample_rows (int): Number of rows read to measure the row size.
+
+    Returns:
+        int: Number of rows per chunk.
+    """
+    sample = pd.read_csv(windspeed_path, nrows=sample_rows)
+    row_bytes = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    row_bytes += station_info.memory_usage(deep=True).sum() / max(len(station_info), 1)
+    # Reading, filtering and merging a chunk keeps roughly three copies of it alive
+    return max(int(memory_budget_mb * 1024 * 1024 / (3 * row_bytes)), 1)
+
+@instrument
+def stream_merge_weather_data(gis_path, station_summary_path, windspeed_path, output_file, memory_budget_mb=512,
+                              partition_by=None, compression='snappy', row_group_size=None):
+    """
+    Merge GIS, station summary, and windspeed datasets without loading the windspeed data at once.
+
+    The windspeed file is read in chunks sized to fit the memory budget. One pass finds the
+    maximum wind speed. A second pass filters each chunk and spills its rows to a temporary
+    file per station. The spilled rows are then joined to the station data and appended to
+    `output_file` in the same row order as merge_weather_data. A .parquet output file gets one
+    row group per appended chunk and keeps the dtypes. With `partition_by`, e.g.
+    ['weatherstationcode'], it becomes a partitioned table directory (see save_data).
+
+    Args:
+        gis_path (str): Path to the GIS dataset.
+        station_summary_path (str): Path to the station summary dataset.
+        windspeed_path (str): Path to the windspeed snapshot dataset.
+        output_file (str): Path of the CSV or Parquet file to write.
+        memory_budget_mb (float): Approximate peak memory for windspeed chunks, in megabytes.
+        partition_by (list): Key columns to partition the output by, or None for a single file.
+        compression (str): Parquet compression codec.
+        row_group_size (int): Maximum rows per Parquet row group.
+
+    Returns:
+        str: Path to the written file or partitioned directory.
+    """
+    gis_data = get_gis_data(gis_path)
+    station_summary = get_station_summary_data(station_summary_path)
+    station_info = gis_data.merge(station_summary, left_on='weatherstationcode', right_on='station').drop(columns=['station'])
+    chunk_rows = estimate_chunk_rows(windspeed_path, station_info, memory_budget_mb)
+
+    # First pass: maximum wind speed and a dtype per column that fits every chunk
+    max_wind_speed = None
+    dtypes = None
+    row_count = 0
+    for chunk in pd.read_csv(windspeed_path, chunksize=chunk_rows):
+        # The maximum is taken in the schema dtype, which the second pass compares against
+        max_wind_speed = running_max(max_wind_speed, apply_schema(chunk[['wind_speed']], 'windspeed_snapshot')['wind_speed'])
+        chunk_dtypes = chunk.dtypes.to_dict()
+        dtypes = chunk_dtypes if dtypes is None else {col: combine_dtypes(dtypes[col], chunk_dtypes[col]) for col in dtypes}
+        row_count += len(chunk)
+    print(f"Windspeed Data streamed with {row_count} rows in chunks of {chunk_rows} rows.")
+
+    # Second pass: spill the rows of each station to its own file, keeping file order
+    station_codes = pd.Index(station_info['weatherstationcode'].unique())
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix='windspeed_spill_', dir=output_dir)
+    try:
+        spilled = set()
+        for chunk in pd.read_csv(windspeed_path, chunksize=chunk_rows, dtype=dtypes):
+            chunk = apply_schema(chunk, 'windspeed_snapshot')
+            chunk = chunk[chunk['wind_speed'] < max_wind_speed]
+            codes = station_codes.get_indexer(chunk['station'])
+            chunk = chunk[codes >= 0]
+            for code, station_rows in chunk.groupby(codes[codes >= 0], sort=False):
+                with open(os.path.join(spill_dir, f"{code}.pkl"), 'ab') as fh:
+                    pickle.dump(station_rows, fh)
+                spilled.add(code)
+
+        # Join the spilled rows station by station, in the order of the station data
+        with TableWriter(output_dir, os.path.basename(output_file), partition_by, compression, row_group_size) as writer:
+            for position in range(len(station_info)):
+                station_row = station_info.iloc[[position]]
+                code = station_codes.get_loc(station_row['weatherstationcode'].iloc[0])
+                if code not in spilled:
+                    continue
+                with open(os.path.join(spill_dir, f"{code}.pkl"), 'rb') as fh:
+                    while True:
+                        try:
+                            station_rows = pickle.load(fh)
+                        except EOFError:
+                            break
+                        merged_chunk = station_row.merge(station_rows, left_on='weatherstationcode', right_on='station').drop(columns=['station'])
+                        merged_chunk['exceed_threshold'] = (merged_chunk['wind_speed'] > merged_chunk['alert']).astype('int8')
+                        writer.write(restore_dtypes(merged_chunk))
+
+            if writer.schema_frame is None:
+                # No rows matched: still write the header so readers see the schema
+                empty = station_info.iloc[:0].merge(pd.read_csv(windspeed_path, nrows=0), left_on='weatherstationcode', right_on='station').drop(columns=['station'])
+                empty['exceed_threshold'] = pd.Series(dtype=int)
+                writer.write(restore_dtypes(empty))
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return writer.path
+
+def merged_weather_chunks(merged_data, columns=None):
+    """
+    Iterate over merged weather data in chunks.
+
+    The merge stage returns the merged DataFrame, or with a memory budget the path of the
+    table written by stream_merge_weather_data. Consumers fold the chunks into their results,
+    so a streamed table is never loaded at once.
+
+    Args:
+        merged_data (pd.DataFrame or str): Merged data, or the path of a merged weather table.
+        columns (list): Columns to load, or None for all.
+
+    Yields:
+        pd.DataFrame: The whole frame, or the chunks of the table with the merged_weather schema.
     """
-    Save a DataFrame to a CSV file.
+    if isinstance(merged_data, pd.DataFrame):
+        yield merged_data if columns is None else merged_data[columns]
+        return
+    for chunk in iter_table(merged_data, columns=columns):
+        yield apply_schema(chunk, 'merged_weather')
+
+def save_data(df, output_path, file_name, partition_by=None, compression='snappy', row_group_size=None):
+    """
+    Save a DataFrame to a CSV file, or to Parquet when the file name ends in .parquet.
+
+    The compact dtypes of schema.SCHEMAS are converted back first (schema.restore_dtypes),
+    so saved tables have the dtypes of the source CSV files. Parquet keeps the dtypes, and
+    GeoDataFrames are written as GeoParquet. With `partition_by` the table becomes a
+    directory with one partition per key value, which read_table can load selectively.
+    See table_store.TableWriter.
 
     Args:
         df (pd.DataFrame): DataFrame to save.
         output_path (str): Directory where the file will be saved.
-        file_name (str): Name of the CSV file.
+        file_name (str): Name of the CSV or Parquet file.
+        partition_by (list): Key columns to partition by, e.g. ['parent_feederid'].
+        compression (str): Parquet compression codec.
+        row_group_size (int): Maximum rows per Parquet row group.
 
     Returns:
-        str: Path to the saved file.
+        str: Path to the saved file or partitioned directory.
     """
-    os.makedirs(output_path, exist_ok=True)
-    file_path = os.path.join(output_path, file_name)
-    df.to_csv(file_path, index=False)
-    return file_path
+    return write_table(restore_dtypes(df), output_path, file_name, partition_by, compression, row_group_size)
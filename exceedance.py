@@ -0,0 +1,367 @@
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from etl import merged_weather_chunks
+from profiling import instrument
+
+
+class ExceedanceMatrix:
+    """
+    Station x date exceedance data for computing span PSPS probabilities.
+
+    Each station has one row and each date one column. When every station has at most one
+    reading per date, the matrix is held as two bit-packed bitmaps: `present` (the station has
+    a reading that day) and `clear` (the reading did not exceed its threshold). With repeated
+    readings it holds per-cell counts instead. This reproduces the row multiplication of the
+    date merges in calculate_span_PSPS_probability.
+
+    A span's probability is the share of dates on which all of its stations have readings and
+    at least one of them exceeds the threshold. It is computed with AND/OR reductions over the
+    stations' rows. Results are memoized by station set, since many spans share one.
+
+    Args:
+        stations (pd.Index): Station code of each row.
+        dates (pd.Index): Date of each column.
+        present (np.ndarray): Packed presence bitmap, or reading counts.
+        clear (np.ndarray): Packed non-exceedance bitmap, or non-exceeding reading counts.
+        packed (bool): Whether `present` and `clear` are bit-packed bitmaps.
+    """
+
+    def __init__(self, stations, dates, present, clear, packed):
+        self.stations = stations
+        self.dates = dates
+        self.present = present
+        self.clear = clear
+        self.packed = packed
+        self.memo = dict()
+
+    @classmethod
+    def from_merged_data(cls, merged_data, station_column='weatherstationcode', date_column='date',
+                         exceed_column='exceed_threshold'):
+        """
+        Build the matrix from the output of merge_weather_data.
+
+        A streamed merge is read chunk by chunk: the first chunk builds the matrix and the
+        others are added with add_rows, so only the matrix and one chunk are in memory.
+
+        Args:
+            merged_data (DataFrame or str): Merged weather station data, or the path of a streamed merge.
+            station_column (str): Column with the station code.
+            date_column (str): Column with the reading date.
+            exceed_column (str): Column flagging readings above the threshold.
+
+        Returns:
+            ExceedanceMatrix: The exceedance matrix.
+        """
+        if not isinstance(merged_data, pd.DataFrame):
+            matrix = None
+            for chunk in merged_weather_chunks(merged_data, [station_column, date_column, exceed_column]):
+                if matrix is None:
+                    matrix = cls.from_merged_data(chunk, station_column, date_column, exceed_column)
+                else:
+                    matrix.add_rows(chunk, station_column, date_column, exceed_column)
+            return matrix
+        station_codes, stations = pd.factorize(merged_data[station_column])
+        # Missing dates still match each other in the date merges, so they get a column too
+        date_codes, dates = pd.factorize(merged_data[date_column], use_na_sentinel=False)
+        exceeds = merged_data[exceed_column].to_numpy() != 0
+
+        known = station_codes >= 0
+        cells = station_codes[known].astype(np.int64) * len(dates) + date_codes[known]
+        shape = (len(stations), len(dates))
+        present = np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+        clear = np.bincount(cells[~exceeds[known]], minlength=shape[0] * shape[1]).reshape(shape)
+
+        # Categorical station codes are kept as plain values, so new stations can be appended
+        stations = pd.Index(np.asarray(stations, dtype=object))
+        if present.size == 0 or present.max() <= 1:
+            return cls(stations, pd.Index(dates), np.packbits(present.astype(bool), axis=1),
+                       np.packbits(clear.astype(bool), axis=1), packed=True)
+        return cls(stations, pd.Index(dates), present, clear, packed=False)
+
+    def reserve(self, n_stations, n_dates):
+        """
+        Grow the arrays to hold at least `n_stations` rows and `n_dates` columns.
+
+        Capacity grows geometrically, so appending readings one batch at a time stays
+        linear in the number of readings.
+        """
+        n_rows, n_columns = self.present.shape
+        needed_columns = (n_dates + 7) // 8 if self.packed else n_dates
+        if n_stations <= n_rows and needed_columns <= n_columns:
+            return
+        shape = (max(n_stations, 2 * n_rows), max(needed_columns, 2 * n_columns))
+        for name in ('present', 'clear'):
+            grown = np.zeros(shape, dtype=getattr(self, name).dtype)
+            grown[:n_rows, :n_columns] = getattr(self, name)
+            setattr(self, name, grown)
+
+    def unpack(self):
+        """Switch from bitmaps to per-cell counts, once a station gets a second reading on a date."""
+        if self.packed:
+            self.present = np.unpackbits(self.present, axis=1).astype(np.int64)
+            self.clear = np.unpackbits(self.clear, axis=1).astype(np.int64)
+            self.packed = False
+
+    def add_rows(self, rows, station_column='weatherstationcode', date_column='date', exceed_column='exceed_threshold'):
+        """
+        Add new merged readings in place.
+
+        Memoized probabilities of station sets that include a touched station are dropped.
+
+        Args:
+            rows (DataFrame): New rows in the format of merge_weather_data output.
+            station_column (str): Column with the station code.
+            date_column (str): Column with the reading date.
+            exceed_column (str): Column flagging readings above the threshold.
+
+        Returns:
+            set: Codes of the stations that received readings.
+        """
+        if rows.empty:
+            return set()
+        station_values = rows[station_column]
+        new_stations = pd.unique(station_values[self.stations.get_indexer(station_values) < 0].dropna())
+        if len(new_stations):
+            self.stations = self.stations.append(pd.Index(new_stations))
+        date_values = rows[date_column]
+        new_dates = pd.unique(date_values[self.dates.get_indexer(date_values) < 0])
+        if len(new_dates):
+            self.dates = self.dates.append(pd.Index(new_dates))
+        self.reserve(len(self.stations), len(self.dates))
+
+        station_codes = self.stations.get_indexer(station_values)
+        date_codes = self.dates.get_indexer(date_values)
+        known = station_codes >= 0
+        station_codes, date_codes = station_codes[known], date_codes[known]
+        clear = rows[exceed_column].to_numpy()[known] == 0
+
+        if self.packed:
+            cells = station_codes.astype(np.int64) * len(self.dates) + date_codes
+            masks = (0x80 >> (date_codes & 7)).astype(np.uint8)
+            already_present = (self.present[station_codes, date_codes >> 3] & masks) != 0
+            if already_present.any() or len(np.unique(cells)) < len(cells):
+                self.unpack()
+        if self.packed:
+            np.bitwise_or.at(self.present, (station_codes, date_codes >> 3), masks)
+            np.bitwise_or.at(self.clear, (station_codes[clear], date_codes[clear] >> 3), masks[clear])
+        else:
+            np.add.at(self.present, (station_codes, date_codes), 1)
+            np.add.at(self.clear, (station_codes[clear], date_codes[clear]), 1)
+
+        touched = set(self.stations[np.unique(station_codes)])
+        self.memo = {key: value for key, value in self.memo.items() if not any(code in touched for code, _ in key)}
+        return touched
+
+    def date_columns(self, since):
+        """
+        Mask of the date columns on or after a date, in the layout of `present`.
+
+        Args:
+            since (pd.Timestamp): First date kept.
+
+        Returns:
+            np.ndarray: Packed bitmap or boolean mask of the columns.
+        """
+        keep = np.asarray(self.dates >= since, dtype=bool)
+        if self.packed:
+            mask = np.zeros(self.present.shape[1], dtype=np.uint8)
+            packed = np.packbits(keep)
+        else:
+            mask = np.zeros(self.present.shape[1], dtype=bool)
+            packed = keep
+        mask[:len(packed)] = packed
+        return mask
+
+    def counts(self, rows, columns=None):
+        """
+        Count the date combinations of a set of station rows, as the chained date merges would.
+
+        Args:
+            rows (np.ndarray): Station row numbers, repeated for repeated stations.
+            columns (np.ndarray): Optional mask from date_columns restricting the dates counted.
+
+        Returns:
+            tuple: Number of combinations, and number of those where no station exceeds.
+        """
+        if self.packed:
+            # Repeating a station does not change a bitmap AND
+            rows = np.unique(rows)
+            all_present = np.bitwise_and.reduce(self.present[rows], axis=0)
+            all_clear = np.bitwise_and.reduce(self.clear[rows], axis=0)
+            if columns is not None:
+                all_present &= columns
+                all_clear &= columns
+            return int(np.unpackbits(all_present).sum()), int(np.unpackbits(all_clear).sum())
+        present = np.prod(self.present[rows].astype(np.float64), axis=0)
+        clear = np.prod(self.clear[rows].astype(np.float64), axis=0)
+        if columns is not None:
+            present, clear = present[columns], clear[columns]
+        return present.sum(), clear.sum()
+
+    def date_counts(self, rows, date_codes):
+        """
+        Count the date combinations of a set of station rows separately on some dates.
+
+        Args:
+            rows (np.ndarray): Station row numbers, repeated for repeated stations.
+            date_codes (np.ndarray): Date column numbers.
+
+        Returns:
+            tuple: Number of combinations on each date, and number of those where no station exceeds.
+        """
+        if self.packed:
+            rows = np.unique(rows)
+            shifts = (7 - (date_codes & 7)).astype(np.uint8)
+            present = np.bitwise_and.reduce((self.present[np.ix_(rows, date_codes >> 3)] >> shifts) & 1, axis=0)
+            clear = np.bitwise_and.reduce((self.clear[np.ix_(rows, date_codes >> 3)] >> shifts) & 1, axis=0)
+            return present.astype(np.float64), clear.astype(np.float64)
+        present = np.prod(self.present[np.ix_(rows, date_codes)].astype(np.float64), axis=0)
+        clear = np.prod(self.clear[np.ix_(rows, date_codes)].astype(np.float64), axis=0)
+        return present, clear
+
+    @instrument
+    def probability(self, associated_stations, columns=None):
+        """
+        Calculate the PSPS probability for a span.
+
+        Args:
+            associated_stations (iterable): Station records of the span; the first item of each is the station code.
+            columns (np.ndarray): Optional mask from date_columns; such results are not memoized.
+
+        Returns:
+            float: PSPS probability for the span, 0 if its stations share no dates.
+        """
+        codes = [station[0] for station in associated_stations]
+        if not codes:
+            return 0
+        key = frozenset(Counter(codes).items())
+        if columns is None and key in self.memo:
+            return self.memo[key]
+
+        rows = self.stations.get_indexer(pd.Index(codes, dtype=object))
+        if (rows < 0).any():
+            probability = 0
+        else:
+            wind_speed_count, clear_count = self.counts(rows, columns)
+            probability = 0 if wind_speed_count == 0 else np.float64(wind_speed_count - clear_count) / wind_speed_count
+        if columns is None:
+            self.memo[key] = probability
+        return probability
+
+    def span_probabilities(self, stations_to_span):
+        """
+        Calculate the PSPS probability of every span.
+
+        Args:
+            stations_to_span (dict): Mapping of spans to their associated station records.
+
+        Returns:
+            dict: Mapping of spans to PSPS probabilities.
+        """
+        return {globalid: self.probability(stations) for globalid, stations in stations_to_span.items()}
+
+    def save(self, store_dir):
+        """
+        Save the matrix as .npy files that worker processes can memory-map.
+
+        Only the filled part of the arrays is written. Each file is written under a temporary
+        name and renamed, so readers never see a partial file.
+
+        Args:
+            store_dir (str): Directory to write to.
+
+        Returns:
+            str: The directory.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        n_columns = (len(self.dates) + 7) // 8 if self.packed else len(self.dates)
+        arrays = {
+            'present': np.ascontiguousarray(self.present[:len(self.stations), :n_columns]),
+            'clear': np.ascontiguousarray(self.clear[:len(self.stations), :n_columns]),
+            'stations': np.asarray(self.stations, dtype=object),
+            'dates': np.asarray(self.dates),
+        }
+        for name, values in arrays.items():
+            temporary = os.path.join(store_dir, f".{name}.npy")
+            np.save(temporary, values, allow_pickle=values.dtype == object)
+            os.replace(temporary, os.path.join(store_dir, f"{name}.npy"))
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as fh:
+            json.dump({'packed': self.packed}, fh)
+        return store_dir
+
+    @classmethod
+    def open(cls, store_dir, mmap_mode='r'):
+        """
+        Attach to a matrix saved with `save` without reading it into memory.
+
+        The bitmaps or counts are memory-mapped read-only, so every process that opens the
+        store shares the same pages. Adding rows to an opened matrix is not supported; pass
+        `mmap_mode=None` to read the arrays into memory instead.
+
+        Args:
+            store_dir (str): Directory holding the matrix.
+            mmap_mode (str): Memory-map mode of the arrays, or None to load them.
+
+        Returns:
+            ExceedanceMatrix: The matrix, backed by the files.
+        """
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as fh:
+            meta = json.load(fh)
+        # Station codes and dates are small and may be Python objects
+        stations = pd.Index(np.load(os.path.join(store_dir, 'stations.npy'), allow_pickle=True), dtype=object)
+        dates = pd.Index(np.load(os.path.join(store_dir, 'dates.npy'), allow_pickle=True))
+        present = np.load(os.path.join(store_dir, 'present.npy'), mmap_mode=mmap_mode)
+        clear = np.load(os.path.join(store_dir, 'clear.npy'), mmap_mode=mmap_mode)
+        return cls(stations, dates, present, clear, meta['packed'])
+
+
+# Matrix opened by each worker process of parallel_span_probabilities
+WORKER_MATRIX = None
+
+
+def attach_store(store_dir):
+    """Open the shared exceedance store once per worker process."""
+    global WORKER_MATRIX
+    WORKER_MATRIX = ExceedanceMatrix.open(store_dir)
+
+
+def station_set_probabilities(station_sets):
+    """Probabilities of a chunk of station sets, computed in a worker process."""
+    return [WORKER_MATRIX.probability(stations) for stations in station_sets]
+
+
+@instrument
+def parallel_span_probabilities(store_dir, stations_to_span, n_workers=None, chunk_size=256):
+    """
+    Calculate the PSPS probability of every span in a process pool attached to a saved matrix.
+
+    Workers memory-map the store instead of receiving the merged data, so the total memory
+    stays close to one copy of the matrix. Each distinct station set is sent once.
+
+    Args:
+        store_dir (str): Directory written by ExceedanceMatrix.save.
+        stations_to_span (dict): Mapping of spans to their associated station records.
+        n_workers (int): Number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): Station sets per task.
+
+    Returns:
+        dict: Mapping of spans to PSPS probabilities, as ExceedanceMatrix.span_probabilities returns them.
+    """
+    keys = dict()
+    span_keys = dict()
+    for globalid, stations in stations_to_span.items():
+        codes = [station[0] for station in stations]
+        key = frozenset(Counter(codes).items())
+        keys.setdefault(key, stations)
+        span_keys[globalid] = key
+
+    station_sets = list(keys.values())
+    chunks = [station_sets[start:start + chunk_size] for start in range(0, len(station_sets), chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_store, initargs=(store_dir,)) as executor:
+        probabilities = [probability for chunk in executor.map(station_set_probabilities, chunks) for probability in chunk]
+    by_key = dict(zip(keys, probabilities))
+    return {globalid: by_key[key] for globalid, key in span_keys.items()}
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pyproj import CRS
+from data_cache import PARQUET_AVAILABLE, cache_paths, is_cache_valid, temporary_path, write_cache_meta
+from profiling import instrument
+
+
+@instrument
+def geometry_from_wkt(shapes):
+    """
+    Parse a column of WKT strings into geometries with a single vectorized call.
+
+    Args:
+        shapes (pd.Series): WKT strings. Missing values become empty (None) geometries.
+
+    Returns:
+        gpd.GeoSeries: Parsed geometries with the same index as `shapes`.
+    """
+    values = np.where(pd.notna(shapes), shapes.astype(object), None)
+    return gpd.GeoSeries.from_wkt(values, index=shapes.index)
+
+
+def crs_tag(crs):
+    """
+    Build a short, file-name safe tag for a coordinate reference system.
+
+    Args:
+        crs: Anything accepted by pyproj, or None for the source CRS.
+
+    Returns:
+        str: Tag such as 'epsg2230', or 'native' when no CRS is given.
+    """
+    if crs is None:
+        return 'native'
+    crs = CRS.from_user_input(crs)
+    epsg = crs.to_epsg()
+    if epsg is not None:
+        return f"epsg{epsg}"
+    return hashlib.sha1(crs.to_wkt().encode()).hexdigest()[:12]
+
+
+@instrument
+def load_geometry_store(file_path, name, build, target_crs=None, cache_dir=None):
+    """
+    Load a GeoDataFrame decoded from a source CSV, building and persisting it on first use.
+
+    The GeoDataFrame is stored as GeoParquet (geometries as WKB) next to the CSV cache.
+    It is keyed by the source file and the target CRS, and rebuilt when the source changes.
+    As with build_cache, the file is renamed into place before its metadata is written.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        name (str): Name of the dataset, used in the stored file name.
+        build (callable): Function returning the GeoDataFrame, already in `target_crs`.
+        target_crs: CRS the geometries were reprojected to, or None for the source CRS.
+        cache_dir (str): Cache directory. Defaults to a `cache` folder next to the source file.
+
+    Returns:
+        gpd.GeoDataFrame: Decoded and reprojected data.
+    """
+    if not PARQUET_AVAILABLE:
+        return build()
+
+    store_path, meta_path = cache_paths(file_path, cache_dir, variant=f"{name}-{crs_tag(target_crs)}")
+    if os.path.exists(store_path) and is_cache_valid(file_path, meta_path):
+        return gpd.read_parquet(store_path)
+
+    gdf = build()
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    temporary = temporary_path(store_path)
+    gdf.to_parquet(temporary)
+    os.replace(temporary, store_path)
+    write_cache_meta(file_path, meta_path)
+    return gdf
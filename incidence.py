@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from span_network import SpanNetwork
+from profiling import instrument
+
+
+class SpanStationIncidence:
+    """
+    Sparse span x station matrix of the weather stations upstream of each span.
+
+    Entry (i, j) is the number of times station j appears in span i's upstream station list
+    (the stations of its upstream spans, then its own station), so span-level sums, averages,
+    counts and maxima of any per-station metric are sparse matrix-vector products instead of
+    loops over the lists.
+
+    Args:
+        matrix (sparse.csr_matrix): Station counts, one row per span.
+        spans (pd.Index): Span id of each row.
+        stations (pd.Index): Station code of each column.
+    """
+
+    def __init__(self, matrix, spans, stations):
+        self.matrix = matrix.tocsr()
+        self.spans = spans
+        self.stations = stations
+
+    @classmethod
+    @instrument
+    def from_parent(cls, ids, parent, node_station, spans):
+        """
+        Build the matrix from a parent-pointer span forest without a per-span loop.
+
+        A node's row is its parent's row plus its own station, so the rows are built one
+        depth level at a time: each level selects its parents' rows from the level above
+        with a sparse product.
+
+        Args:
+            ids (array-like): Span id of each node.
+            parent (np.ndarray): Node code of each node's upstream span, or -1.
+            node_station (array-like): Weather station code of each node, missing for nodes without one.
+            spans (array-like): Span ids of the rows, in order.
+
+        Returns:
+            SpanStationIncidence: The incidence matrix, or None if the network has a cycle.
+        """
+        parent = np.asarray(parent, dtype=np.int64)
+        station_codes, stations = pd.factorize(pd.Series(node_station, dtype=object))
+        n_nodes, n_stations = len(parent), len(stations)
+        child_indptr, child_indices = SpanNetwork.children_csr(parent)
+
+        position = np.empty(n_nodes, dtype=np.int64)
+        levels, matrices = [], []
+        level = np.nonzero(parent < 0)[0]
+        above = None
+        while len(level):
+            position[level] = np.arange(len(level))
+            own = station_codes[level]
+            has_station = own >= 0
+            matrix = sparse.csr_matrix((np.ones(has_station.sum(), dtype=np.int32), (np.nonzero(has_station)[0], own[has_station])),
+                                       shape=(len(level), n_stations))
+            if above is not None:
+                select = sparse.csr_matrix((np.ones(len(level), dtype=np.int32), (np.arange(len(level)), position[parent[level]])),
+                                           shape=(len(level), above.shape[0]))
+                matrix = select @ above + matrix
+            levels.append(level)
+            matrices.append(matrix)
+            above = matrix
+
+            # Children of this level, in CSR slices of child_indices
+            counts = child_indptr[level + 1] - child_indptr[level]
+            starts = np.repeat(child_indptr[level] - np.cumsum(counts) + counts, counts)
+            level = child_indices[starts + np.arange(counts.sum())]
+
+        order = np.concatenate(levels) if levels else np.empty(0, dtype=np.int64)
+        if len(order) < n_nodes:
+            # Nodes on or below a cycle are never reached from a feeder top
+            return None
+
+        row_of_node = np.empty(n_nodes, dtype=np.int64)
+        row_of_node[order] = np.arange(n_nodes)
+        span_nodes = pd.Index(np.asarray(ids, dtype=object)).get_indexer(pd.Index(spans, dtype=object))
+        if (span_nodes < 0).any():
+            raise KeyError('Spans missing from the network.')
+        matrix = sparse.vstack(matrices, format='csr') if matrices else sparse.csr_matrix((0, n_stations), dtype=np.int32)
+        return cls(matrix[row_of_node[span_nodes]], pd.Index(spans), pd.Index(np.asarray(stations, dtype=object)))
+
+    @classmethod
+    def from_upstream_map(cls, upstream_stations):
+        """
+        Build the matrix from lists of upstream station records.
+
+        Used for networks that from_parent cannot handle (cycles, spans with several
+        upstream spans), whose lists come from upstream_weather_stations.
+
+        Args:
+            upstream_stations (dict): Span to its upstream station records, each starting with the station code.
+
+        Returns:
+            SpanStationIncidence: The incidence matrix.
+        """
+        lengths = np.fromiter((len(records) for records in upstream_stations.values()), dtype=np.int64, count=len(upstream_stations))
+        codes = [record[0] for records in upstream_stations.values() for record in records]
+        station_codes, stations = pd.factorize(pd.Series(codes, dtype=object))
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        # Repeated (row, station) entries are summed into counts
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, station_codes)),
+                                   shape=(len(lengths), len(stations)))
+        matrix.sum_duplicates()
+        return cls(matrix, pd.Index(list(upstream_stations)), pd.Index(np.asarray(stations, dtype=object)))
+
+    def station_vector(self, values):
+        """
+        Align a per-station metric with the matrix columns.
+
+        Args:
+            values (dict or pd.Series): Metric keyed by station code.
+
+        Returns:
+            np.ndarray: Float metric of each column.
+        """
+        values = pd.Series(values)
+        values.index = pd.Index(np.asarray(values.index, dtype=object))
+        missing = self.stations[~self.stations.isin(values.index)]
+        if len(missing):
+            raise KeyError(f"No value for stations: {list(missing[:5])}")
+        return values.reindex(self.stations).to_numpy(dtype=np.float64)
+
+    def counts(self):
+        """Number of upstream station entries of each span, repeats included."""
+        return pd.Series(np.asarray(self.matrix.sum(axis=1)).ravel(), index=self.spans)
+
+    def distinct_counts(self):
+        """Number of distinct upstream stations of each span."""
+        return pd.Series(np.diff(self.matrix.indptr), index=self.spans)
+
+    def total(self, values):
+        """
+        Sum a per-station metric over each span's upstream stations, repeats included.
+
+        Args:
+            values (dict or pd.Series): Metric keyed by station code.
+
+        Returns:
+            pd.Series: Sum of each span.
+        """
+        return pd.Series(self.matrix @ self.station_vector(values), index=self.spans)
+
+    def mean(self, values, fill=0):
+        """
+        Average a per-station metric over each span's upstream stations, repeats included.
+
+        Args:
+            values (dict or pd.Series): Metric keyed by station code.
+            fill: Value of spans without upstream stations.
+
+        Returns:
+            pd.Series: Average of each span.
+        """
+        totals = self.matrix @ self.station_vector(values)
+        counts = np.asarray(self.matrix.sum(axis=1)).ravel()
+        means = np.full(len(counts), fill, dtype=np.float64)
+        np.divide(totals, counts, out=means, where=counts > 0)
+        return pd.Series(means, index=self.spans)
+
+    def max(self, values, fill=0):
+        """
+        Largest value of a per-station metric among each span's upstream stations.
+
+        Args:
+            values (dict or pd.Series): Metric keyed by station code.
+            fill: Value of spans without upstream stations.
+
+        Returns:
+            pd.Series: Maximum of each span.
+        """
+        entries = self.station_vector(values)[self.matrix.indices]
+        nonempty = np.diff(self.matrix.indptr) > 0
+        maxima = np.full(len(self.spans), fill, dtype=np.float64)
+        if len(entries):
+            maxima[nonempty] = np.maximum.reduceat(entries, self.matrix.indptr[:-1][nonempty])
+        return pd.Series(maxima, index=self.spans)
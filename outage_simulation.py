@@ -0,0 +1,208 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import ndtri
+from etl import merged_weather_chunks
+from profiling import instrument
+
+# Span x trial-year draws held in memory at once by each batch
+SIMULATION_BATCH_CELLS = 1 << 24
+
+# Model of the worker processes, set once by their initializer
+WORKER_MODEL = None
+
+
+@instrument
+def station_exceedance_correlation(merged_data, station_column='weatherstationcode', date_column='date',
+                                   exceed_column='exceed_threshold'):
+    """
+    Average pairwise correlation of the daily exceedance flags of the weather stations.
+
+    Args:
+        merged_data (pd.DataFrame or str): Merged weather station data, or the path of a streamed merge.
+        station_column (str): Column with the station code.
+        date_column (str): Column with the reading date.
+        exceed_column (str): Column flagging readings above the threshold.
+
+    Returns:
+        float: Mean off-diagonal correlation, clipped to [0, 1), or 0 when it cannot be estimated.
+    """
+    if isinstance(merged_data, pd.DataFrame):
+        daily = merged_data.pivot_table(index=date_column, columns=station_column, values=exceed_column,
+                                        aggfunc='max', observed=True)
+    else:
+        # Daily maxima of each chunk, combined as plain values since chunks may hold different categories
+        maxima = [chunk.astype({station_column: object}).groupby([date_column, station_column])[exceed_column].max()
+                  for chunk in merged_weather_chunks(merged_data, [station_column, date_column, exceed_column])]
+        daily = pd.concat(maxima).groupby(level=[0, 1]).max().unstack()
+    correlation = daily.astype(float).corr().to_numpy()
+    off_diagonal = correlation[~np.eye(len(correlation), dtype=bool)]
+    off_diagonal = off_diagonal[~np.isnan(off_diagonal)]
+    if len(off_diagonal) == 0:
+        return 0.0
+    return float(np.clip(off_diagonal.mean(), 0.0, 0.99))
+
+
+class OutageModel:
+    """
+    Span-level PSPS outage events driven by correlated station-level weather events.
+
+    Every trial-year draws one standard normal variable per weather station from a one-factor
+    model: a regional weather factor shared by all stations plus station noise, with
+    `correlation` between any two stations. A span's variable is the normalized sum of its
+    upstream stations' variables, taken from the span x station incidence matrix. The span is
+    de-energized in that year when its variable falls below the quantile of its annual
+    probability 1 - (1 - probability) ** expected_fire. Each span's expected outage rate is
+    therefore the one feeder_analysis uses, while spans sharing stations, and all spans
+    through the regional factor, fail together.
+
+    Args:
+        weights (sparse.csr_matrix): Span x station counts of the upstream stations, one row per span row.
+        cutoff (np.ndarray): Outage cutoff of each span's scaled variable, -inf for spans that never fail.
+        feeders (sparse.csr_matrix): Feeder x span matrix of customer counts.
+        feeder_ids (pd.Index): Feeder id of each row of `feeders`.
+        correlation (float): Correlation of the station variables.
+        expected (np.ndarray): Expected customers affected per feeder and year.
+    """
+
+    def __init__(self, weights, cutoff, feeders, feeder_ids, correlation, expected):
+        self.weights = weights
+        self.cutoff = cutoff
+        self.feeders = feeders
+        self.feeder_ids = feeder_ids
+        self.correlation = correlation
+        self.expected = expected
+
+    @classmethod
+    def from_spans(cls, spans, incidence, correlation, feeder_column='parent_feederid'):
+        """
+        Build the model from the analyze_spans results.
+
+        Args:
+            spans (pd.DataFrame): Span data with 'globalid', 'probability', 'expected_fire',
+                'cust_total' and the feeder column.
+            incidence (SpanStationIncidence): Upstream station counts of each span.
+            correlation (float): Correlation of the station variables.
+            feeder_column (str): Column grouping the spans.
+
+        Returns:
+            OutageModel: The model.
+        """
+        rows = incidence.spans.get_indexer(pd.Index(spans['globalid'].to_numpy(dtype=object)))
+        if (rows < 0).any():
+            raise KeyError('Spans missing from the station incidence.')
+        weights = incidence.matrix[rows].astype(np.float64)
+
+        annual = 1 - (1 - spans['probability'].to_numpy(dtype=np.float64)) ** spans['expected_fire'].to_numpy(dtype=np.float64)
+        # Variance of the summed station variables: correlated part plus independent part
+        row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        row_squares = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()
+        scale = np.sqrt(correlation * row_sums ** 2 + (1 - correlation) * row_squares)
+        cutoff = np.full(len(spans), -np.inf)
+        can_fail = (annual > 0) & (scale > 0)
+        cutoff[can_fail] = ndtri(np.minimum(annual[can_fail], 1.0)) * scale[can_fail]
+
+        feeder_codes, feeder_ids = pd.factorize(spans[feeder_column])
+        customers = spans['cust_total'].to_numpy(dtype=np.float64)
+        known = feeder_codes >= 0
+        feeders = sparse.csr_matrix((customers[known], (feeder_codes[known], np.nonzero(known)[0])),
+                                    shape=(len(feeder_ids), len(spans)))
+        expected = feeders @ np.where(can_fail, annual, 0.0)
+        return cls(weights, cutoff, feeders, pd.Index(np.asarray(feeder_ids, dtype=object)), correlation, expected)
+
+    def simulate(self, n_trials, years, seed_sequence):
+        """
+        Customers affected per feeder in each of a batch of trials.
+
+        Args:
+            n_trials (int): Number of trials.
+            years (int): Years summed in each trial.
+            seed_sequence (np.random.SeedSequence): Seed of this batch.
+
+        Returns:
+            np.ndarray: Feeders x trials customer counts.
+        """
+        rng = np.random.default_rng(seed_sequence)
+        draws = n_trials * years
+        regional = rng.standard_normal(draws)
+        stations = np.sqrt(self.correlation) * regional + np.sqrt(1 - self.correlation) * rng.standard_normal((self.weights.shape[1], draws))
+        outages = (self.weights @ stations) < self.cutoff[:, None]
+        customers = self.feeders @ outages.astype(np.float64)
+        # Draws are trial-major, so each trial's years are consecutive columns. Totals stay
+        # float64, which holds customer counts exactly where float32 stops at 2**24
+        return customers.reshape(len(self.feeder_ids), n_trials, years).sum(axis=2)
+
+    def batch_trials(self, years):
+        """Trials per batch that keep the span x draw matrix within SIMULATION_BATCH_CELLS."""
+        return max(1, SIMULATION_BATCH_CELLS // max(1, self.weights.shape[0] * years))
+
+
+def init_worker(model):
+    """Keep the model in the worker process, so batches only send their seeds."""
+    global WORKER_MODEL
+    WORKER_MODEL = model
+
+
+def simulate_batch(job):
+    """Run one batch of trials in a worker process."""
+    n_trials, years, seed_sequence = job
+    return WORKER_MODEL.simulate(n_trials, years, seed_sequence)
+
+
+@instrument
+def simulate_outages(model, n_trials, years, seed=None, n_workers=1):
+    """
+    Simulate the customers affected per feeder over a number of years.
+
+    Trials run in batches with their own seeds spawned from `seed`, and the batch sizes only
+    depend on the model, so a fixed seed gives the same draws for any number of workers.
+
+    Args:
+        model (OutageModel): The outage model.
+        n_trials (int): Number of trials.
+        years (int): Years summed in each trial.
+        seed (int): Random seed, or None for fresh randomness.
+        n_workers (int): Number of worker processes; 1 runs the batches in this process.
+
+    Returns:
+        np.ndarray: Feeders x trials customer counts.
+    """
+    batch = model.batch_trials(years)
+    sizes = [min(batch, n_trials - start) for start in range(0, n_trials, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(size, years, seed_sequence) for size, seed_sequence in zip(sizes, seeds)]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers <= 1 or len(jobs) <= 1:
+        pieces = [model.simulate(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(model,)) as executor:
+            pieces = list(executor.map(simulate_batch, jobs))
+    if not pieces:
+        return np.zeros((len(model.feeder_ids), 0))
+    return np.concatenate(pieces, axis=1)
+
+
+def summarize_outages(model, samples, years, percentiles=(50, 90, 95)):
+    """
+    Per-feeder mean, spread and percentiles of the simulated customers affected.
+
+    Args:
+        model (OutageModel): The outage model.
+        samples (np.ndarray): Output of simulate_outages.
+        years (int): Years summed in each trial.
+        percentiles (list): Percentiles to report.
+
+    Returns:
+        pd.DataFrame: Indexed by feeder, with 'expected' (the feeder_analysis estimate over the
+            years), 'mean', 'std' and a 'p<N>' column per percentile.
+    """
+    summary = pd.DataFrame({'expected': model.expected * years, 'mean': samples.mean(axis=1, dtype=np.float64),
+                            'std': samples.std(axis=1, dtype=np.float64)}, index=model.feeder_ids)
+    summary.index.name = 'parent_feederid'
+    for percentile, values in zip(percentiles, np.percentile(samples, percentiles, axis=1)):
+        summary[f"p{percentile:g}"] = values
+    return summary
@@ -0,0 +1,525 @@
+import ast
+import contextlib
+import glob
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from data_cache import file_fingerprint, write_meta
+from profiling import profile_stage, write_report, print_report
+
+
+class Stage:
+    """
+    A pipeline target and the inputs its result depends on.
+
+    Args:
+        name (str): Target name used on the command line.
+        func (callable): Function called as func(config, inputs), where inputs maps each
+            dependency name to its result.
+        depends_on (tuple): Names of the stages whose results the stage consumes.
+        data_sources (tuple): Keys of `data_sources` in data-params.json read by the stage.
+        parameters (tuple): Keys of `parameters` in data-params.json that change the stage's result.
+        checkpoint (bool): Whether the result is saved to disk and reused.
+    """
+
+    def __init__(self, name, func, depends_on=(), data_sources=(), parameters=(), checkpoint=True):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.data_sources = tuple(data_sources)
+        self.parameters = tuple(parameters)
+        self.checkpoint = checkpoint
+
+    def load(self):
+        """Import the modules of the stage ahead of running it, as listed by function_imports."""
+        for module in function_imports(self.func):
+            importlib.import_module(module)
+
+
+def imported_modules(tree):
+    """Names of the modules imported anywhere in an ast tree, in the order they are found."""
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def function_definitions(func):
+    """
+    Find the definition of a function and of the top-level helpers of its module it uses.
+
+    Args:
+        func (callable): Function defined at the top level of a module.
+
+    Returns:
+        tuple: Source of the module, and the ast nodes of the function and its helpers.
+    """
+    source = inspect.getsource(sys.modules[func.__module__])
+    functions = {node.name: node for node in ast.parse(source).body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    definitions = []
+    pending = [func.__name__]
+    while pending:
+        name = pending.pop(0)
+        if name not in functions or functions[name] in definitions:
+            continue
+        definitions.append(functions[name])
+        pending.extend(node.id for node in ast.walk(functions[name]) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load))
+    return source, definitions
+
+
+def function_imports(func):
+    """
+    List the modules a function imports when it runs, read from its source.
+
+    Stage functions import their modules in their body, so a target only pays for the
+    libraries it uses. Helpers defined at the top level of the same module and used by the
+    function are followed, so a stage that calls save_output also lists what it imports.
+
+    Args:
+        func (callable): Function defined at the top level of a module.
+
+    Returns:
+        list: Module names, in the order they are found.
+    """
+    modules = []
+    for definition in function_definitions(func)[1]:
+        modules.extend(imported_modules(definition))
+    return list(dict.fromkeys(modules))
+
+
+def local_modules(modules, code_dir):
+    """
+    Follow imports through the pipeline's own modules.
+
+    Args:
+        modules (list): Imported module names.
+        code_dir (str): Directory holding the pipeline modules.
+
+    Returns:
+        list: Sorted names of the modules in `code_dir` among `modules` and everything they
+            import, at any depth. Third-party modules are left out.
+    """
+    found = set()
+    pending = [module.split('.')[0] for module in modules]
+    while pending:
+        name = pending.pop()
+        path = os.path.join(code_dir, f"{name}.py")
+        if name in found or not os.path.exists(path):
+            continue
+        found.add(name)
+        with open(path, 'r') as fh:
+            pending.extend(module.split('.')[0] for module in imported_modules(ast.parse(fh.read())))
+    return sorted(found)
+
+
+def resolve_stages(stages, targets):
+    """
+    List the targets and every stage they depend on, dependencies first.
+
+    Args:
+        stages (dict): Stage name to Stage.
+        targets (list): Requested stage names.
+
+    Returns:
+        list: Stage names in dependency order.
+    """
+    order = []
+
+    def visit(name, trail):
+        if name not in stages:
+            raise ValueError(f"Unknown target: {name}. Use one of: {', '.join(stages)}.")
+        if name in trail:
+            raise ValueError(f"Stage dependency cycle: {' -> '.join(trail + (name,))}")
+        if name in order:
+            return
+        for dependency in stages[name].depends_on:
+            visit(dependency, trail + (name,))
+        order.append(name)
+
+    for target in targets:
+        visit(target, ())
+    return order
+
+
+def code_fingerprint(func, code_dir=None):
+    """
+    Hash the code a stage runs, so its checkpoint is rebuilt after a change to that code.
+
+    The hash covers the source of the stage function and of the helpers it uses, and the
+    pipeline modules it imports with their own imports (local_modules). Editing a module the
+    stage does not reach, such as benchmark.py, leaves its checkpoint valid. Changes upstream
+    reach it through the keys of its dependencies.
+
+    Args:
+        func (callable): Stage function.
+        code_dir (str): Directory holding the pipeline modules. Defaults to this file's directory.
+
+    Returns:
+        str: Hex digest of the stage's code.
+    """
+    if code_dir is None:
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    source, definitions = function_definitions(func)
+    for definition in definitions:
+        digest.update(ast.get_source_segment(source, definition).encode())
+    for module in local_modules(function_imports(func), code_dir):
+        digest.update(f"{module}.py".encode())
+        with open(os.path.join(code_dir, f"{module}.py"), 'rb') as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def stage_key(stage, config, upstream_keys, code_version):
+    """
+    Fingerprint everything a stage's result depends on.
+
+    Args:
+        stage (Stage): The stage.
+        config (dict): Contents of data-params.json.
+        upstream_keys (dict): Keys of the stages it depends on.
+        code_version (str): Fingerprint of the stage's code, from code_fingerprint.
+
+    Returns:
+        str: Hex digest identifying the stage's result.
+    """
+    sources = dict()
+    for source in stage.data_sources:
+        fingerprint = file_fingerprint(config['data_sources'][source])
+        sources[source] = [fingerprint['source'], fingerprint['size'], fingerprint['mtime_ns']]
+    payload = {
+        'stage': stage.name,
+        'code': code_version,
+        'data_sources': sources,
+        'parameters': {parameter: config['parameters'].get(parameter) for parameter in stage.parameters},
+        'upstream': {dependency: upstream_keys[dependency] for dependency in stage.depends_on},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def checkpoint_path(checkpoint_dir, name, key):
+    """Path of the checkpoint file for a stage result."""
+    return os.path.join(checkpoint_dir, f"{name}-{key[:16]}.pkl")
+
+
+def save_checkpoint(result, path):
+    """
+    Pickle a stage result, replacing older checkpoints of the same stage.
+
+    When the result is the path of a file the stage wrote, such as a streamed merge, the
+    fingerprint of that output is saved next to the checkpoint (output_fingerprint).
+
+    Args:
+        result: Stage result.
+        path (str): Destination checkpoint file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stage_prefix = os.path.basename(path).rsplit('-', 1)[0]
+    for pattern in ('pkl', 'output.json'):
+        for stale in glob.glob(os.path.join(os.path.dirname(path), f"{stage_prefix}-*.{pattern}")):
+            if stale not in (path, output_meta_path(path)):
+                os.remove(stale)
+    fingerprint = output_fingerprint(result)
+    if fingerprint is not None:
+        write_meta(output_meta_path(path), {'output': result, 'files': fingerprint})
+    elif os.path.exists(output_meta_path(path)):
+        os.remove(output_meta_path(path))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as fh:
+        pickle.dump(result, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path):
+    """Load a pickled stage result."""
+    with open(path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def output_meta_path(path):
+    """Path of the output fingerprint saved next to a checkpoint."""
+    return f"{os.path.splitext(path)[0]}.output.json"
+
+
+def output_fingerprint(result):
+    """
+    Fingerprint the output file or partitioned directory a stage result points to.
+
+    Args:
+        result: Stage result.
+
+    Returns:
+        list: Path, size and modification time of each output file, or None when the result
+            is not the path of an existing file or directory.
+    """
+    if not isinstance(result, str) or not os.path.exists(result):
+        return None
+    if os.path.isdir(result):
+        files = sorted(file for file in glob.glob(os.path.join(result, '**', '*'), recursive=True) if os.path.isfile(file))
+    else:
+        files = [result]
+    fingerprints = [file_fingerprint(file) for file in files]
+    return [[fingerprint['source'], fingerprint['size'], fingerprint['mtime_ns']] for fingerprint in fingerprints]
+
+
+def is_checkpoint_valid(path):
+    """
+    Check that a checkpoint exists and that the output file it points to, if any, is unchanged.
+
+    Args:
+        path (str): Checkpoint file.
+
+    Returns:
+        bool: True if the checkpoint can be reused.
+    """
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(output_meta_path(path)):
+        return True
+    with open(output_meta_path(path), 'r') as fh:
+        meta = json.load(fh)
+    return output_fingerprint(meta['output']) == meta['files']
+
+
+def stage_plan(stages, targets, config, checkpoint_dir, force=False):
+    """
+    Work out which stages have to run and where their checkpoints go.
+
+    A stage that is not requested and has a checkpoint for its current inputs is reused, and
+    the stages only it depends on are left out. A checkpoint whose result is an output file
+    that was changed or removed since is not reused (is_checkpoint_valid).
+
+    Args:
+        stages (dict): Stage name to Stage.
+        targets (list): Requested stage names.
+        config (dict): Contents of data-params.json.
+        checkpoint_dir (str): Directory holding the checkpoints.
+        force (bool): Rebuild every stage instead of loading checkpoints.
+
+    Returns:
+        tuple: Names of the stages to run in dependency order, and checkpoint path by stage
+            name (None for stages that are not checkpointed).
+    """
+    keys = dict()
+    paths = dict()
+    for name in resolve_stages(stages, targets):
+        stage = stages[name]
+        keys[name] = stage_key(stage, config, keys, code_fingerprint(stage.func))
+        paths[name] = checkpoint_path(checkpoint_dir, name, keys[name]) if stage.checkpoint else None
+
+    to_run = set()
+
+    def require(name):
+        if name in to_run:
+            return
+        if name not in targets and not force and paths[name] and is_checkpoint_valid(paths[name]):
+            return
+        to_run.add(name)
+        for dependency in stages[name].depends_on:
+            require(dependency)
+
+    for target in targets:
+        require(target)
+    return [name for name in paths if name in to_run], paths
+
+
+def run_pipeline(stages, targets, config, checkpoint_dir, force=False, max_workers=1, log_dir=None,
+                 profile_dir=None, cprofile=False):
+    """
+    Run the requested targets, reusing valid checkpoints of the stages they depend on.
+
+    Requested targets always run. A dependency is loaded from its checkpoint when one exists
+    for its current inputs: source file fingerprints, relevant parameters, upstream results
+    and pipeline code. Otherwise it is rebuilt and checkpointed.
+
+    With more than one worker, stages whose dependencies are done run concurrently in a
+    process pool (see run_stages_concurrently).
+
+    Args:
+        stages (dict): Stage name to Stage.
+        targets (list): Requested stage names.
+        config (dict): Contents of data-params.json.
+        checkpoint_dir (str): Directory holding the checkpoints.
+        force (bool): Rebuild every stage instead of loading checkpoints.
+        max_workers (int): Number of stages run at the same time.
+        log_dir (str): Directory for the per-stage logs of concurrent runs.
+        profile_dir (str): If given, each stage is profiled and a JSON report is written there.
+        cprofile (bool): Also write a cProfile dump of each stage to `profile_dir`.
+
+    Returns:
+        dict: Results of the requested targets, plus those of other stages run in this process.
+    """
+    start = time.perf_counter()
+    to_run, paths = stage_plan(stages, targets, config, checkpoint_dir, force)
+    profile = {'dir': profile_dir, 'cprofile': cprofile} if profile_dir else None
+    records = []
+    if max_workers > 1 and len(to_run) > 1:
+        results = run_stages_concurrently(stages, to_run, targets, config, paths, max_workers,
+                                          log_dir or os.path.join(checkpoint_dir, 'logs'), profile, records)
+    else:
+        results = run_stages_serially(stages, to_run, config, paths, profile, records)
+
+    if profile:
+        print_report(records)
+        print(f"Profile report saved to {write_report(records, profile_dir, time.perf_counter() - start)}")
+    return results
+
+
+def call_stage(name, func, config, inputs, profile):
+    """
+    Call a stage function, profiling it when requested.
+
+    Returns:
+        tuple: The stage result and its profile record, or None when not profiling.
+    """
+    if not profile:
+        return func(config, inputs), None
+    return profile_stage(name, func, config, inputs, profile['dir'] if profile['cprofile'] else None)
+
+
+def run_stages_serially(stages, to_run, config, paths, profile=None, records=None):
+    """
+    Run stages one after the other in this process.
+
+    Args:
+        stages (dict): Stage name to Stage.
+        to_run (list): Names of the stages to run, in dependency order.
+        config (dict): Contents of data-params.json.
+        paths (dict): Checkpoint path by stage name.
+        profile (dict): Profiling options, or None.
+        records (list): Receives the profile record of each stage.
+
+    Returns:
+        dict: Results of the stages run and of the checkpoints loaded.
+    """
+    results = dict()
+    for name in to_run:
+        stage = stages[name]
+        inputs = dict()
+        for dependency in stage.depends_on:
+            if dependency not in results:
+                print(f"Using checkpoint for {dependency}: {paths[dependency]}")
+                results[dependency] = load_checkpoint(paths[dependency])
+            inputs[dependency] = results[dependency]
+        results[name], record = call_stage(name, stage.func, config, inputs, profile)
+        if record:
+            records.append(record)
+        if paths[name]:
+            save_checkpoint(results[name], paths[name])
+    return results
+
+
+def run_stage_process(name, func, config, inputs, path, log_path, return_result, profile=None):
+    """
+    Run one stage in a worker process, with its output written to a log file.
+
+    Args:
+        name (str): Stage name.
+        func (callable): Stage function.
+        config (dict): Contents of data-params.json.
+        inputs (dict): Dependency name to ('checkpoint', path) or ('result', value).
+        path (str): Checkpoint file for the result, or None.
+        log_path (str): File receiving the stage's stdout and stderr.
+        return_result (bool): Whether to send the result back to the parent process.
+        profile (dict): Profiling options, or None.
+
+    Returns:
+        tuple: The stage result (None when `return_result` is False) and its profile record.
+    """
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        loaded = dict()
+        for dependency, (kind, value) in inputs.items():
+            if kind == 'checkpoint':
+                print(f"Using checkpoint for {dependency}: {value}")
+                value = load_checkpoint(value)
+            loaded[dependency] = value
+        try:
+            result, record = call_stage(name, func, config, loaded, profile)
+        except BaseException:
+            traceback.print_exc()
+            raise
+        if path:
+            save_checkpoint(result, path)
+    return (result if return_result else None), record
+
+
+def print_stage_log(name, log_path):
+    """Print the log of a stage run in a worker process."""
+    print(f"----- {name} -----")
+    with open(log_path, 'r') as fh:
+        print(fh.read(), end='')
+
+
+def run_stages_concurrently(stages, to_run, targets, config, paths, max_workers, log_dir, profile=None, records=None):
+    """
+    Run stages in a process pool, each as soon as its dependencies are done.
+
+    Stages exchange results through their checkpoint files. Each stage's output goes to
+    `{log_dir}/{stage}.log` and is printed when the stage finishes. If a stage fails, the
+    stages not yet started are cancelled and the error is raised once the running ones end.
+
+    Args:
+        stages (dict): Stage name to Stage.
+        to_run (list): Names of the stages to run, in dependency order.
+        targets (list): Requested stage names.
+        config (dict): Contents of data-params.json.
+        paths (dict): Checkpoint path by stage name.
+        max_workers (int): Number of stages run at the same time.
+        log_dir (str): Directory for the per-stage logs.
+        profile (dict): Profiling options, or None.
+        records (list): Receives the profile record of each stage.
+
+    Returns:
+        dict: Results of the requested targets.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    waiting = list(to_run)
+    results = dict()
+    done = {name for name in paths if name not in to_run}
+    running = dict()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for name in [name for name in waiting if all(dep in done for dep in stages[name].depends_on)]:
+                if len(running) >= max_workers:
+                    break
+                inputs = {
+                    dependency: ('checkpoint', paths[dependency]) if paths[dependency] else ('result', results[dependency])
+                    for dependency in stages[name].depends_on
+                }
+                # Stages other processes still need and that are not checkpointed are sent back
+                return_result = name in targets or not paths[name]
+                log_path = os.path.join(log_dir, f"{name}.log")
+                future = executor.submit(run_stage_process, name, stages[name].func, config, inputs, paths[name],
+                                         log_path, return_result, profile)
+                running[future] = name
+                waiting.remove(name)
+                print(f"Started {name}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                print_stage_log(name, os.path.join(log_dir, f"{name}.log"))
+                try:
+                    result, record = future.result()
+                except BaseException as error:
+                    for pending in running:
+                        pending.cancel()
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise RuntimeError(f"Stage {name} failed; see {os.path.join(log_dir, name + '.log')}") from error
+                if result is not None:
+                    results[name] = result
+                if record:
+                    records.append(record)
+                done.add(name)
+    return results
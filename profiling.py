@@ -0,0 +1,352 @@
+import cProfile
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Bytes per memory page, for the resident page counts in /proc
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Call counts and cumulative time of instrumented functions, collected while enabled
+INSTRUMENTATION = {'enabled': False, 'calls': dict()}
+
+
+def instrument(func=None, name=None):
+    """
+    Count the calls and cumulative wall time of a function while profiling is enabled.
+
+    When profiling is off, the wrapper only checks a flag before calling the function.
+
+    Args:
+        func (callable): Function to wrap, when used as a bare decorator.
+        name (str): Name used in the report. Defaults to module.qualname.
+
+    Returns:
+        callable: The wrapped function, or a decorator when `func` is not given.
+    """
+    def decorate(func):
+        label = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION['enabled']:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats = INSTRUMENTATION['calls'].setdefault(label, {'calls': 0, 'seconds': 0.0})
+                stats['calls'] += 1
+                stats['seconds'] += elapsed
+
+        return wrapper
+
+    return decorate(func) if func is not None else decorate
+
+
+def enable_instrumentation(enabled=True):
+    """Turn collection of instrumented call statistics on or off, clearing earlier ones."""
+    INSTRUMENTATION['enabled'] = enabled
+    INSTRUMENTATION['calls'] = dict()
+
+
+def instrumentation_snapshot():
+    """Copy of the call statistics collected so far, slowest first."""
+    calls = INSTRUMENTATION['calls']
+    return {label: dict(stats) for label, stats in sorted(calls.items(), key=lambda item: item[1]['seconds'], reverse=True)}
+
+
+def peak_rss_mb(who='self'):
+    """
+    Peak resident set size of this process or of its finished child processes, over their lifetime.
+
+    Args:
+        who (str): 'self' or 'children'.
+
+    Returns:
+        float: Peak RSS in MB, or None where the resource module is unavailable.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss * scale / (1024 * 1024)
+
+
+def current_rss_mb(pid='self'):
+    """
+    Resident set size of a process now.
+
+    Args:
+        pid (int or str): Process id, or 'self'.
+
+    Returns:
+        float: RSS in MB, or None where /proc is unavailable or the process has ended.
+    """
+    try:
+        with open(f"/proc/{pid}/statm", 'r') as fh:
+            resident_pages = int(fh.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * PAGE_SIZE / (1024 * 1024)
+
+
+def descendant_pids(pid='self'):
+    """Ids of the running child processes of a process and of their own children, from /proc."""
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    pids = []
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children", 'r') as fh:
+                children = [int(child) for child in fh.read().split()]
+        except (OSError, ValueError):
+            continue
+        for child in children:
+            pids.append(child)
+            pids.extend(descendant_pids(child))
+    return pids
+
+
+def children_rss_mb():
+    """Total resident set size of the running child processes, in MB."""
+    return sum(current_rss_mb(pid) or 0.0 for pid in descendant_pids())
+
+
+class RSSSampler:
+    """
+    Track the memory a stage adds while it runs.
+
+    The lifetime peaks of the resource module do not come down after a large stage, so a
+    background thread samples the current RSS of this process and the total RSS of its child
+    processes instead. The peaks are reported relative to the RSS when sampling started. When
+    the process sets a new lifetime peak meanwhile, that exact peak replaces the sampled one,
+    which can miss a spike between two samples.
+
+    Args:
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        """Update the peaks with the current RSS."""
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+            self.child_peak = max(self.child_peak, children_rss_mb())
+
+    def run(self):
+        """Sample until stopped; runs in the background thread."""
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """Record the starting RSS and start sampling."""
+        self.start_rss = current_rss_mb()
+        self.start_child_rss = children_rss_mb() if self.start_rss is not None else None
+        self.start_lifetime_peak = peak_rss_mb('self')
+        self.peak = self.start_rss or 0.0
+        self.child_peak = self.start_child_rss or 0.0
+        if self.start_rss is not None:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        Returns:
+            dict: 'start_rss_mb', and 'peak_rss_mb' and 'peak_child_rss_mb', the peaks above
+                the starting RSS. All None where /proc is unavailable.
+        """
+        if self.start_rss is None:
+            return {'start_rss_mb': None, 'peak_rss_mb': None, 'peak_child_rss_mb': None}
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        lifetime_peak = peak_rss_mb('self')
+        if lifetime_peak is not None and lifetime_peak > self.start_lifetime_peak:
+            self.peak = max(self.peak, lifetime_peak)
+        return {
+            'start_rss_mb': self.start_rss,
+            'peak_rss_mb': self.peak - self.start_rss,
+            'peak_child_rss_mb': self.child_peak - self.start_child_rss,
+        }
+
+
+def cpu_seconds():
+    """CPU time used by this process and its finished child processes, in seconds."""
+    if resource is None:
+        return time.process_time()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def count_rows(value, depth=1):
+    """
+    Row counts of a stage input or result.
+
+    Args:
+        value: DataFrame, dict of stage outputs, or any other object.
+        depth (int): Levels of nested dicts reported entry by entry; deeper dicts give their length.
+
+    Returns:
+        int or dict: Number of rows, a dict of counts for each entry of a dict, or None.
+    """
+    if isinstance(value, dict) and depth > 0:
+        return {key: count_rows(item, depth - 1) for key, item in value.items()}
+    if hasattr(value, 'shape') and len(getattr(value, 'shape')) > 0:
+        return int(value.shape[0])
+    if hasattr(value, '__len__'):
+        return len(value)
+    return None
+
+
+def profile_stage(name, func, config, inputs, profile_dir=None):
+    """
+    Run a stage function and record its resource usage.
+
+    Args:
+        name (str): Stage name.
+        func (callable): Stage function, called as func(config, inputs).
+        config (dict): Contents of data-params.json.
+        inputs (dict): Results of the stages it depends on.
+        profile_dir (str): If given, a cProfile dump is written to `{profile_dir}/{name}.prof`.
+
+    Returns:
+        tuple: The stage result and a dict with wall and CPU seconds, the peak RSS the stage
+            added to this process and to its child processes (RSSSampler), row counts and the
+            instrumented function statistics.
+    """
+    enable_instrumentation()
+    sampler = RSSSampler().start()
+    profiler = cProfile.Profile() if profile_dir else None
+    wall_start = time.perf_counter()
+    cpu_start = cpu_seconds()
+    if profiler:
+        profiler.enable()
+    try:
+        result = func(config, inputs)
+    finally:
+        if profiler:
+            profiler.disable()
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_used = cpu_seconds() - cpu_start
+        memory = sampler.stop()
+        functions = instrumentation_snapshot()
+        enable_instrumentation(False)
+
+    record = {
+        'stage': name,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_used,
+        **memory,
+        'input_rows': count_rows(inputs, depth=2),
+        'output_rows': count_rows(result),
+        'functions': functions,
+    }
+    if profiler:
+        os.makedirs(profile_dir, exist_ok=True)
+        record['cprofile'] = os.path.join(profile_dir, f"{name}.prof")
+        profiler.dump_stats(record['cprofile'])
+    return result, record
+
+
+def write_report(records, profile_dir, total_wall_seconds=None):
+    """
+    Write the stage records of a run to a timestamped JSON report.
+
+    Args:
+        records (list): Records returned by profile_stage.
+        profile_dir (str): Directory for the report.
+        total_wall_seconds (float): Wall time of the whole run.
+
+    Returns:
+        str: Path to the report.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    created = datetime.now()
+    report = {
+        'created': created.isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'total_wall_seconds': total_wall_seconds,
+        'stages': {record['stage']: record for record in records},
+    }
+    path = os.path.join(profile_dir, f"report-{created.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    return path
+
+
+def print_report(records):
+    """Print a one-line summary per stage and its slowest instrumented functions."""
+    for record in records:
+        rss = record['peak_rss_mb']
+        print(f"{record['stage']}: {record['wall_seconds']:.2f}s wall, {record['cpu_seconds']:.2f}s CPU, "
+              f"peak RSS {'n/a' if rss is None else f'+{rss:.0f} MB'}")
+        for label, stats in list(record['functions'].items())[:5]:
+            print(f"    {label}: {stats['calls']} calls, {stats['seconds']:.2f}s")
+
+
+def compare_reports(baseline_path, current_path, tolerance=0.2):
+    """
+    Compare two reports and list the stages and functions that got slower.
+
+    Args:
+        baseline_path (str): Earlier report.
+        current_path (str): Later report.
+        tolerance (float): Relative slowdown allowed before an entry counts as a regression.
+
+    Returns:
+        list: (name, metric, baseline value, current value) for each regression.
+    """
+    with open(baseline_path, 'r') as fh:
+        baseline = json.load(fh)['stages']
+    with open(current_path, 'r') as fh:
+        current = json.load(fh)['stages']
+
+    regressions = []
+
+    def check(name, metric, before, after):
+        if before is not None and after is not None and after > before * (1 + tolerance):
+            regressions.append((name, metric, before, after))
+
+    for stage, record in current.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]
+        for metric in ('wall_seconds', 'cpu_seconds', 'peak_rss_mb'):
+            check(stage, metric, before.get(metric), record.get(metric))
+        for label, stats in record['functions'].items():
+            if label in before['functions']:
+                check(f"{stage}:{label}", 'seconds', before['functions'][label]['seconds'], stats['seconds'])
+    return regressions
+
+
+if __name__ == "__main__":
+    # python profiling.py <baseline report> <current report> [tolerance]
+    tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+    regressions = compare_reports(sys.argv[1], sys.argv[2], tolerance)
+    for name, metric, before, after in regressions:
+        print(f"{name} {metric}: {before:.2f} -> {after:.2f}")
+    print(f"{len(regressions)} regressions above {tolerance:.0%}.")
@@ -1,29 +1,65 @@
 import pandas as pd
+from etl import merged_weather_chunks
+from profiling import instrument
 
+def station_exceedance_counts(merged_data, condition):
+    """Counts the wind speed records of each weather station and those above a threshold.
+
+    The counts are summed over the chunks of the merged data, so a streamed merge is never
+    loaded at once.
+
+    Args:
+        merged_data (pd.DataFrame or str): The merged dataset, or the path of a streamed merge.
+        condition (str): Threshold column, e.g. 'alert'.
+
+    Returns:
+        pd.DataFrame: 'wind_speed_count' and 'above_threshold_count' indexed by weather station code.
+    """
+    counts = []
+    for chunk in merged_weather_chunks(merged_data, ['weatherstationcode', 'wind_speed', condition]):
+        stations = chunk['weatherstationcode']
+        counts.append(pd.DataFrame({
+            'wind_speed_count': chunk['wind_speed'].groupby(stations, observed=True).count(),
+            'above_threshold_count': (chunk['wind_speed'] > chunk[condition]).groupby(stations, observed=True).sum(),
+        }))
+    if len(counts) == 1:
+        return counts[0]
+    # Chunks may hold different category sets, so their station codes are combined as plain values
+    counts = pd.concat([chunk.set_axis(chunk.index.astype(object)) for chunk in counts])
+    return counts.groupby(level=0, sort=False).sum().rename_axis('weatherstationcode')
+
+
+@instrument
 def calculate_psps_probability(merged_data, gis_weather_station, condition):
     """Calculates the PSPS probability for each weather station using record-specific thresholds
        and merges it with GIS weather station metadata.
 
     Args:
-        merged_data (pd.DataFrame): The merged dataset containing wind speed data and alert thresholds.
+        merged_data (pd.DataFrame or str): The merged dataset containing wind speed data and alert
+            thresholds, or the path of a streamed merge.
         gis_weather_station (pd.DataFrame): GIS metadata for weather stations.
 
     Returns:
         pd.DataFrame: A DataFrame with PSPS probabilities and GIS metadata.
     """
-    # Step 1: Count wind speed records for each weather station
-    wind_speed_count = merged_data.groupby('weatherstationcode')[['wind_speed']].count()
-    wind_speed_count = wind_speed_count.rename(columns={'wind_speed': 'wind_speed_count'})
+    # Step 1-2: Count wind speed records and records exceeding the threshold for each weather station
+    combined_count = station_exceedance_counts(merged_data, condition)
 
-    # Step 2: Count records exceeding the alert threshold
-    wind_speed_above_threshold = merged_data[merged_data['wind_speed'] > merged_data[condition]]
-    above_threshold_count = wind_speed_above_threshold.groupby('weatherstationcode')[['wind_speed']].count()
-    above_threshold_count = above_threshold_count.rename(columns={'wind_speed': 'above_threshold_count'})
-
-    # Step 3: Combine counts and calculate PSPS probability
-    combined_count = wind_speed_count.join(above_threshold_count, how='left').fillna(0)
+    # Step 3: Calculate PSPS probability
     combined_count['PSPS_probability'] = combined_count['above_threshold_count'] / combined_count['wind_speed_count']
 
+    return merge_station_psps(combined_count, gis_weather_station)
+
+def merge_station_psps(combined_count, gis_weather_station):
+    """Merges per-station counts and PSPS probabilities with GIS weather station metadata.
+
+    Args:
+        combined_count (pd.DataFrame): Counts and PSPS probability indexed by weather station code.
+        gis_weather_station (pd.DataFrame): GIS metadata for weather stations.
+
+    Returns:
+        pd.DataFrame: A DataFrame with PSPS probabilities and GIS metadata.
+    """
     # Reset the index to include weather station code as a column
     combined_count = combined_count.reset_index()
 
@@ -39,32 +75,22 @@ def calculate_psps_probability(merged_data, gis_weather_station, condition):
 
     return weather_station_psps
 
+@instrument
 def calculate_combined_count(merged_station_wind_speed):
     """
     Calculate the combined count with PSPS probability for each weather station.
     
     Args:
-        merged_station_wind_speed (DataFrame): The merged station wind speed DataFrame.
+        merged_station_wind_speed (DataFrame or str): The merged station wind speed DataFrame, or
+            the path of a streamed merge.
 
     Returns:
         DataFrame: Combined count with PSPS probabilities.
     """
-    # Calculate total wind speed counts
-    wind_speed_count = merged_station_wind_speed.groupby('weatherstationcode')[['wind_speed']].count().rename(
-        columns={'wind_speed': 'wind_speed_count'}
-    )
-
-    # Filter for wind speeds above the threshold
-    windspeed_above_threshold = merged_station_wind_speed[
-        merged_station_wind_speed['wind_speed'] > merged_station_wind_speed['alert']
-    ]
-    windspeed_count_above_threshold = windspeed_above_threshold.groupby('weatherstationcode')[['wind_speed']].count().rename(
-        columns={'wind_speed': 'above_threshold_count'}
-    )
+    # Count wind speeds and wind speeds above the threshold
+    combined_count = station_exceedance_counts(merged_station_wind_speed, 'alert')[['above_threshold_count', 'wind_speed_count']]
 
-    # Merge and calculate PSPS probability
-    combined_count = windspeed_count_above_threshold.merge(wind_speed_count, on="weatherstationcode", how='right')
-    combined_count['above_threshold_count'] = combined_count['above_threshold_count'].fillna(0)
+    # Calculate PSPS probability
     combined_count['PSPS_probability'] = combined_count['above_threshold_count'] / combined_count['wind_speed_count']
     
     return combined_count
\ No newline at end of file
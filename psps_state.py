@@ -0,0 +1,442 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+from data_cache import temporary_path, write_meta
+from etl import load_data, save_data, running_max, get_gis_data, get_station_summary_data
+from exceedance import ExceedanceMatrix
+from psps import merge_station_psps
+
+
+class StationAggregateState:
+    """
+    Per-station wind speed counts that can be updated with new readings and saved between runs.
+
+    The state keeps, for each weather station, the number of readings and the number above
+    each threshold column. New readings are folded in with `update` in time proportional to
+    the batch. merge_weather_data drops readings equal to the highest wind speed seen, so the
+    state also holds back those readings until a higher one arrives. The counts therefore
+    always match a full recompute. The ids of the batches already counted are kept, so a
+    batch that is passed in again is not counted twice.
+
+    Args:
+        station_info (DataFrame): Weather station codes with their threshold columns, one row per GIS/summary match.
+        conditions (list): Threshold columns counted for each station.
+        counts (DataFrame): Counts indexed by weather station code.
+        max_wind_speed (float): Highest wind speed seen so far, or None.
+        held (DataFrame): Readings at the highest wind speed, which are left out of the counts.
+        applied_batches (list): Ids of the update batches already counted.
+    """
+
+    def __init__(self, station_info, conditions, counts=None, max_wind_speed=None, held=None, applied_batches=None):
+        self.station_info = station_info
+        self.conditions = list(conditions)
+        count_columns = ['wind_speed_count'] + [f"above_threshold_count_{condition}" for condition in self.conditions]
+        if counts is None:
+            counts = pd.DataFrame(columns=count_columns, dtype='int64')
+            counts.index.name = 'weatherstationcode'
+        self.counts = counts
+        self.max_wind_speed = max_wind_speed
+        if held is None:
+            held = station_info.iloc[:0].assign(date=pd.Series(dtype='datetime64[ns]'), wind_speed=pd.Series(dtype='float64'))
+        self.held = held
+        self.applied_batches = list(applied_batches or [])
+
+    @classmethod
+    def for_stations(cls, gis_path, station_summary_path, conditions=None):
+        """
+        Build a state without readings for the stations of the GIS and station summary datasets.
+
+        Args:
+            gis_path (str): Path to the GIS dataset.
+            station_summary_path (str): Path to the station summary dataset.
+            conditions (list): Threshold columns to count. Defaults to every numeric station summary column.
+
+        Returns:
+            StationAggregateState: State with empty counts.
+        """
+        gis_data = get_gis_data(gis_path)
+        station_summary = get_station_summary_data(station_summary_path)
+        if conditions is None:
+            conditions = [column for column in station_summary.select_dtypes('number').columns if column != 'station']
+        station_info = gis_data.merge(station_summary, left_on='weatherstationcode', right_on='station')[['weatherstationcode'] + list(conditions)]
+        return cls(station_info, conditions)
+
+    @classmethod
+    def from_sources(cls, gis_path, station_summary_path, windspeed_path, conditions=None):
+        """
+        Build the state from the full history in the raw datasets.
+
+        Args:
+            gis_path (str): Path to the GIS dataset.
+            station_summary_path (str): Path to the station summary dataset.
+            windspeed_path (str): Path to the windspeed snapshot dataset.
+            conditions (list): Threshold columns to count. Defaults to every numeric station summary column.
+
+        Returns:
+            StationAggregateState: State holding the counts of the whole history.
+        """
+        state = cls.for_stations(gis_path, station_summary_path, conditions)
+        state.update(load_data(windspeed_path, columns=['station', 'date', 'wind_speed'], schema='windspeed_snapshot'))
+        return state
+
+    def update(self, batch, batch_id=None):
+        """
+        Fold a batch of new windspeed readings into the counts.
+
+        Args:
+            batch (DataFrame): New readings with 'station', 'date' and 'wind_speed' columns.
+            batch_id (str): Id of the batch, e.g. the hash of its file. A batch whose id was
+                already applied is skipped.
+
+        Returns:
+            DataFrame: Readings that entered the counts, in the format of merge_weather_data output
+                (with 'exceed_threshold' against 'alert' when that column is counted).
+        """
+        if batch_id is not None and batch_id in self.applied_batches:
+            batch = batch.iloc[:0]
+        elif batch_id is not None:
+            self.applied_batches.append(batch_id)
+        joined = self.station_info.merge(
+            batch[['station', 'date', 'wind_speed']], left_on='weatherstationcode', right_on='station'
+        ).drop(columns=['station'])
+        previous_max = self.max_wind_speed
+        self.max_wind_speed = running_max(previous_max, batch['wind_speed'])
+
+        at_max = joined[joined['wind_speed'] == self.max_wind_speed]
+        if previous_max is None or self.max_wind_speed > previous_max:
+            # A new maximum: the readings held back at the old maximum now count
+            released = self.held
+            self.held = at_max
+        else:
+            released = self.held.iloc[:0]
+            self.held = pd.concat([self.held, at_max], ignore_index=True)
+        added = pd.concat([released, joined[joined['wind_speed'] < self.max_wind_speed]], ignore_index=True)
+
+        delta = pd.DataFrame({'wind_speed_count': added.groupby('weatherstationcode', observed=True)['wind_speed'].count()})
+        for condition in self.conditions:
+            above = added['wind_speed'] > added[condition]
+            delta[f"above_threshold_count_{condition}"] = above.groupby(added['weatherstationcode'], observed=True).sum()
+        self.counts = self.counts.add(delta, fill_value=0).astype('int64')
+        self.counts.index.name = 'weatherstationcode'
+
+        if 'alert' in added.columns:
+            added['exceed_threshold'] = (added['wind_speed'] > added['alert']).astype('int8')
+        return added
+
+    def station_counts(self, condition):
+        """
+        Counts and PSPS probability per station for one threshold column.
+
+        Args:
+            condition (str): Threshold column.
+
+        Returns:
+            DataFrame: 'wind_speed_count', 'above_threshold_count' and 'PSPS_probability', indexed by station code.
+        """
+        counts = self.counts[self.counts['wind_speed_count'] > 0].sort_index()
+        combined_count = pd.DataFrame({
+            'wind_speed_count': counts['wind_speed_count'],
+            'above_threshold_count': counts[f"above_threshold_count_{condition}"],
+        })
+        combined_count['PSPS_probability'] = combined_count['above_threshold_count'] / combined_count['wind_speed_count']
+        return combined_count
+
+    def psps_probability(self, gis_weather_station, condition):
+        """
+        Station PSPS probabilities with GIS metadata, as calculate_psps_probability returns them.
+
+        Args:
+            gis_weather_station (DataFrame): GIS metadata for weather stations.
+            condition (str): Threshold column.
+
+        Returns:
+            DataFrame: A DataFrame with PSPS probabilities and GIS metadata.
+        """
+        return merge_station_psps(self.station_counts(condition), gis_weather_station)
+
+    def combined_count(self, condition='alert'):
+        """
+        Station counts in the layout of calculate_combined_count.
+
+        Args:
+            condition (str): Threshold column.
+
+        Returns:
+            DataFrame: Combined count with PSPS probabilities.
+        """
+        return self.station_counts(condition)[['above_threshold_count', 'wind_speed_count', 'PSPS_probability']]
+
+    def save(self, state_dir):
+        """
+        Save the state to a directory.
+
+        Args:
+            state_dir (str): Directory to write to.
+
+        Returns:
+            str: The directory.
+        """
+        save_data(self.station_info, state_dir, 'station_info.csv')
+        save_data(self.counts.reset_index(), state_dir, 'counts.csv')
+        save_data(self.held, state_dir, 'held.csv')
+        with open(os.path.join(state_dir, 'state.json'), 'w') as fh:
+            max_wind_speed = None if self.max_wind_speed is None else float(self.max_wind_speed)
+            json.dump({'conditions': self.conditions, 'max_wind_speed': max_wind_speed,
+                       'applied_batches': self.applied_batches}, fh, indent=2)
+        return state_dir
+
+    @classmethod
+    def load(cls, state_dir):
+        """
+        Load a state saved with `save`.
+
+        Args:
+            state_dir (str): Directory holding the state.
+
+        Returns:
+            StationAggregateState: The loaded state.
+        """
+        with open(os.path.join(state_dir, 'state.json'), 'r') as fh:
+            meta = json.load(fh)
+        counts = load_data(os.path.join(state_dir, 'counts.csv'), use_cache=False).set_index('weatherstationcode')
+        return cls(
+            load_data(os.path.join(state_dir, 'station_info.csv'), use_cache=False, schema='merged_weather'),
+            meta['conditions'],
+            counts=counts,
+            max_wind_speed=meta['max_wind_speed'],
+            held=load_data(os.path.join(state_dir, 'held.csv'), use_cache=False, schema='merged_weather'),
+            applied_batches=meta.get('applied_batches', []),
+        )
+
+
+def spans_by_station(stations_to_span):
+    """
+    Invert a span-to-stations mapping.
+
+    Args:
+        stations_to_span (dict): Mapping of spans to their associated station records.
+
+    Returns:
+        dict: Mapping of station codes to the spans downstream of them.
+    """
+    station_spans = dict()
+    for globalid, stations in stations_to_span.items():
+        for station in stations:
+            station_spans.setdefault(station[0], []).append(globalid)
+    return station_spans
+
+
+def update_span_probabilities(span_probabilities, stations_to_span, station_spans, engine, added):
+    """
+    Recompute only the span probabilities affected by newly counted readings.
+
+    Args:
+        span_probabilities (dict): Mapping of spans to PSPS probabilities, updated in place.
+        stations_to_span (dict): Mapping of spans to their associated station records.
+        station_spans (dict): Output of spans_by_station for `stations_to_span`.
+        engine (ExceedanceMatrix): Exceedance matrix of the readings counted so far.
+        added (DataFrame): Readings returned by StationAggregateState.update.
+
+    Returns:
+        set: Spans whose probability was recomputed.
+    """
+    updated = set()
+    for station in engine.add_rows(added):
+        for globalid in station_spans.get(station, []):
+            if globalid not in updated:
+                span_probabilities[globalid] = engine.probability(stations_to_span[globalid])
+                updated.add(globalid)
+    return updated
+
+
+def network_key(stations_to_span):
+    """
+    Hash the upstream station codes of every span, to tell when the span network changed.
+
+    Args:
+        stations_to_span (dict): Mapping of spans to their associated station records.
+
+    Returns:
+        str: Hex digest of the spans and their station codes.
+    """
+    spans = sorted((str(globalid), sorted(str(station[0]) for station in stations))
+                   for globalid, stations in stations_to_span.items())
+    return hashlib.sha256(json.dumps(spans).encode()).hexdigest()
+
+
+class SpanAggregateState:
+    """
+    Span PSPS probabilities that can be updated with new readings and saved between runs.
+
+    The state holds its own StationAggregateState, the exceedance matrix of the readings it
+    has counted and the probability of every span. A batch is folded into the station counts,
+    its counted readings are added to the matrix, and only the spans downstream of the
+    stations they touch are recomputed (update_span_probabilities). When the span network
+    differs from the one the probabilities were computed for, every span is recomputed.
+
+    The saved state is a full snapshot followed by one part per later save. A part holds the
+    readings counted since the previous save, the probabilities of the spans they changed and
+    the station counts, so saving an update costs the size of the update, not of the network
+    or the history. A new snapshot replaces the parts when the span network changed.
+
+    Args:
+        stations (StationAggregateState): Station counts, which also track the applied batches.
+        engine (ExceedanceMatrix): Exceedance matrix of the counted readings.
+        span_probabilities (dict): Mapping of spans to PSPS probabilities.
+        network (str): network_key of the spans the probabilities were computed for.
+        parts (list): Names of the saved part directories, the snapshot first.
+    """
+
+    def __init__(self, stations, engine, span_probabilities=None, network=None, parts=None):
+        self.stations = stations
+        self.engine = engine
+        self.span_probabilities = dict(span_probabilities or {})
+        self.network = network
+        self.parts = list(parts or [])
+        # Changes since the last save
+        self.added = []
+        self.changed_spans = set()
+        self.needs_snapshot = False
+
+    @classmethod
+    def from_sources(cls, gis_path, station_summary_path, windspeed_path):
+        """
+        Build the state from the full history in the raw datasets.
+
+        Args:
+            gis_path (str): Path to the GIS dataset.
+            station_summary_path (str): Path to the station summary dataset.
+            windspeed_path (str): Path to the windspeed snapshot dataset.
+
+        Returns:
+            SpanAggregateState: State holding the whole history, without span probabilities yet.
+        """
+        stations = StationAggregateState.for_stations(gis_path, station_summary_path)
+        added = stations.update(load_data(windspeed_path, columns=['station', 'date', 'wind_speed'], schema='windspeed_snapshot'))
+        # The counted readings are the merged data, so the matrix is the one analyze_spans builds
+        return cls(stations, ExceedanceMatrix.from_merged_data(added))
+
+    def update(self, batch, stations_to_span, batch_id=None, network=None, station_spans=None):
+        """
+        Fold a batch of new windspeed readings into the span probabilities.
+
+        Args:
+            batch (DataFrame): New readings with 'station', 'date' and 'wind_speed' columns.
+            stations_to_span (dict): Mapping of spans to their unique upstream station records.
+            batch_id (str): Id of the batch. A batch whose id was already applied is skipped.
+            network (str): network_key of `stations_to_span`, computed when not given.
+            station_spans (dict): spans_by_station of `stations_to_span`, computed when not given.
+
+        Returns:
+            set: Spans whose probability was recomputed.
+        """
+        if network is None:
+            network = network_key(stations_to_span)
+        if station_spans is None:
+            station_spans = spans_by_station(stations_to_span)
+        if network != self.network:
+            self.span_probabilities = self.engine.span_probabilities(stations_to_span)
+            self.network = network
+            self.needs_snapshot = True
+            updated = set(stations_to_span)
+        else:
+            updated = set()
+        if batch_id is None or batch_id not in self.stations.applied_batches:
+            added = self.stations.update(batch, batch_id)
+            self.added.append(added)
+            updated |= update_span_probabilities(self.span_probabilities, stations_to_span, station_spans, self.engine, added)
+        self.changed_spans |= updated
+        return updated
+
+    def save(self, state_dir):
+        """
+        Save the changes since the last save to a directory.
+
+        The first save, and the first after the span network changed, writes a snapshot;
+        the others add a part. Each part is written under a temporary name and renamed, and
+        state.json, which lists the parts, is replaced last, so a save that stops midway
+        leaves the previous state, with its applied batches, as it was.
+
+        Args:
+            state_dir (str): Directory to write to.
+
+        Returns:
+            str: The directory.
+        """
+        if self.parts and not self.needs_snapshot:
+            if not self.added and not self.changed_spans:
+                return state_dir
+            parts = self.parts + [self.write_part(state_dir, snapshot=False)]
+        else:
+            parts = [self.write_part(state_dir, snapshot=True)]
+        write_meta(os.path.join(state_dir, 'state.json'), {'network': self.network, 'parts': parts})
+        # Parts replaced by a snapshot, or left behind by a save that stopped midway
+        for name in os.listdir(state_dir):
+            if name.startswith('part-') and name not in parts:
+                shutil.rmtree(os.path.join(state_dir, name))
+        self.parts = parts
+        self.added = []
+        self.changed_spans = set()
+        self.needs_snapshot = False
+        return state_dir
+
+    def write_part(self, state_dir, snapshot):
+        """
+        Write the next part directory of a saved state.
+
+        Args:
+            state_dir (str): Directory of the saved state.
+            snapshot (bool): Write the whole state rather than the changes since the last save.
+
+        Returns:
+            str: Name of the part directory.
+        """
+        number = int(self.parts[-1].rsplit('-', 1)[1]) + 1 if self.parts else 0
+        name = f"part-{number}"
+        path = os.path.join(state_dir, name)
+        temporary = temporary_path(path)
+        shutil.rmtree(temporary, ignore_errors=True)
+        self.stations.save(os.path.join(temporary, 'stations'))
+        if snapshot:
+            self.engine.save(os.path.join(temporary, 'exceedance'))
+            spans = list(self.span_probabilities)
+        else:
+            save_data(pd.concat(self.added, ignore_index=True), temporary, 'added.csv')
+            spans = sorted(self.changed_spans)
+        save_data(pd.DataFrame({'span': spans, 'probability': [self.span_probabilities[span] for span in spans]}),
+                  temporary, 'span_probabilities.csv')
+        # A part of the same name can only be left over from a save that stopped midway
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary, path)
+        return name
+
+    @classmethod
+    def load(cls, state_dir):
+        """
+        Load a state saved with `save`, replaying its parts on the snapshot.
+
+        Args:
+            state_dir (str): Directory holding the state.
+
+        Returns:
+            SpanAggregateState: The loaded state.
+        """
+        with open(os.path.join(state_dir, 'state.json'), 'r') as fh:
+            meta = json.load(fh)
+        paths = [os.path.join(state_dir, name) for name in meta['parts']]
+        engine = ExceedanceMatrix.open(os.path.join(paths[0], 'exceedance'), mmap_mode=None)
+        span_probabilities = dict()
+        for number, path in enumerate(paths):
+            if number:
+                engine.add_rows(load_data(os.path.join(path, 'added.csv'), use_cache=False, schema='merged_weather'))
+            probabilities = load_data(os.path.join(path, 'span_probabilities.csv'), use_cache=False)
+            span_probabilities.update(zip(probabilities['span'].astype(str), probabilities['probability']))
+        return cls(
+            StationAggregateState.load(os.path.join(paths[-1], 'stations')),
+            engine,
+            span_probabilities,
+            meta['network'],
+            meta['parts'],
+        )
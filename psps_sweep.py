@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+from etl import merged_weather_chunks
+from exceedance import ExceedanceMatrix
+from profiling import instrument
+
+# Exceedance flags evaluated per chunk of readings, across all multipliers of a condition
+SWEEP_CHUNK_CELLS = 1 << 24
+
+
+def scenario_grid(conditions, multipliers):
+    """
+    List the (condition, multiplier) scenarios of a sweep.
+
+    Args:
+        conditions (list): Threshold columns of the station summary, e.g. 'alert'.
+        multipliers (list): Factors applied to each threshold.
+
+    Returns:
+        pd.DataFrame: 'scenario', 'condition' and 'multiplier' of each scenario.
+    """
+    grid = pd.DataFrame([(condition, float(multiplier)) for condition in conditions for multiplier in multipliers],
+                        columns=['condition', 'multiplier'])
+    grid.insert(0, 'scenario', grid['condition'] + 'x' + grid['multiplier'].map('{:g}'.format))
+    return grid
+
+
+def chunk_sweep_counts(merged_data, conditions, factors):
+    """
+    Reading counts and exceedance counts of each station in one frame of merged data.
+
+    Args:
+        merged_data (pd.DataFrame): Merged weather data.
+        conditions (list): Threshold columns to sweep.
+        factors (np.ndarray): Factors applied to each threshold.
+
+    Returns:
+        tuple: Station codes (pd.Index in order of appearance), reading counts, and exceedance
+            counts of shape (condition, station, factor).
+    """
+    codes, stations = pd.factorize(merged_data['weatherstationcode'])
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    wind = merged_data['wind_speed'].to_numpy(dtype=np.float64)[order]
+    known = sorted_codes >= 0
+    wind_speed_count = np.bincount(sorted_codes[known], weights=~np.isnan(wind[known]), minlength=len(stations))
+
+    above = np.zeros((len(conditions), len(stations), len(factors)), dtype=np.int64)
+    chunk_rows = max(1, SWEEP_CHUNK_CELLS // max(1, len(factors)))
+    for position, condition in enumerate(conditions):
+        thresholds = merged_data[condition].to_numpy(dtype=np.float64)[order]
+        for start in range(0, len(order), chunk_rows):
+            stop = min(start + chunk_rows, len(order))
+            # Float32 columns are compared exactly in float64, so a multiplier of 1 matches the pipeline
+            exceed = (wind[start:stop, None] > thresholds[start:stop, None] * factors).astype(np.int32)
+            chunk_codes = sorted_codes[start:stop]
+            starts = np.flatnonzero(np.r_[True, chunk_codes[1:] != chunk_codes[:-1]])
+            sums = np.add.reduceat(exceed, starts, axis=0)
+            valid = chunk_codes[starts] >= 0
+            above[position, chunk_codes[starts][valid]] += sums[valid]
+    return pd.Index(np.asarray(stations, dtype=object), dtype=object), wind_speed_count, above
+
+
+@instrument
+def sweep_station_probabilities(merged_data, conditions, multipliers=(1.0,)):
+    """
+    PSPS probability of every weather station under every scenario in one pass per condition.
+
+    The readings are sorted by station once. Each chunk of readings is compared with all the
+    scaled thresholds of a condition at once, and the exceedances are summed per station with
+    a single reduceat. With a multiplier of 1 the counts are those of calculate_psps_probability.
+    A streamed merge is counted chunk by chunk.
+
+    Args:
+        merged_data (pd.DataFrame or str): Merged weather data with 'weatherstationcode', 'wind_speed'
+            and the condition columns, or the path of a streamed merge.
+        conditions (list): Threshold columns to sweep.
+        multipliers (list): Factors applied to each threshold.
+
+    Returns:
+        pd.DataFrame: One row per scenario and station with 'scenario', 'condition', 'multiplier',
+            'weatherstationcode', 'wind_speed_count', 'above_threshold_count' and 'PSPS_probability'.
+    """
+    factors = np.asarray(multipliers, dtype=np.float64)
+    stations = pd.Index([], dtype=object)
+    wind_speed_count = np.zeros(0)
+    above = np.zeros((len(conditions), 0, len(factors)), dtype=np.int64)
+    # Chunks of a streamed merge are folded in, stations in order of first appearance
+    for chunk in merged_weather_chunks(merged_data, ['weatherstationcode', 'wind_speed'] + list(dict.fromkeys(conditions))):
+        chunk_stations, chunk_wind_speed_count, chunk_above = chunk_sweep_counts(chunk, conditions, factors)
+        positions = stations.get_indexer(chunk_stations)
+        new = positions < 0
+        positions[new] = len(stations) + np.arange(new.sum())
+        stations = stations.append(chunk_stations[new])
+        wind_speed_count = np.concatenate([wind_speed_count, np.zeros(new.sum())])
+        above = np.concatenate([above, np.zeros((len(conditions), new.sum(), len(factors)), dtype=np.int64)], axis=1)
+        wind_speed_count[positions] += chunk_wind_speed_count
+        above[:, positions] += chunk_above
+
+    grid = scenario_grid(conditions, multipliers)
+    n_stations = len(stations)
+    table = grid.loc[grid.index.repeat(n_stations)].reset_index(drop=True)
+    table['weatherstationcode'] = np.tile(np.asarray(stations, dtype=object), len(grid))
+    table['wind_speed_count'] = np.tile(wind_speed_count, len(grid))
+    # (condition, station, multiplier) -> scenario-major rows, as in the grid
+    table['above_threshold_count'] = above.transpose(0, 2, 1).reshape(-1).astype(np.float64)
+    table['PSPS_probability'] = table['above_threshold_count'] / table['wind_speed_count']
+    return table
+
+
+@instrument
+def sweep_top_stations(station_table, thresholds):
+    """
+    Stations above each minimum probability in each scenario, as filter_top_psps_stations selects them.
+
+    Args:
+        station_table (pd.DataFrame): Output of sweep_station_probabilities.
+        thresholds (list): Minimum PSPS probabilities.
+
+    Returns:
+        pd.DataFrame: One row per scenario, threshold and selected station, with 'min_alert_threshold'.
+    """
+    probabilities = station_table['PSPS_probability'].to_numpy()
+    levels = np.asarray(thresholds, dtype=np.float64)
+    rows, selected = np.nonzero(probabilities[None, :] > levels[:, None])
+    # Scenarios in grid order, then thresholds in the given order, then stations
+    scenario_codes = pd.factorize(station_table['scenario'])[0]
+    order = np.lexsort((selected, rows, scenario_codes[selected]))
+    top = station_table.iloc[selected[order]].reset_index(drop=True)
+    top.insert(3, 'min_alert_threshold', levels[rows[order]])
+    return top
+
+
+@instrument
+def sweep_span_probabilities(merged_data, stations_to_span, conditions, multipliers=(1.0,)):
+    """
+    PSPS probability of every span under every scenario.
+
+    Each scenario builds a station x date exceedance matrix from its own flags, all in one
+    pass over the merged data, and each distinct upstream station set is evaluated once per
+    scenario.
+
+    Args:
+        merged_data (pd.DataFrame or str): Merged weather data, or the path of a streamed merge.
+        stations_to_span (dict): Span to its unique upstream station records.
+        conditions (list): Threshold columns to sweep.
+        multipliers (list): Factors applied to each threshold.
+
+    Returns:
+        pd.DataFrame: One row per scenario and span with 'scenario', 'condition', 'multiplier',
+            'span' and 'probability'.
+    """
+    grid = scenario_grid(conditions, multipliers)
+    matrices = [None] * len(grid)
+    # One pass over the merged data feeds the exceedance matrices of all scenarios
+    for chunk in merged_weather_chunks(merged_data, ['weatherstationcode', 'date', 'wind_speed'] + list(dict.fromkeys(conditions))):
+        readings = chunk[['weatherstationcode', 'date']].copy()
+        wind = chunk['wind_speed'].to_numpy(dtype=np.float64)
+        for position, scenario in enumerate(grid.itertuples(index=False)):
+            readings['exceed_threshold'] = (wind > chunk[scenario.condition].to_numpy(dtype=np.float64) * scenario.multiplier).astype(np.int8)
+            if matrices[position] is None:
+                matrices[position] = ExceedanceMatrix.from_merged_data(readings)
+            else:
+                matrices[position].add_rows(readings)
+    tables = []
+    for matrix, scenario in zip(matrices, grid.itertuples(index=False)):
+        probabilities = matrix.span_probabilities(stations_to_span)
+        tables.append(pd.DataFrame({'scenario': scenario.scenario, 'condition': scenario.condition,
+                                    'multiplier': scenario.multiplier, 'span': list(probabilities),
+                                    'probability': list(probabilities.values())}))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(
+        columns=['scenario', 'condition', 'multiplier', 'span', 'probability'])
@@ -0,0 +1,337 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+import numpy as np
+import pandas as pd
+from pipeline import load_checkpoint, run_pipeline, stage_plan
+from reachability import ReachabilityIndex
+from span_analysis import annual_customer_counts, getDownstream, getUpstream
+from stages import STAGES
+
+# Columns of the span records returned by the service
+SPAN_COLUMNS = ['globalid', 'upstream_span_id', 'station', 'parent_feederid', 'upstreamardfacilityid',
+                'cust_total', 'probability', 'expected_fire', 'annual_cust_total']
+STATION_FIELDS = ['station', 'PSPS_probability', 'above_threshold_count', 'wind_speed_count']
+
+
+class PSPSQueryService:
+    """
+    In-process lookups of span, circuit and feeder PSPS risk.
+
+    Everything is loaded and indexed once: span records by globalid, circuit and feeder
+    summaries (the span_count, PSPS value and customer columns of the analyze_spans
+    printouts, plus annual customers affected) and the spans of each circuit and feeder.
+    Queries are then dictionary lookups and slices of a reachability index of the span
+    network. Networks that are not a forest have no index: their upstream and downstream
+    spans are traversed with getUpstream and getDownstream, and upstream tests and
+    de-energized sets are refused.
+
+    Ids are matched by their string form, so lookups work the same from Python and HTTP.
+
+    Args:
+        spans (DataFrame): 'spans' result of analyze_spans.
+        network (nx.DiGraph or SpanNetwork): 'span_network' result of analyze_spans.
+        upstream_stations (dict): 'unique_upstream_stations' result of analyze_spans.
+    """
+
+    def __init__(self, spans, network, upstream_stations):
+        spans = spans.reset_index(drop=True)
+        spans['annual_cust_total'] = annual_customer_counts(spans)
+        self.spans = spans
+        self.network = network
+        self.upstream_stations = upstream_stations
+
+        self.columns = [column for column in SPAN_COLUMNS if column in spans.columns]
+        self.values = {column: spans[column].to_numpy(dtype=object) for column in self.columns}
+        span_ids = spans['globalid'].astype(str).to_numpy()
+        # A span listed in several rows is answered with its first row
+        self.span_rows = dict(zip(span_ids[::-1].tolist(), range(len(spans) - 1, -1, -1)))
+
+        self.circuits = self.summary('upstreamardfacilityid', 'circuit_psps_value')
+        self.feeders = self.summary('parent_feederid', 'segment_psps_value')
+        self.circuit_spans = self.group_spans('upstreamardfacilityid')
+        self.feeder_spans = self.group_spans('parent_feederid')
+        try:
+            self.reachability = ReachabilityIndex.from_network(network)
+        except ValueError:
+            self.reachability = None
+
+    @classmethod
+    def from_pipeline(cls, config):
+        """
+        Load the service from the analyze_spans checkpoint, running the stage if it has none.
+
+        Args:
+            config (dict): Contents of data-params.json.
+
+        Returns:
+            PSPSQueryService: The loaded service.
+        """
+        checkpoint_dir = config['parameters'].get('checkpoint_dir', './data/checkpoints')
+        _, paths = stage_plan(STAGES, ['analyze_spans'], config, checkpoint_dir)
+        if os.path.exists(paths['analyze_spans']):
+            result = load_checkpoint(paths['analyze_spans'])
+        else:
+            result = run_pipeline(STAGES, ['analyze_spans'], config, checkpoint_dir)['analyze_spans']
+        return cls(result['spans'], result['span_network'], result['unique_upstream_stations'])
+
+    def summary(self, column, value_name):
+        """Per-group span count, mean PSPS probability and customer totals, indexed by id string."""
+        summary = self.spans.groupby(column, observed=True).agg(
+            span_count=('globalid', 'count'),
+            **{value_name: ('probability', 'mean')},
+            sum_of_customers=('cust_total', 'sum'),
+            annual_customers_affected=('annual_cust_total', 'sum')
+        )
+        summary.index = summary.index.astype(str)
+        return summary
+
+    def group_spans(self, column):
+        """Span ids of each group, keyed by id string."""
+        codes, groups = pd.factorize(self.spans[column].astype(str))
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+        span_ids = self.values['globalid'][order]
+        return {group: span_ids[bounds[code]:bounds[code + 1]].tolist() for code, group in enumerate(groups)}
+
+    def row(self, globalid):
+        """Row of a span, raising KeyError for unknown spans."""
+        try:
+            return self.span_rows[str(globalid)]
+        except KeyError:
+            raise KeyError(f"Unknown span: {globalid}") from None
+
+    def span_id(self, globalid):
+        """The span id as stored in the network."""
+        return self.values['globalid'][self.row(globalid)]
+
+    def span(self, globalid):
+        """
+        PSPS risk of one span.
+
+        Args:
+            globalid: Span id.
+
+        Returns:
+            dict: The span's record and its unique upstream weather stations.
+        """
+        row = self.row(globalid)
+        record = {column: python_value(self.values[column][row]) for column in self.columns}
+        record['upstream_stations'] = self.stations(self.values['globalid'][row])
+        return record
+
+    def stations(self, span_id):
+        """Unique upstream weather station records of a span, sorted by station."""
+        records = sorted(self.upstream_stations.get(span_id, ()), key=lambda record: str(record[0]))
+        return [{field: python_value(value) for field, value in zip(STATION_FIELDS, record)} for record in records]
+
+    def upstream(self, globalid):
+        """Spans upstream of a span, nearest first, as getUpstream lists them."""
+        span_id = self.span_id(globalid)
+        if self.reachability is None:
+            return [python_value(upstream_id) for upstream_id in getUpstream(self.network, span_id, 'dfs')]
+        return [python_value(upstream_id) for upstream_id in self.reachability.upstream(span_id)]
+
+    def downstream(self, globalid):
+        """Spans downstream of a span, in the depth-first order of getDownstream."""
+        span_id = self.span_id(globalid)
+        if self.reachability is None:
+            return [python_value(downstream_id) for downstream_id in getDownstream(self.network, span_id, 'dfs')]
+        return [python_value(downstream_id) for downstream_id in self.reachability.downstream(span_id)]
+
+    def reachability_index(self):
+        """The reachability index, raising ValueError if the network is not a span forest."""
+        if self.reachability is None:
+            raise ValueError('The span network is not a forest, so it has no reachability index.')
+        return self.reachability
+
+    def is_upstream(self, upstream_id, globalid):
+        """Whether span `upstream_id` feeds span `globalid`."""
+        return self.reachability_index().is_upstream(self.span_id(upstream_id), self.span_id(globalid))
+
+    def deenergized(self, globalids):
+        """
+        Spans that lose power when the given spans are de-energized.
+
+        Args:
+            globalids (list): De-energized span ids; unknown ids are left out.
+
+        Returns:
+            list: Those spans and all spans downstream of them.
+        """
+        span_ids = [self.values['globalid'][self.span_rows[str(globalid)]] for globalid in globalids
+                    if str(globalid) in self.span_rows]
+        return [python_value(span_id) for span_id in self.reachability_index().deenergized(span_ids)]
+
+    def circuit(self, circuit_id, include_spans=False):
+        """
+        PSPS risk of one circuit (upstreamardfacilityid).
+
+        Args:
+            circuit_id: Circuit id.
+            include_spans (bool): Also list the circuit's span ids.
+
+        Returns:
+            dict: The circuit summary.
+        """
+        return self.group_record(self.circuits, self.circuit_spans, 'upstreamardfacilityid', circuit_id, include_spans)
+
+    def feeder(self, feeder_id, include_spans=False):
+        """
+        PSPS risk of one parent feeder (parent_feederid).
+
+        Args:
+            feeder_id: Parent feeder id.
+            include_spans (bool): Also list the feeder's span ids.
+
+        Returns:
+            dict: The feeder summary.
+        """
+        return self.group_record(self.feeders, self.feeder_spans, 'parent_feederid', feeder_id, include_spans)
+
+    def group_record(self, summary, group_spans, column, group_id, include_spans):
+        """Summary record of a circuit or feeder, raising KeyError for unknown ids."""
+        key = str(group_id)
+        if key not in summary.index:
+            raise KeyError(f"Unknown {column}: {group_id}")
+        record = {column: key}
+        record.update(frame_records(summary.loc[[key]])[0])
+        if include_spans:
+            record['spans'] = [python_value(span_id) for span_id in group_spans[key]]
+        return record
+
+    def spans_batch(self, globalids):
+        """
+        PSPS risk of several spans at once.
+
+        Args:
+            globalids (list): Span ids; unknown ids are left out.
+
+        Returns:
+            DataFrame: One row per known span, in request order.
+        """
+        rows = [self.span_rows[str(globalid)] for globalid in globalids if str(globalid) in self.span_rows]
+        return self.spans.iloc[rows][self.columns].reset_index(drop=True)
+
+    def circuits_batch(self, circuit_ids):
+        """Summaries of several circuits, unknown ids left out."""
+        return self.circuits.loc[[str(circuit_id) for circuit_id in circuit_ids if str(circuit_id) in self.circuits.index]]
+
+    def feeders_batch(self, feeder_ids):
+        """Summaries of several parent feeders, unknown ids left out."""
+        return self.feeders.loc[[str(feeder_id) for feeder_id in feeder_ids if str(feeder_id) in self.feeders.index]]
+
+
+def python_value(value):
+    """Convert NumPy scalars and missing values to plain JSON-friendly Python values."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+
+def frame_records(frame):
+    """Rows of a DataFrame as a list of dicts with plain Python values, the index included."""
+    frame = frame.reset_index()
+    return [{column: python_value(value) for column, value in zip(frame.columns, row)}
+            for row in frame.itertuples(index=False, name=None)]
+
+
+def make_handler(service):
+    """
+    Build an HTTP request handler answering from a PSPSQueryService.
+
+    Routes (JSON responses, 404 for unknown ids):
+        GET /span/<id>, /span/<id>/upstream, /span/<id>/downstream
+        GET /span/<id>/feeds/<other id> (whether the span is upstream of the other one)
+        GET /deenergized?ids=a,b (spans without power when those spans are de-energized)
+        GET /circuit/<id>, /feeder/<id> (add ?spans=1 to list their spans)
+        GET /spans?ids=a,b, /circuits?ids=a,b, /feeders?ids=a,b
+
+    Args:
+        service (PSPSQueryService): The loaded service.
+
+    Returns:
+        type: A BaseHTTPRequestHandler subclass.
+    """
+    single = {'span': service.span, 'circuit': service.circuit, 'feeder': service.feeder}
+    batch = {'spans': service.spans_batch, 'circuits': service.circuits_batch, 'feeders': service.feeders_batch}
+    traversals = {'upstream': service.upstream, 'downstream': service.downstream}
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+            query = parse_qs(url.query)
+            try:
+                if len(parts) == 1 and parts[0] in batch:
+                    ids = [span_id for value in query.get('ids', []) for span_id in value.split(',') if span_id]
+                    body = frame_records(batch[parts[0]](ids))
+                elif len(parts) == 2 and parts[0] in ('circuit', 'feeder'):
+                    body = single[parts[0]](parts[1], include_spans=query.get('spans', ['0'])[0] not in ('0', ''))
+                elif len(parts) == 2 and parts[0] == 'span':
+                    body = service.span(parts[1])
+                elif len(parts) == 3 and parts[0] == 'span' and parts[2] in traversals:
+                    body = traversals[parts[2]](parts[1])
+                elif len(parts) == 4 and parts[0] == 'span' and parts[2] == 'feeds':
+                    body = service.is_upstream(parts[1], parts[3])
+                elif len(parts) == 1 and parts[0] == 'deenergized':
+                    body = service.deenergized([span_id for value in query.get('ids', []) for span_id in value.split(',') if span_id])
+                else:
+                    self.reply(404, {'error': f"Unknown route: {url.path}"})
+                    return
+            except KeyError as error:
+                self.reply(404, {'error': error.args[0]})
+                return
+            except ValueError as error:
+                self.reply(400, {'error': error.args[0]})
+                return
+            self.reply(200, body)
+
+        def reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # Keep the console quiet for high query rates
+            pass
+
+    return QueryHandler
+
+
+def serve(service, host='127.0.0.1', port=8050):
+    """
+    Answer queries over HTTP until interrupted.
+
+    Args:
+        service (PSPSQueryService): The loaded service.
+        host (str): Interface to listen on; local only by default.
+        port (int): Port to listen on.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"PSPS query service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # python query_service.py [port]: load the analyze_spans results once and serve them over HTTP
+    import sys
+
+    with open('data-params.json', 'r') as fh:
+        config = json.load(fh)
+    service = PSPSQueryService.from_pipeline(config)
+    print(f"Loaded {len(service.span_rows)} spans, {len(service.circuits)} circuits and {len(service.feeders)} feeders.")
+    serve(service, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8050)
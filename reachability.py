@@ -0,0 +1,256 @@
+import numpy as np
+import pandas as pd
+from span_network import SpanNetwork
+from profiling import instrument
+
+
+class ReachabilityIndex:
+    """
+    Pre-order intervals of a span forest for constant-time upstream/downstream queries.
+
+    The spans are numbered in depth-first pre-order, one feeder tree after the other, with
+    children in the order of the span network. A span's downstream spans then fill the
+    positions right after it, so span A is upstream of span B exactly when B's position lies
+    in A's interval, and the spans fed through A are one contiguous slice of `ordered_ids`.
+
+    Args:
+        ids (np.ndarray): Span id of each node.
+        parent (np.ndarray): Node code of each node's upstream span, or -1.
+        enter (np.ndarray): Pre-order position of each node.
+        size (np.ndarray): Number of nodes in each node's subtree, itself included.
+        depth (np.ndarray): Number of upstream spans of each node.
+        root (np.ndarray): Node code of the top of each node's feeder tree.
+    """
+
+    def __init__(self, ids, parent, enter, size, depth, root):
+        self.ids = ids
+        self.parent = parent
+        self.enter = enter
+        self.size = size
+        self.exit = enter + size
+        self.depth = depth
+        self.root = root
+        self.index = pd.Index(ids)
+        order = np.empty(len(ids), dtype=np.int64)
+        order[enter] = np.arange(len(ids))
+        self.order = order
+        self.ordered_ids = np.asarray(ids)[order]
+
+    @classmethod
+    @instrument
+    def from_parent(cls, ids, parent):
+        """
+        Build the index from a parent-pointer span forest without a per-span loop.
+
+        The forest is walked one depth level at a time: subtree sizes are summed from the
+        deepest level up, then each level's positions follow from its parent's position and
+        the sizes of its earlier siblings.
+
+        Args:
+            ids (array-like): Span id of each node.
+            parent (np.ndarray): Node code of each node's upstream span, or -1.
+
+        Returns:
+            ReachabilityIndex: The index.
+
+        Raises:
+            ValueError: If the network has a cycle.
+        """
+        parent = np.asarray(parent, dtype=np.int64)
+        n_nodes = len(parent)
+        child_indptr, child_indices = SpanNetwork.children_csr(parent)
+
+        depth = np.empty(n_nodes, dtype=np.int64)
+        root = np.empty(n_nodes, dtype=np.int64)
+        levels = []
+        level = np.nonzero(parent < 0)[0]
+        root[level] = level
+        while len(level):
+            depth[level] = len(levels)
+            levels.append(level)
+            # Children of this level, in CSR slices of child_indices
+            counts = child_indptr[level + 1] - child_indptr[level]
+            starts = np.repeat(child_indptr[level] - np.cumsum(counts) + counts, counts)
+            children = child_indices[starts + np.arange(counts.sum())]
+            root[children] = root[parent[children]]
+            level = children
+
+        if sum(len(level) for level in levels) < n_nodes:
+            # Nodes on or below a cycle are never reached from a feeder top
+            raise ValueError('The span network has a cycle; the reachability index needs a span forest.')
+
+        size = np.ones(n_nodes, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            size += np.bincount(parent[level], weights=size[level], minlength=n_nodes).astype(np.int64)
+
+        # Positions taken by the earlier siblings of each child, from the CSR child order
+        sibling_sizes = size[child_indices]
+        before = np.cumsum(sibling_sizes) - sibling_sizes
+        offset = np.empty(n_nodes, dtype=np.int64)
+        offset[child_indices] = before - before[child_indptr[parent[child_indices]]]
+
+        enter = np.empty(n_nodes, dtype=np.int64)
+        if levels:
+            roots = levels[0]
+            enter[roots] = np.cumsum(size[roots]) - size[roots]
+            for level in levels[1:]:
+                enter[level] = enter[parent[level]] + 1 + offset[level]
+        return cls(SpanNetwork.compact_ids(ids), parent, enter, size, depth, root)
+
+    @classmethod
+    def from_network(cls, G):
+        """
+        Build the index from the span network of analyze_spans.
+
+        Args:
+            G (nx.DiGraph or SpanNetwork): Directed graph of spans, edges pointing upstream.
+
+        Returns:
+            ReachabilityIndex: The index.
+
+        Raises:
+            ValueError: If a span has several upstream spans or the network has a cycle.
+        """
+        if isinstance(G, SpanNetwork) and G.extra_parents:
+            raise ValueError('A span has several upstream spans; the reachability index needs a span forest.')
+        if isinstance(G, SpanNetwork):
+            return cls.from_parent(G.ids, G.parent)
+        if any(degree > 1 for _, degree in G.out_degree()):
+            raise ValueError('A span has several upstream spans; the reachability index needs a span forest.')
+        ids = list(G)
+        parent = pd.Index(ids, dtype=object).get_indexer(
+            pd.Index([next(iter(G.successors(node)), None) for node in ids], dtype=object))
+        return cls.from_parent(ids, parent)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __contains__(self, span_id):
+        return span_id in self.index
+
+    def codes(self, span_ids):
+        """
+        Encode span ids as node codes.
+
+        Args:
+            span_ids (array-like): Span ids.
+
+        Returns:
+            np.ndarray: Node codes, -1 for unknown ids.
+        """
+        return self.index.get_indexer(pd.Index(span_ids, dtype=object))
+
+    def code(self, span_id):
+        """Encode a single span id, raising KeyError if it is not in the network."""
+        return self.index.get_loc(span_id)
+
+    def is_upstream(self, upstream_id, span_id):
+        """
+        Test whether a span is upstream of another, i.e. feeds it.
+
+        Args:
+            upstream_id: Candidate upstream span id.
+            span_id: Span id.
+
+        Returns:
+            bool: True if `upstream_id` is on the path from `span_id` to the top of its feeder.
+        """
+        upstream, node = self.code(upstream_id), self.code(span_id)
+        return bool(self.enter[upstream] < self.enter[node] < self.exit[upstream])
+
+    def is_upstream_batch(self, upstream_ids, span_ids):
+        """
+        Pairwise is_upstream over two arrays of span ids.
+
+        Args:
+            upstream_ids (array-like): Candidate upstream span ids.
+            span_ids (array-like): Span ids, the same length as `upstream_ids`.
+
+        Returns:
+            np.ndarray: Boolean array, False where either id is unknown.
+        """
+        upstream, nodes = self.codes(upstream_ids), self.codes(span_ids)
+        known = (upstream >= 0) & (nodes >= 0)
+        upstream, nodes = upstream[known], nodes[known]
+        result = np.zeros(len(known), dtype=bool)
+        result[known] = (self.enter[upstream] < self.enter[nodes]) & (self.enter[nodes] < self.exit[upstream])
+        return result
+
+    def upstream(self, span_id):
+        """
+        Spans upstream of a span, nearest first, as SpanNetwork.upstream lists them.
+
+        Args:
+            span_id: Span id.
+
+        Returns:
+            np.ndarray: Upstream span ids, the top of the feeder last.
+        """
+        node = self.code(span_id)
+        nodes = np.empty(self.depth[node], dtype=np.int64)
+        for position in range(len(nodes)):
+            node = self.parent[node]
+            nodes[position] = node
+        return self.ordered_ids[self.enter[nodes]]
+
+    def downstream(self, span_id):
+        """
+        Spans fed through a span, in depth-first order, as SpanNetwork.downstream lists them.
+
+        Args:
+            span_id: Span id.
+
+        Returns:
+            np.ndarray: A view of `ordered_ids`.
+        """
+        node = self.code(span_id)
+        return self.ordered_ids[self.enter[node] + 1:self.exit[node]]
+
+    def downstream_bounds(self, span_ids):
+        """
+        Slices of `ordered_ids` holding the downstream spans of several spans.
+
+        Args:
+            span_ids (array-like): Span ids.
+
+        Returns:
+            tuple: Start and stop arrays; unknown ids get empty slices.
+        """
+        nodes = self.codes(span_ids)
+        known = nodes >= 0
+        starts = np.zeros(len(nodes), dtype=np.int64)
+        stops = np.zeros(len(nodes), dtype=np.int64)
+        starts[known] = self.enter[nodes[known]] + 1
+        stops[known] = self.exit[nodes[known]]
+        return starts, stops
+
+    def downstream_batch(self, span_ids):
+        """Downstream spans of each of several spans, as views of `ordered_ids`."""
+        starts, stops = self.downstream_bounds(span_ids)
+        return [self.ordered_ids[start:stop] for start, stop in zip(starts.tolist(), stops.tolist())]
+
+    def deenergized(self, span_ids):
+        """
+        Spans that lose power when the given spans are de-energized.
+
+        Args:
+            span_ids (array-like): De-energized span ids; unknown ids are ignored.
+
+        Returns:
+            np.ndarray: The de-energized spans and everything downstream of them, each once,
+                in depth-first order.
+        """
+        nodes = self.codes(span_ids)
+        nodes = nodes[nodes >= 0]
+        # Covered positions are where more intervals have opened than closed
+        cover = np.zeros(len(self) + 1, dtype=np.int64)
+        np.add.at(cover, self.enter[nodes], 1)
+        np.add.at(cover, self.exit[nodes], -1)
+        return self.ordered_ids[np.cumsum(cover[:-1]) > 0]
+
+    def feeder_top(self, span_ids):
+        """Top span of the feeder tree of each span, None for unknown ids."""
+        nodes = self.codes(span_ids)
+        tops = np.full(len(nodes), None, dtype=object)
+        tops[nodes >= 0] = np.asarray(self.ids, dtype=object)[self.root[nodes[nodes >= 0]]]
+        return tops
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from profiling import instrument
+
+# Hierarchy levels above the spans, from the smallest: name, grouping column and the output
+# columns the level names differently, as the analyze_spans printouts name the mean probability
+CIRCUIT_LEVEL = ('circuit', 'upstreamardfacilityid', {'psps_value': 'circuit_psps_value'})
+FEEDER_LEVEL = ('feeder', 'parent_feederid', {'psps_value': 'segment_psps_value'})
+ROLLUP_LEVELS = [CIRCUIT_LEVEL, FEEDER_LEVEL]
+
+# Aggregates of each level: output column -> (span column, 'sum', 'mean' or 'count')
+ROLLUP_METRICS = {
+    'span_count': ('globalid', 'count'),
+    'psps_value': ('probability', 'mean'),
+    'sum_of_customers': ('cust_total', 'sum'),
+    'annual_customers_affected': ('annual_cust_total', 'sum'),
+}
+
+
+class HierarchyRollup:
+    """
+    Span aggregates for every group of every hierarchy level at once.
+
+    The group of each span at each level is encoded once into a sparse membership matrix
+    with one row per (level, group) and one column per span row. Any set of span metrics is
+    then aggregated for all circuits and feeders with a single sparse product, so adding a
+    metric later costs one matrix-vector product instead of new groupby passes.
+
+    Groups are sorted by id, missing group ids are left out and missing values are skipped,
+    as in a pandas groupby.
+
+    Args:
+        spans (pd.DataFrame): Span data with the grouping columns of `levels`.
+        levels (list): (name, column, output column renames) of each level, smallest first.
+    """
+
+    def __init__(self, spans, levels=ROLLUP_LEVELS):
+        self.spans = spans
+        self.levels = levels
+        self.groups = dict()
+        rows, codes = [], []
+        offset = 0
+        self.offsets = dict()
+        for name, column, _ in levels:
+            level_codes, groups = pd.factorize(spans[column], sort=True)
+            # Group ids keep the dtype of their values, as in a groupby on the plain column
+            groups = pd.Index(np.asarray(groups), name=column)
+            known = np.nonzero(level_codes >= 0)[0]
+            rows.append(known)
+            codes.append(level_codes[known] + offset)
+            self.groups[name] = groups
+            self.offsets[name] = offset
+            offset += len(groups)
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+        self.membership = sparse.csr_matrix((np.ones(len(rows)), (codes, rows)), shape=(offset, len(spans)))
+
+    def totals(self, values):
+        """
+        Sum and count of the non-missing values of one or more span columns per group.
+
+        Args:
+            values (np.ndarray): Span values, one row per span row and one column per metric.
+
+        Returns:
+            tuple: Sums and counts, one row per (level, group).
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(len(self.spans), -1)
+        present = ~np.isnan(values)
+        sums = self.membership @ np.where(present, values, 0.0)
+        counts = self.membership @ present.astype(np.float64)
+        return sums, counts
+
+    @instrument
+    def aggregate(self, metrics=None):
+        """
+        Aggregate span columns for every group of every level in one pass.
+
+        Args:
+            metrics (dict): Output column -> (span column, 'sum', 'mean' or 'count').
+                Defaults to ROLLUP_METRICS, skipping columns the spans do not have.
+
+        Returns:
+            dict: Level name -> DataFrame indexed by group id, one column per metric, named
+                as the level renames it.
+        """
+        if metrics is None:
+            metrics = {name: spec for name, spec in ROLLUP_METRICS.items() if spec[0] in self.spans.columns}
+        for _, how in metrics.values():
+            if how not in ('sum', 'mean', 'count'):
+                raise ValueError(f"Unknown aggregate: {how}. Use 'sum', 'mean' or 'count'.")
+        columns = list(dict.fromkeys(column for column, _ in metrics.values()))
+        values = np.column_stack([self.numeric(column) for column in columns]) if columns else np.empty((len(self.spans), 0))
+        sums, counts = self.totals(values)
+
+        tables = dict()
+        for name, column, renames in self.levels:
+            start = self.offsets[name]
+            stop = start + len(self.groups[name])
+            table = pd.DataFrame(index=self.groups[name])
+            for output, (span_column, how) in metrics.items():
+                position = columns.index(span_column)
+                output = renames.get(output, output)
+                level_sums, level_counts = sums[start:stop, position], counts[start:stop, position]
+                if how == 'count':
+                    table[output] = level_counts.astype(np.int64)
+                elif how == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        table[output] = level_sums / level_counts
+                elif self.is_integer(span_column):
+                    table[output] = np.rint(level_sums).astype(np.int64)
+                else:
+                    table[output] = level_sums
+            tables[name] = table
+        return tables
+
+    def numeric(self, column):
+        """A span column as floats; non-numeric columns, such as ids, become presence flags for counting."""
+        values = self.spans[column]
+        if pd.api.types.is_numeric_dtype(values):
+            return values.astype(np.float64).to_numpy(na_value=np.nan)
+        return np.where(values.isna().to_numpy(), np.nan, 1.0)
+
+    def is_integer(self, column):
+        """Whether a span column holds integers, so its sums stay integers."""
+        values = self.spans[column]
+        return pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values)
+
+
+def rank_rollups(tables, by='annual_customers_affected'):
+    """
+    Sort each level's table by a metric, largest first, and number the groups.
+
+    Args:
+        tables (dict): Output of HierarchyRollup.aggregate.
+        by (str): Column to rank by; groups tied on it keep their id order.
+
+    Returns:
+        dict: Level name -> ranked DataFrame with a 'rank' column, the group id as a column.
+    """
+    ranked = dict()
+    for name, table in tables.items():
+        table = table.sort_index(kind='stable').sort_values(by, ascending=False, kind='stable', na_position='last')
+        table.insert(0, 'rank', np.arange(1, len(table) + 1))
+        ranked[name] = table.reset_index()
+    return ranked
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+
+# Applied to every float column not listed in a schema
+NUMERIC = '*numeric'
+
+# Column dtypes of each input file, keyed like `data_sources` in data-params.json.
+# Ids are categorical; a ('category', group) entry shares its categories with the other
+# columns of the same group, so span ids referenced by upstream_span_id are stored once.
+# Wind speeds and station thresholds stay float64: rounding both sides of
+# `wind_speed > threshold` to float32 can turn a reading just below a threshold into a tie.
+SCHEMAS = {
+    'gis_weatherstation': {
+        'weatherstationcode': 'category',
+        # Repeated on every reading after the merge with the wind speeds
+        'shape': 'category',
+        'shape_srid': 'int32',
+    },
+    'station_summary_snapshot': {
+        'station': 'category',
+    },
+    'windspeed_snapshot': {
+        'station': 'category',
+        'date': 'datetime64[ns]',
+    },
+    'src_vri_snapshot': {
+        'shape_srid': 'int32',
+    },
+    'dev_wings_agg_span': {
+        'globalid': ('category', 'span_id'),
+        'upstream_span_id': ('category', 'span_id'),
+        'station': 'category',
+        'parent_feederid': 'category',
+        'upstreamardfacilityid': 'category',
+        'shape_srid': 'int32',
+    },
+    # Output of merge_weather_data, read back from merged_weather_output
+    'merged_weather': {
+        'weatherstationcode': 'category',
+        'shape': 'category',
+        'shape_srid': 'int32',
+        'date': 'datetime64[ns]',
+        'exceed_threshold': 'int8',
+    },
+}
+
+
+def apply_schema(df, schema):
+    """
+    Convert the columns of a DataFrame to the dtypes of a schema.
+
+    Columns missing from the frame are skipped, and columns already of the right dtype are
+    left as they are, so applying a schema twice is cheap.
+
+    Args:
+        df (DataFrame): Data to convert, modified in place.
+        schema (str or dict): Name of an entry of SCHEMAS, or a column-to-dtype mapping.
+
+    Returns:
+        DataFrame: The converted data.
+    """
+    if isinstance(schema, str):
+        schema = SCHEMAS[schema]
+
+    groups = dict()
+    for column, dtype in schema.items():
+        if column == NUMERIC or column not in df.columns:
+            continue
+        if isinstance(dtype, tuple):
+            groups.setdefault(dtype[1], []).append(column)
+        elif dtype == 'category':
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        elif dtype.startswith('datetime64'):
+            if not pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = pd.to_datetime(df[column])
+        elif df[column].dtype != dtype and not df[column].isna().any():
+            df[column] = df[column].astype(dtype)
+
+    for columns in groups.values():
+        align_categories(df, columns)
+
+    if NUMERIC in schema:
+        for column in df.columns:
+            if column not in schema and pd.api.types.is_float_dtype(df[column]) and df[column].dtype != schema[NUMERIC]:
+                df[column] = df[column].astype(schema[NUMERIC])
+    return df
+
+
+def restore_dtypes(df):
+    """
+    Convert the compact dtypes of SCHEMAS back to the ones pandas reads from the CSV files.
+
+    Categorical columns get the dtype of their values and narrow integers become int64, so
+    saved tables have the dtypes they had without the schemas. Dates stay datetime64.
+
+    Args:
+        df (DataFrame): Data with schema dtypes.
+
+    Returns:
+        DataFrame: The data, converted where needed (a copy then).
+    """
+    dtypes = dict()
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[column] = dtype.categories.dtype
+        elif pd.api.types.is_integer_dtype(dtype) and dtype != np.int64 and not pd.api.types.is_extension_array_dtype(dtype):
+            dtypes[column] = np.int64
+    return df.astype(dtypes) if dtypes else df
+
+
+def align_categories(df, columns):
+    """
+    Give several columns of a frame one shared set of categories.
+
+    Args:
+        df (DataFrame): Data, modified in place.
+        columns (list): Columns to convert.
+
+    Returns:
+        pd.CategoricalDtype: The shared dtype.
+    """
+    return align_frame_categories([(df, column) for column in columns])
+
+
+def align_frame_categories(frame_columns):
+    """
+    Give columns of several frames one shared, sorted set of categories.
+
+    Merging categorical keys keeps them categorical only when both sides have the same
+    categories, so the keys are aligned before the merges.
+
+    Args:
+        frame_columns (list): (DataFrame, column) pairs, modified in place.
+
+    Returns:
+        pd.CategoricalDtype: The shared dtype.
+    """
+    values = []
+    for df, column in frame_columns:
+        series = df[column]
+        values.append(series.cat.categories if isinstance(series.dtype, pd.CategoricalDtype) else pd.Index(series.dropna().unique()))
+    categories = values[0].append(values[1:]).unique() if len(values) > 1 else values[0]
+    # Sorted categories keep groupby results in the order object keys would give
+    dtype = pd.CategoricalDtype(pd.Index(categories).sort_values())
+    for df, column in frame_columns:
+        if df[column].dtype != dtype:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].cat.set_categories(dtype.categories)
+            else:
+                df[column] = df[column].astype(dtype)
+    return dtype
+
+
+def memory_footprint(df):
+    """
+    Memory used by each column of a frame, in MB, including the objects it references.
+
+    Categories shared by several columns are counted once for each of them.
+
+    Args:
+        df (DataFrame): Data to measure.
+
+    Returns:
+        pd.Series: Megabytes per column and a 'total' entry.
+    """
+    usage = df.memory_usage(deep=True, index=False) / (1024 * 1024)
+    usage['total'] = usage.sum()
+    return usage
+
+
+def compare_footprints(before, after, name):
+    """
+    Print the memory of a frame before and after applying a schema.
+
+    Args:
+        before (DataFrame): Data with the default dtypes.
+        after (DataFrame): Data with the schema dtypes.
+        name (str): Name shown in the report.
+
+    Returns:
+        DataFrame: 'default_mb', 'compact_mb' and 'ratio' per column.
+    """
+    report = pd.DataFrame({'default_mb': memory_footprint(before), 'compact_mb': memory_footprint(after)})
+    report['ratio'] = report['compact_mb'] / report['default_mb'].replace(0, np.nan)
+    print(f"{name}: {report.loc['total', 'default_mb']:.1f} MB -> {report.loc['total', 'compact_mb']:.1f} MB")
+    print(report.round(3))
+    return report
+
+
+if __name__ == "__main__":
+    # python schema.py: memory footprint of each input and the merged weather data with and without the schemas
+    import json
+    from etl import load_data, merge_weather_data
+
+    with open('data-params.json', 'r') as fh:
+        data_sources = json.load(fh)['data_sources']
+    for name in SCHEMAS:
+        if name in data_sources:
+            compare_footprints(load_data(data_sources[name]), load_data(data_sources[name], schema=name), name)
+    paths = [data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'], data_sources['windspeed_snapshot']]
+    compare_footprints(merge_weather_data(*paths, compact=False), merge_weather_data(*paths), 'merged_weather')
@@ -0,0 +1,237 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from spatial_join import parallel_sjoin, serial_match_rank
+from profiling import instrument
+
+
+def feature_keys(gdf, id_column='globalid'):
+    """
+    Hash every row of a snapshot by its geometry and attributes.
+
+    Args:
+        gdf (gpd.GeoDataFrame): Snapshot rows.
+        id_column (str): Column with the feature id.
+
+    Returns:
+        pd.DataFrame: Indexed like `gdf`, with the feature 'id', its 'occurrence' (0 for the
+            first row of an id, 1 for the second, ...) and the 'row_hash' of the row.
+    """
+    geometry_hash = pd.util.hash_array(np.asarray(shapely.to_wkb(gdf.geometry.to_numpy()), dtype=object))
+    attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).assign(_geometry=geometry_hash)
+    keys = pd.DataFrame({
+        'id': gdf[id_column].to_numpy(dtype=object),
+        'occurrence': gdf.groupby(id_column, sort=False, dropna=False, observed=True).cumcount().to_numpy(),
+        'row_hash': pd.util.hash_pandas_object(attributes, index=False).to_numpy(),
+    }, index=gdf.index)
+    return keys
+
+
+def feature_hashes(keys):
+    """
+    Combine the row hashes of each feature, so a feature listed in several rows gets one hash.
+
+    Args:
+        keys (pd.DataFrame): Output of feature_keys.
+
+    Returns:
+        pd.Series: Hash of each feature, indexed by id.
+    """
+    # Mixing in the occurrence makes the combined hash depend on the order of a feature's rows
+    mixed = pd.util.hash_pandas_object(keys[['row_hash', 'occurrence']], index=False).to_numpy()
+    codes, ids = pd.factorize(keys['id'], use_na_sentinel=False)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]]) if len(order) else np.empty(0, dtype=np.int64)
+    combined = np.bitwise_xor.reduceat(mixed[order], starts) if len(order) else np.empty(0, dtype=np.uint64)
+    return pd.Series(combined, index=pd.Index(np.asarray(ids, dtype=object)[codes[order][starts]], dtype=object))
+
+
+def diff_snapshots(old_keys, new_keys):
+    """
+    Find the features added, removed and modified between two snapshots.
+
+    A feature is modified when its geometry, any of its attributes or its number of rows changed.
+
+    Args:
+        old_keys (pd.DataFrame): feature_keys of the previous snapshot.
+        new_keys (pd.DataFrame): feature_keys of the new snapshot.
+
+    Returns:
+        dict: 'added', 'removed', 'modified' and 'unchanged' feature ids, as pd.Index.
+    """
+    old, new = feature_hashes(old_keys), feature_hashes(new_keys)
+    common = old.index.intersection(new.index, sort=False)
+    same = old.reindex(common).to_numpy() == new.reindex(common).to_numpy()
+    return {
+        'added': new.index.difference(old.index, sort=False),
+        'removed': old.index.difference(new.index, sort=False),
+        'modified': common[~same],
+        'unchanged': common[same],
+    }
+
+
+def describe_diff(diff):
+    """One-line summary of a snapshot diff."""
+    return ', '.join(f"{len(diff[kind])} {kind}" for kind in ('added', 'removed', 'modified', 'unchanged'))
+
+
+def is_unchanged(ids, diff):
+    """Flag the ids of unchanged features."""
+    return pd.Index(diff['unchanged'], dtype=object).get_indexer(pd.Index(ids, dtype=object)) >= 0
+
+
+def relabel(old_labels, old_keys, new_keys):
+    """
+    Map row labels of the previous snapshot to the labels of the same rows in the new one.
+
+    Rows are matched by feature id and occurrence, which is only meaningful for unchanged features.
+
+    Returns:
+        pd.Index: New label of each old label.
+    """
+    old_rows = old_keys.loc[old_labels]
+    new_rows = pd.MultiIndex.from_arrays([new_keys['id'], new_keys['occurrence']])
+    positions = new_rows.get_indexer(pd.MultiIndex.from_arrays([old_rows['id'], old_rows['occurrence']]))
+    return new_keys.index.take(positions)
+
+
+@instrument
+def patch_sjoin(previous, old_left_keys, old_right_keys, left, right, left_keys, right_keys, predicate):
+    """
+    Update a previous inner spatial join for new snapshots of both sides.
+
+    Rows of the previous result whose left and right features are both unchanged are kept
+    and relabelled. Changed left features are joined with the whole right side, and the
+    unchanged left features with the changed right features only. The rows are then put
+    in the order gpd.sjoin produces, so the result equals a full rejoin.
+
+    Args:
+        previous (gpd.GeoDataFrame): Join result of the previous snapshots.
+        old_left_keys (pd.DataFrame): feature_keys of the previous left snapshot.
+        old_right_keys (pd.DataFrame): feature_keys of the previous right snapshot.
+        left (gpd.GeoDataFrame): New left snapshot.
+        right (gpd.GeoDataFrame): New right snapshot.
+        left_keys (pd.DataFrame): feature_keys of `left`.
+        right_keys (pd.DataFrame): feature_keys of `right`.
+        predicate (str): Binary predicate of the join.
+
+    Returns:
+        tuple: The patched join, and the left and right snapshot diffs.
+    """
+    left_diff = diff_snapshots(old_left_keys, left_keys)
+    right_diff = diff_snapshots(old_right_keys, right_keys)
+    right_index_column = previous.columns[len(left.columns)]
+
+    # Previous rows between two unchanged features still hold
+    kept_left = is_unchanged(old_left_keys.loc[previous.index, 'id'], left_diff)
+    kept_right = is_unchanged(old_right_keys.loc[previous[right_index_column], 'id'], right_diff)
+    kept = previous[kept_left & kept_right].copy()
+    kept.index = relabel(kept.index, old_left_keys, left_keys)
+    kept[right_index_column] = relabel(kept[right_index_column], old_right_keys, right_keys)
+
+    changed_left = ~is_unchanged(left_keys['id'], left_diff)
+    changed_right = ~is_unchanged(right_keys['id'], right_diff)
+    pieces = [
+        gpd.sjoin(left[changed_left], right, how='inner', predicate=predicate),
+        gpd.sjoin(left[~changed_left], right[changed_right], how='inner', predicate=predicate),
+    ]
+    # Kept rows take the column types and index name of the new joins, e.g. their categories
+    kept = kept.astype({column: dtype for column, dtype in pieces[0].dtypes.items()
+                        if isinstance(dtype, pd.CategoricalDtype)}).rename_axis(pieces[0].index.name)
+
+    joined = pd.concat([kept] + pieces)
+    left_positions = left.index.get_indexer(joined.index)
+    right_positions = right.index.get_indexer(joined[right_index_column])
+    order = np.lexsort((serial_match_rank(right, predicate)[right_positions], left_positions))
+    return joined.iloc[order], left_diff, right_diff
+
+
+def load_join_state(state_path):
+    """Load a join state saved by incremental_sjoin, or None if there is none."""
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def save_join_state(state, state_path):
+    """Save a join state, replacing the previous one only once it is fully written."""
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'wb') as fh:
+        pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, state_path)
+
+
+@instrument
+def incremental_sjoin(left, right, predicate, state_path, left_id='globalid', right_id='globalid',
+                      n_workers=None, partition='right', verify=False):
+    """
+    Inner spatial join that patches the result of the previous run instead of rejoining.
+
+    The result, with the feature hashes of both inputs, is saved to `state_path`. The next
+    call diffs its inputs against them and only joins the added and modified features. The
+    full parallel join runs instead on the first call, or when the previous result cannot
+    be reused: another predicate, CRS or columns, or row labels that are not unique.
+
+    Args:
+        left (gpd.GeoDataFrame): Left GeoDataFrame.
+        right (gpd.GeoDataFrame): Right GeoDataFrame.
+        predicate (str): Binary predicate, as in `gpd.sjoin`.
+        state_path (str): File holding the previous result and feature hashes.
+        left_id (str): Feature id column of `left`.
+        right_id (str): Feature id column of `right`.
+        n_workers (int): Number of processes for a full join. Defaults to the number of CPUs.
+        partition (str): Side split into tiles by a full parallel join.
+        verify (bool): Also run the full join and raise an AssertionError if the results differ,
+            leaving the saved state as it was.
+
+    Returns:
+        gpd.GeoDataFrame: Result identical to `gpd.sjoin(left, right, how='inner', predicate=predicate)`.
+    """
+    left_keys, right_keys = feature_keys(left, left_id), feature_keys(right, right_id)
+    state = load_join_state(state_path)
+    reusable = (
+        state is not None and state['predicate'] == predicate
+        and state['left_crs'] == left.crs and state['right_crs'] == right.crs
+        and state['left_columns'] == list(left.columns) and state['right_columns'] == list(right.columns)
+        and left.index.is_unique and right.index.is_unique
+        and state['left_keys'].index.is_unique and state['right_keys'].index.is_unique
+    )
+    if reusable:
+        joined, left_diff, right_diff = patch_sjoin(state['result'], state['left_keys'], state['right_keys'],
+                                                    left, right, left_keys, right_keys, predicate)
+        print(f"Patched {predicate} join: left {describe_diff(left_diff)}; right {describe_diff(right_diff)}.")
+    else:
+        joined = parallel_sjoin(left, right, predicate=predicate, n_workers=n_workers, partition=partition)
+
+    if verify:
+        # Checked before saving, so a wrong patch is not carried into the next run
+        full = parallel_sjoin(left, right, predicate=predicate, n_workers=n_workers, partition=partition)
+        pd.testing.assert_frame_equal(joined, full)
+        print(f"Verified the {predicate} join against a full rejoin ({len(full)} rows).")
+
+    save_join_state({
+        'predicate': predicate, 'result': joined,
+        'left_crs': left.crs, 'right_crs': right.crs,
+        'left_columns': list(left.columns), 'right_columns': list(right.columns),
+        'left_keys': left_keys, 'right_keys': right_keys,
+    }, state_path)
+    return joined
+
+
+if __name__ == "__main__":
+    # python snapshot_diff.py vri|conductor <old.csv> <new.csv>: list the features that changed
+    import sys
+    from data_vri_conductor import process_conductor_data, process_vri_data
+
+    kind, old_path, new_path = sys.argv[1:4]
+    process = process_vri_data if kind == 'vri' else process_conductor_data
+    diff = diff_snapshots(feature_keys(process(old_path)), feature_keys(process(new_path)))
+    print(describe_diff(diff))
+    for change in ('added', 'removed', 'modified'):
+        if len(diff[change]):
+            print(f"{change}: {', '.join(map(str, diff[change][:20]))}{' ...' if len(diff[change]) > 20 else ''}")
@@ -1,20 +1,25 @@
 
 from etl import load_data, save_data
-import networkx as nx
 from psps import calculate_combined_count
+from span_network import SpanNetwork
+from exceedance import ExceedanceMatrix, parallel_span_probabilities
+from incidence import SpanStationIncidence
 import pandas as pd
 import numpy as np
+from profiling import instrument
 
-def formSpanNet(merged_station_wind_speed, dev_wings_agg_span):
+@instrument
+def formSpanNet(merged_station_wind_speed, dev_wings_agg_span, backend='networkx'):
     """
     Create a span network as a directed graph.
 
     Args:
         merged_station_wind_speed (DataFrame): Merged station wind speed data.
         dev_wings_agg_span (DataFrame): Aggregated span data.
+        backend (str): 'networkx' for an nx.DiGraph or 'array' for a compact SpanNetwork.
 
     Returns:
-        tuple: Directed graph (nx.DiGraph) and merged station spans DataFrame.
+        tuple: Directed graph (nx.DiGraph or SpanNetwork) and merged station spans DataFrame.
     """
     # Calculate combined count
     combined_count = calculate_combined_count(merged_station_wind_speed)
@@ -22,26 +27,40 @@ def formSpanNet(merged_station_wind_speed, dev_wings_agg_span):
     # Merge spans with combined count
     merged_station_psps_spans = dev_wings_agg_span.merge(combined_count, left_on='station', right_index=True, how='inner')
 
-    # Create the directed graph
+    if backend.lower() == 'array':
+        return SpanNetwork.from_spans(dev_wings_agg_span), merged_station_psps_spans
+    if backend.lower() != 'networkx':
+        raise ValueError('Invalid Backend: Use "networkx" or "array".')
+
+    # Create the directed graph, spans first so nodes are in the order of SpanNetwork
+    import networkx as nx
     G = nx.DiGraph()
+    G.add_nodes_from(dev_wings_agg_span['globalid'])
     for row in dev_wings_agg_span.itertuples(index=True, name='Pandas'):
-        G.add_edge(row.globalid, row.upstream_span_id)
+        # A missing upstream span marks the top of a feeder, not a shared 'nan' node
+        if not pd.isna(row.upstream_span_id):
+            G.add_edge(row.globalid, row.upstream_span_id)
 
     return G, merged_station_psps_spans
 
 
+@instrument
 def getUpstream(G, start_node, algorithm='dfs'):
     """
     Get all upstream nodes from the start node using the specified algorithm.
     
     Args:
-        G (nx.DiGraph): The directed graph.
+        G (nx.DiGraph or SpanNetwork): The directed graph.
         start_node: The starting node.
         algorithm (str): The traversal algorithm ('bfs' or 'dfs').
 
     Returns:
         List: List of upstream nodes.
     """
+    if isinstance(G, SpanNetwork):
+        # Each span has a single upstream span, so both algorithms follow the same chain
+        return G.upstream(start_node)
+    import networkx as nx
     if algorithm.lower() == 'bfs':
         tracing = dict(nx.bfs_successors(G, start_node))
     elif algorithm.lower() == 'dfs':
@@ -57,51 +76,242 @@ def getDownstream(G, start_node, algorithm='dfs'):
     Retrieve downstream nodes from a given start node.
 
     Args:
-        G (nx.DiGraph): Directed graph.
+        G (nx.DiGraph or SpanNetwork): Directed graph.
         start_node: Starting node in the graph.
         algorithm (str): Algorithm for traversal ('bfs' or 'dfs').
 
     Returns:
         List: Downstream nodes.
     """
+    if isinstance(G, SpanNetwork):
+        return G.downstream(start_node)
+    import networkx as nx
+    # Edges point upstream, so the downstream spans are reached against them
+    reverse = G.reverse(copy=False)
     if algorithm.lower() == 'bfs':
-        tracing = dict(nx.bfs_predecessors(G, start_node))
+        return [node for _, node in nx.bfs_edges(reverse, start_node)]
     elif algorithm.lower() == 'dfs':
-        tracing = nx.dfs_predecessors(G, start_node)
+        return list(nx.dfs_preorder_nodes(reverse, start_node))[1:]
     else:
         raise ValueError('Invalid Algorithm: Use "bfs" or "dfs".')
 
-    return list(tracing.keys())
 
 
+def has_several_upstream_spans(G):
+    """
+    Check whether any span of a network has more than one upstream span.
 
-def unique_upstream_weather_stations_to_span(dev_wings_agg_span, G, merged_station_psps_spans):
+    Args:
+        G (nx.DiGraph or SpanNetwork): Directed graph of spans.
+
+    Returns:
+        bool: True if the network is not a span forest.
     """
-    Map unique upstream weather stations to each span.
+    if isinstance(G, SpanNetwork):
+        return bool(G.extra_parents)
+    return any(degree > 1 for _, degree in G.out_degree())
+
+
+class StationChain:
+    """
+    Immutable linked list of upstream weather station records.
+
+    A span's chain is its parent's chain with the parent's station in front, so spans on
+    the same radial path share all but one link instead of each holding a full copy.
+    """
+    __slots__ = ('head', 'tail', 'length')
+
+    def __init__(self, head, tail=None):
+        self.head = head
+        self.tail = tail
+        self.length = 1 + (tail.length if tail is not None else 0)
+
+    def __iter__(self):
+        node = self
+        while node is not None:
+            yield node.head
+            node = node.tail
+
+
+class UpstreamStations:
+    """
+    Read-only list of the weather stations upstream of a span, nearest first, then the span's own station.
+
+    Args:
+        ancestors (StationChain): Stations of the upstream spans, or None.
+        own: Station record of the span itself, or None.
+    """
+    __slots__ = ('ancestors', 'own')
+
+    def __init__(self, ancestors, own):
+        self.ancestors = ancestors
+        self.own = own
+
+    def __iter__(self):
+        if self.ancestors is not None:
+            yield from self.ancestors
+        if self.own is not None:
+            yield self.own
+
+    def __len__(self):
+        return (self.ancestors.length if self.ancestors is not None else 0) + (self.own is not None)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (UpstreamStations, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def span_weather_station_map(merged_station_psps_spans):
+    """
+    Map each span to the record of its own weather station.
+
+    Args:
+        merged_station_psps_spans (DataFrame): Merged station and PSPS spans data.
+
+    Returns:
+        dict: Span globalid to (station, PSPS_probability, above_threshold_count, wind_speed_count).
+    """
+    span_weather_station = dict()
+    for row in merged_station_psps_spans.itertuples(index=True, name='Pandas'):
+        span_weather_station[row.globalid] = (row.station, row.PSPS_probability, row.above_threshold_count, row.wind_speed_count)
+    return span_weather_station
+
+
+@instrument
+def propagate_upstream_stations(parent, span_weather_station):
+    """
+    Collect the weather stations upstream of every node in one pass over a span forest.
+
+    Each node is resolved after its parent and inherits the parent's results, so the total
+    work is linear in the number of nodes. Nodes on a cycle get the stations of all other
+    nodes on the cycle, as a depth-first search from them would.
+
+    Args:
+        parent (dict): Node to its upstream node, or None for the top of a feeder.
+        span_weather_station (dict): Span to its own weather station record.
+
+    Returns:
+        tuple: Dicts mapping each node to the StationChain and the frozenset of its upstream stations.
+    """
+    chains = dict()
+    station_sets = dict()
+    empty = frozenset()
+
+    def inherit(node, upstream):
+        station = span_weather_station.get(upstream)
+        if station is None:
+            chains[node] = chains[upstream]
+            station_sets[node] = station_sets[upstream]
+        else:
+            chains[node] = StationChain(station, chains[upstream])
+            upstream_set = station_sets[upstream]
+            station_sets[node] = upstream_set if station in upstream_set else upstream_set | {station}
+
+    for start in parent:
+        if start in chains:
+            continue
+
+        # Walk up until a resolved node, the top of the feeder or a cycle
+        path = []
+        on_path = dict()
+        node = start
+        while node is not None and node not in chains and node not in on_path:
+            on_path[node] = len(path)
+            path.append(node)
+            node = parent.get(node)
+
+        if node is not None and node in on_path:
+            # The walk closed a cycle: every node on it sees the rest of the cycle
+            cycle = path[on_path[node]:]
+            path = path[:on_path[node]]
+            for position, cycle_node in enumerate(cycle):
+                others = cycle[position + 1:] + cycle[:position]
+                stations = [span_weather_station[other] for other in others if other in span_weather_station]
+                chain = None
+                for station in reversed(stations):
+                    chain = StationChain(station, chain)
+                chains[cycle_node] = chain
+                station_sets[cycle_node] = frozenset(stations)
+        elif path:
+            top = path.pop()
+            if parent.get(top) is None:
+                chains[top] = None
+                station_sets[top] = empty
+            else:
+                inherit(top, parent[top])
+
+        for node in reversed(path):
+            inherit(node, parent[node])
+
+    return chains, station_sets
+
+
+@instrument
+def upstream_weather_stations(dev_wings_agg_span, G, merged_station_psps_spans):
+    """
+    Map every span to its upstream weather stations, as a list and as a unique set, in one traversal.
 
     Args:
         dev_wings_agg_span (DataFrame): Aggregated span data.
-        G (nx.DiGraph): Directed graph of spans.
+        G (nx.DiGraph or SpanNetwork): Directed graph of spans.
         merged_station_psps_spans (DataFrame): Merged station and PSPS spans data.
 
     Returns:
-        dict: Mapping of spans to unique upstream weather stations.
+        tuple: Mapping of spans to upstream weather stations (nearest first, then the span's own
+            station) and mapping of spans to the unique set of those stations.
     """
+    span_weather_station = span_weather_station_map(merged_station_psps_spans)
     upstream_weather_station_to_span = dict()
     unique_upstream_weather_stations_to_span = dict()
 
-    span_weather_station = dict()
-    for row in merged_station_psps_spans.itertuples(index=True, name='Pandas'):
-        span_weather_station[row.globalid] = (row.station, row.PSPS_probability, row.above_threshold_count, row.wind_speed_count)
+    if has_several_upstream_spans(G):
+        # Spans with more than one upstream span: trace each span separately
+        for row in dev_wings_agg_span.itertuples(index=True, name='Pandas'):
+            upstream_spans = getUpstream(G, row.globalid, 'dfs') + [row.globalid]
+            weather_stations = [span_weather_station[span] for span in upstream_spans if span in span_weather_station]
+            upstream_weather_station_to_span[row.globalid] = weather_stations
+            unique_upstream_weather_stations_to_span[row.globalid] = set(weather_stations)
+        return upstream_weather_station_to_span, unique_upstream_weather_stations_to_span
+    if isinstance(G, SpanNetwork):
+        parent = G.parent_map()
+    else:
+        parent = {node: next(iter(G.successors(node)), None) for node in G}
+
+    chains, station_sets = propagate_upstream_stations(parent, span_weather_station)
+
+    for globalid in dev_wings_agg_span['globalid']:
+        own = span_weather_station.get(globalid)
+        upstream_weather_station_to_span[globalid] = UpstreamStations(chains[globalid], own)
+        station_set = station_sets[globalid]
+        if own is not None and own not in station_set:
+            station_set = station_set | {own}
+        unique_upstream_weather_stations_to_span[globalid] = station_set
+
+    return upstream_weather_station_to_span, unique_upstream_weather_stations_to_span
 
-    for row in dev_wings_agg_span.itertuples(index=True, name='Pandas'):
-        upstream_spans = getUpstream(G, row.globalid, 'dfs') + [row.globalid]
 
-        weather_stations = [span_weather_station[span] for span in upstream_spans if span in span_weather_station]
-        upstream_weather_station_to_span[row.globalid] = weather_stations
-        unique_upstream_weather_stations_to_span[row.globalid] = set(weather_stations)
+def unique_upstream_weather_stations_to_span(dev_wings_agg_span, G, merged_station_psps_spans):
+    """
+    Map unique upstream weather stations to each span.
+
+    Args:
+        dev_wings_agg_span (DataFrame): Aggregated span data.
+        G (nx.DiGraph or SpanNetwork): Directed graph of spans.
+        merged_station_psps_spans (DataFrame): Merged station and PSPS spans data.
 
-    return unique_upstream_weather_stations_to_span
+    Returns:
+        dict: Mapping of spans to unique upstream weather stations.
+    """
+    return upstream_weather_stations(dev_wings_agg_span, G, merged_station_psps_spans)[1]
     
 def upstream_weather_stations_to_span(dev_wings_agg_span, G, merged_station_psps_spans):
     """
@@ -109,27 +319,54 @@ def upstream_weather_stations_to_span(dev_wings_agg_span, G, merged_station_psps
 
     Args:
         dev_wings_agg_span (DataFrame): Aggregated span data.
-        G (nx.DiGraph): Directed graph of spans.
+        G (nx.DiGraph or SpanNetwork): Directed graph of spans.
         merged_station_psps_spans (DataFrame): Merged station and PSPS spans data.
 
     Returns:
         dict: Mapping of spans to upstream weather stations.
     """    
-    upstream_weather_station_to_span = dict()
-    span_weather_station = dict()
-    
-    for row in merged_station_psps_spans.itertuples(index=True, name='Pandas'):
-        span_weather_station[row.globalid] = (row.station, row.PSPS_probability, row.above_threshold_count, row.wind_speed_count)
-    
-    for row in dev_wings_agg_span.itertuples(index=True, name='Pandas'):
-        upstream_spans = getUpstream(G, row.globalid, 'dfs') + [row.globalid]
-    
-        weather_stations = [span_weather_station[span] for span in upstream_spans if span in span_weather_station]
-        upstream_weather_station_to_span[row.globalid] = weather_stations
-    return upstream_weather_station_to_span
+    return upstream_weather_stations(dev_wings_agg_span, G, merged_station_psps_spans)[0]
+
 
 
+@instrument
+def span_station_incidence(dev_wings_agg_span, G, merged_station_psps_spans):
+    """
+    Build the sparse span x station incidence of the stations upstream of each span.
+
+    Row i counts the stations of span i's upstream_weather_stations list. Span forests are
+    built level by level from the parent pointers; networks with cycles or spans with
+    several upstream spans fall back to the lists.
 
+    Args:
+        dev_wings_agg_span (DataFrame): Aggregated span data.
+        G (nx.DiGraph or SpanNetwork): Directed graph of spans.
+        merged_station_psps_spans (DataFrame): Merged station and PSPS spans data.
+
+    Returns:
+        SpanStationIncidence: One row per span, in the order of the span data.
+    """
+    spans = pd.unique(dev_wings_agg_span['globalid'].to_numpy(dtype=object))
+    incidence = None
+    if not has_several_upstream_spans(G):
+        if isinstance(G, SpanNetwork):
+            ids, parent = G.ids, G.parent
+        else:
+            ids = list(G)
+            parent = pd.Index(ids, dtype=object).get_indexer(
+                pd.Index([next(iter(G.successors(node)), None) for node in ids], dtype=object))
+        # A span listed in several rows keeps the station of its last row, as span_weather_station_map does
+        own = merged_station_psps_spans.drop_duplicates('globalid', keep='last')
+        rows = pd.Index(own['globalid'].to_numpy(dtype=object)).get_indexer(pd.Index(ids, dtype=object))
+        node_station = pd.Series(own['station'].to_numpy(dtype=object)).reindex(rows).to_numpy()
+        incidence = SpanStationIncidence.from_parent(ids, parent, node_station, spans)
+    if incidence is None:
+        incidence = SpanStationIncidence.from_upstream_map(upstream_weather_stations(dev_wings_agg_span, G, merged_station_psps_spans)[0])
+    return incidence
+
+
+
+@instrument
 def calculate_span_PSPS_probability(associated_stations, merged_data):
     """
     Calculate the PSPS probability for a span.
@@ -164,6 +401,46 @@ def calculate_span_PSPS_probability(associated_stations, merged_data):
     return above_threshold_count/wind_speed_count
 
 
+@instrument
+def calculate_span_PSPS_probabilities(stations_to_span, merged_data, n_workers=1, store_dir=None):
+    """
+    Calculate the PSPS probability of every span from one station x date exceedance matrix.
+
+    Gives the same numbers as calling calculate_span_PSPS_probability for each span, but
+    computes each distinct station set only once. With several workers the matrix is saved
+    to `store_dir` and the worker processes memory-map it instead of receiving the data.
+
+    Args:
+        stations_to_span (dict): Mapping of spans to their associated stations.
+        merged_data (DataFrame): Merged weather station data.
+        n_workers (int): Number of worker processes; 1 computes in this process.
+        store_dir (str): Directory for the shared exceedance store, required with several workers.
+
+    Returns:
+        dict: Mapping of spans to PSPS probabilities.
+    """
+    matrix = ExceedanceMatrix.from_merged_data(merged_data)
+    if n_workers is None or n_workers > 1:
+        return parallel_span_probabilities(matrix.save(store_dir), stations_to_span, n_workers)
+    return matrix.span_probabilities(stations_to_span)
+
+
+@instrument
+def annual_customer_counts(spans):
+    """
+    Expected customers affected per year for every span, as one column expression.
+
+    Args:
+        spans (DataFrame): Span data with 'probability', 'expected_fire' and 'cust_total'.
+
+    Returns:
+        pd.Series: Annual customers affected per span.
+    """
+    annual_probability = 1 - (1 - spans['probability']) ** spans['expected_fire']
+    return annual_probability * spans['cust_total']
+
+
+@instrument
 def calculate_annual_customer_count(row):
     annual_probability = 1 - (1 - row['probability']) ** row['expected_fire']
     annual_customers_affected = annual_probability * row['cust_total']
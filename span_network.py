@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+
+
+class SpanNetwork:
+    """
+    Compact span network backed by NumPy arrays.
+
+    Span ids are encoded as integers. Each node has one parent (its upstream span, or -1 at
+    the top of a feeder) and its children are stored in CSR form. Traversals and loading
+    only touch these arrays, so a utility-scale network needs a few bytes per span.
+
+    A span listed in several rows with different upstream spans keeps the first as its
+    parent and the others in `extra_parents`, so traversals see every edge the networkx
+    graph has. Such networks are not span forests.
+
+    Args:
+        ids (np.ndarray): Span id of each node.
+        parent (np.ndarray): Node code of each node's upstream span, or -1.
+        child_indptr (np.ndarray): CSR row pointer of the child lists.
+        child_indices (np.ndarray): CSR child node codes.
+        extra_parents (dict): Node code to the codes of its further upstream spans.
+    """
+
+    def __init__(self, ids, parent, child_indptr, child_indices, extra_parents=None):
+        self.ids = ids
+        self.parent = parent
+        self.child_indptr = child_indptr
+        self.child_indices = child_indices
+        self.extra_parents = dict(extra_parents or {})
+        self.index = pd.Index(ids)
+
+    @classmethod
+    def from_spans(cls, dev_wings_agg_span):
+        """
+        Build the network from the span table without a per-row loop.
+
+        Nodes are the span ids followed by any upstream ids that are not spans themselves.
+        Each row adds an edge from its span to its upstream span, once per pair, in row order
+        as formSpanNet adds them to the networkx graph. A span's first upstream span is its
+        parent. Missing upstream ids mark the top of a feeder.
+
+        Args:
+            dev_wings_agg_span (DataFrame): Aggregated span data with 'globalid' and 'upstream_span_id'.
+
+        Returns:
+            SpanNetwork: The span network.
+        """
+        globalid = dev_wings_agg_span['globalid'].to_numpy(dtype=object)
+        upstream = dev_wings_agg_span['upstream_span_id'].to_numpy(dtype=object)
+        codes, ids = pd.factorize(np.concatenate([globalid, upstream]))
+        span_codes = codes[:len(globalid)]
+        upstream_codes = codes[len(globalid):]
+
+        # Edges in row order, each (span, upstream) pair once
+        rows = np.nonzero((span_codes >= 0) & (upstream_codes >= 0))[0]
+        pairs = span_codes[rows].astype(np.int64) * len(ids) + upstream_codes[rows]
+        first = np.sort(np.unique(pairs, return_index=True)[1])
+        child, upstream_node = span_codes[rows][first].astype(np.int64), upstream_codes[rows][first].astype(np.int64)
+
+        parent = np.full(len(ids), -1, dtype=np.int64)
+        is_parent = np.zeros(len(child), dtype=bool)
+        is_parent[np.unique(child, return_index=True)[1]] = True
+        parent[child[is_parent]] = upstream_node[is_parent]
+        extra_parents = dict()
+        for node, other in zip(child[~is_parent].tolist(), upstream_node[~is_parent].tolist()):
+            extra_parents.setdefault(node, []).append(other)
+
+        # Children of a node in the order their edges were added
+        order = np.lexsort((np.arange(len(child)), upstream_node))
+        counts = np.bincount(upstream_node, minlength=len(ids))
+        child_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(cls.compact_ids(ids), parent, child_indptr, child[order], extra_parents)
+
+    @staticmethod
+    def children_csr(parent):
+        """
+        Invert a parent-pointer array into CSR child adjacency.
+
+        Args:
+            parent (np.ndarray): Parent node code of each node, or -1.
+
+        Returns:
+            tuple: Row pointer and child node codes, children in node order.
+        """
+        children = np.nonzero(parent >= 0)[0]
+        children = children[np.argsort(parent[children], kind='stable')]
+        counts = np.bincount(parent[parent >= 0], minlength=len(parent))
+        child_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return child_indptr, children.astype(np.int64)
+
+    @staticmethod
+    def compact_ids(ids):
+        """Store the ids as a fixed-width string array when they are all strings."""
+        ids = np.asarray(ids, dtype=object)
+        if len(ids) and all(isinstance(span_id, str) for span_id in ids):
+            return ids.astype(str)
+        return ids
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __contains__(self, span_id):
+        return span_id in self.index
+
+    def codes(self, span_ids):
+        """
+        Encode span ids as node codes.
+
+        Args:
+            span_ids (array-like): Span ids.
+
+        Returns:
+            np.ndarray: Node codes, -1 for unknown ids.
+        """
+        return self.index.get_indexer(pd.Index(span_ids, dtype=object))
+
+    def code(self, span_id):
+        """Encode a single span id, raising KeyError if it is not in the network."""
+        return self.index.get_loc(span_id)
+
+    def parent_map(self):
+        """
+        Map each span id to its upstream span id.
+
+        Returns:
+            dict: Span id to upstream span id, or None at the top of a feeder.
+        """
+        ids = self.ids.tolist()
+        return {span_id: (ids[code] if code >= 0 else None) for span_id, code in zip(ids, self.parent.tolist())}
+
+    def upstream_nodes(self, node):
+        """Node codes of the upstream spans of a node, its parent first."""
+        nodes = [int(self.parent[node])] if self.parent[node] >= 0 else []
+        return nodes + self.extra_parents.get(node, [])
+
+    def upstream(self, span_id):
+        """
+        List the spans upstream of a span, nearest first, as getUpstream does.
+
+        In a span forest this is the chain of parents. With several upstream spans it follows
+        getUpstream's depth-first search: the first span reached from each span on the search tree.
+
+        Args:
+            span_id: Starting span id.
+
+        Returns:
+            list: Upstream span ids.
+        """
+        node = self.code(span_id)
+        visited = {node}
+        upstream = []
+        if not self.extra_parents:
+            node = self.parent[node]
+            while node >= 0 and node not in visited:
+                visited.add(node)
+                upstream.append(node)
+                node = self.parent[node]
+        else:
+            # nx.dfs_successors, keeping the first successor of each search tree node
+            successors = dict()
+            stack = [(node, iter(self.upstream_nodes(node)))]
+            while stack:
+                source, others = stack[-1]
+                for other in others:
+                    if other not in visited:
+                        visited.add(other)
+                        successors.setdefault(source, other)
+                        stack.append((other, iter(self.upstream_nodes(other))))
+                        break
+                else:
+                    stack.pop()
+            upstream = list(successors.values())
+        # Plain Python ids, not NumPy strings
+        return self.ids[upstream].tolist()
+
+    def downstream(self, span_id):
+        """
+        List the spans fed through a span, in depth-first order, as getDownstream does.
+
+        Args:
+            span_id: Starting span id.
+
+        Returns:
+            list: Downstream span ids.
+        """
+        start = self.code(span_id)
+        visited = {start}
+        downstream = []
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            if node != start:
+                downstream.append(node)
+            children = self.child_indices[self.child_indptr[node]:self.child_indptr[node + 1]].tolist()
+            for child in reversed(children):
+                if child not in visited:
+                    visited.add(child)
+                    stack.append(child)
+        return self.ids[downstream].tolist()
+
+    def save(self, path):
+        """
+        Save the network arrays to a NumPy .npz file.
+
+        Args:
+            path (str): Destination file.
+
+        Returns:
+            str: Path to the saved file.
+        """
+        extra_child = np.asarray([node for node, others in self.extra_parents.items() for _ in others], dtype=np.int64)
+        extra_parent = np.asarray([other for others in self.extra_parents.values() for other in others], dtype=np.int64)
+        np.savez(path, ids=self.ids, parent=self.parent, child_indptr=self.child_indptr, child_indices=self.child_indices,
+                 extra_child=extra_child, extra_parent=extra_parent)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a network saved with `save`.
+
+        Args:
+            path (str): Path to the .npz file.
+
+        Returns:
+            SpanNetwork: The span network.
+        """
+        # Non-string span ids are stored as an object array
+        with np.load(path, allow_pickle=True) as arrays:
+            extra_parents = dict()
+            if 'extra_child' in arrays:
+                for node, other in zip(arrays['extra_child'].tolist(), arrays['extra_parent'].tolist()):
+                    extra_parents.setdefault(node, []).append(other)
+            return cls(arrays['ids'], arrays['parent'], arrays['child_indptr'], arrays['child_indices'], extra_parents)
@@ -0,0 +1,224 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from data_cache import cache_paths, is_cache_valid, temporary_path, write_cache_meta
+from geo_store import crs_tag, geometry_from_wkt
+from profiling import instrument
+
+
+class SpatialIndex:
+    """
+    STRtree over a set of geometries, with their ids, that can be saved next to the data.
+
+    The geometries are stored as one WKB buffer with offsets, sorted along a Hilbert curve of
+    their bounding boxes, so loading is one vectorized decode and the tree is bulk-loaded from
+    spatially ordered input. Query results refer to positions in the original order.
+
+    Args:
+        geometries (np.ndarray): Shapely geometries, in index order.
+        ids (np.ndarray): Id of each geometry.
+        positions (np.ndarray): Original row position of each geometry.
+        crs (str): WKT of the geometries' CRS, or None.
+    """
+
+    def __init__(self, geometries, ids, positions, crs=None):
+        self.geometries = geometries
+        self.ids = ids
+        self.positions = positions
+        self.crs = crs
+        self.tree = shapely.STRtree(geometries)
+
+    @classmethod
+    def from_geodataframe(cls, gdf, id_column):
+        """
+        Index the geometries of a GeoDataFrame.
+
+        Args:
+            gdf (gpd.GeoDataFrame): Geometries to index; empty and missing ones are left out.
+            id_column (str): Column with the id of each geometry.
+
+        Returns:
+            SpatialIndex: The index.
+        """
+        geometries = gdf.geometry.to_numpy()
+        positions = np.nonzero(~(shapely.is_missing(geometries) | shapely.is_empty(geometries)))[0]
+        order = positions[np.argsort(gdf.geometry.iloc[positions].hilbert_distance(), kind='stable')]
+        crs = gdf.crs.to_wkt() if gdf.crs is not None else None
+        return cls(geometries[order], gdf[id_column].to_numpy(dtype=object)[order], order, crs)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def save(self, path):
+        """
+        Save the index to a NumPy .npz file without pickled objects.
+
+        Args:
+            path (str): Destination file.
+
+        Returns:
+            str: Path to the saved file.
+        """
+        wkb = shapely.to_wkb(self.geometries)
+        lengths = np.fromiter((len(blob) for blob in wkb), dtype=np.int64, count=len(wkb))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        buffer = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+        meta = json.dumps({'crs': self.crs})
+        np.savez(path, wkb=buffer, offsets=offsets, ids=self.ids.astype(str), positions=self.positions,
+                 meta=np.frombuffer(meta.encode(), dtype=np.uint8))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with `save`.
+
+        Args:
+            path (str): Path to the .npz file.
+
+        Returns:
+            SpatialIndex: The index.
+        """
+        with np.load(path) as arrays:
+            buffer = arrays['wkb'].tobytes()
+            offsets = arrays['offsets']
+            blobs = np.array([buffer[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())], dtype=object)
+            meta = json.loads(arrays['meta'].tobytes().decode())
+            return cls(shapely.from_wkb(blobs), arrays['ids'].astype(object), arrays['positions'], meta['crs'])
+
+    def prepare(self, geometries):
+        """Turn query input into a geometry array in the index CRS."""
+        if isinstance(geometries, gpd.GeoSeries):
+            if geometries.crs is not None and self.crs is not None:
+                geometries = geometries.to_crs(self.crs)
+            return geometries.to_numpy()
+        if isinstance(geometries, pd.Series) and geometries.dtype == object and len(geometries) and isinstance(geometries.iloc[0], str):
+            return geometry_from_wkt(geometries).to_numpy()
+        return np.asarray(geometries, dtype=object)
+
+    def pairs(self, input_positions, tree_positions, extra=None):
+        """Query results as a frame of input positions and matching ids and rows, in input order."""
+        order = np.lexsort((self.positions[tree_positions], input_positions))
+        result = pd.DataFrame({
+            'input': input_positions[order],
+            'id': self.ids[tree_positions[order]],
+            'position': self.positions[tree_positions[order]],
+        })
+        for name, values in (extra or {}).items():
+            result[name] = values[order]
+        return result
+
+    @instrument
+    def query(self, geometries, predicate='intersects'):
+        """
+        Find the indexed geometries related to each query geometry.
+
+        Args:
+            geometries (array-like or gpd.GeoSeries): Query geometries.
+            predicate (str): Relation of the query geometry to the indexed one, as in STRtree.query.
+
+        Returns:
+            pd.DataFrame: 'input' (query position), 'id' and 'position' (row of the indexed data).
+        """
+        input_positions, tree_positions = self.tree.query(self.prepare(geometries), predicate=predicate)
+        return self.pairs(input_positions, tree_positions)
+
+    def containing(self, points):
+        """Polygons containing each point, with the 'within' predicate of the VRI join."""
+        return self.query(points, predicate='within')
+
+    def intersecting(self, geometries):
+        """Indexed geometries intersecting each query geometry."""
+        return self.query(geometries, predicate='intersects')
+
+    @instrument
+    def nearest(self, geometries, max_distance=None):
+        """
+        Nearest indexed geometry to each query geometry.
+
+        Args:
+            geometries (array-like or gpd.GeoSeries): Query geometries.
+            max_distance (float): Only match within this distance, in CRS units.
+
+        Returns:
+            pd.DataFrame: 'input', 'id', 'position' and 'distance'; ties give several rows.
+        """
+        (input_positions, tree_positions), distances = self.tree.query_nearest(
+            self.prepare(geometries), max_distance=max_distance, return_distance=True)
+        return self.pairs(input_positions, tree_positions, {'distance': distances})
+
+
+@instrument
+def load_spatial_index(file_path, name, build, id_column, target_crs=None, cache_dir=None):
+    """
+    Load the spatial index of a dataset, building and persisting it on first use.
+
+    The index is stored next to the dataset's cache and rebuilt when the source file changes,
+    like the geometry store, and is renamed into place before its metadata is written.
+
+    Args:
+        file_path (str): Path to the source CSV file.
+        name (str): Name of the dataset, used in the stored file name.
+        build (callable): Function returning the GeoDataFrame to index, already in `target_crs`.
+        id_column (str): Column with the id of each geometry.
+        target_crs: CRS of the geometries, or None for the source CRS.
+        cache_dir (str): Cache directory. Defaults to a `cache` folder next to the source file.
+
+    Returns:
+        SpatialIndex: The index.
+    """
+    store_path, meta_path = cache_paths(file_path, cache_dir, variant=f"{name}-index-{crs_tag(target_crs)}")
+    index_path = os.path.splitext(store_path)[0] + '.npz'
+    if os.path.exists(index_path) and is_cache_valid(file_path, meta_path):
+        return SpatialIndex.load(index_path)
+
+    index = SpatialIndex.from_geodataframe(build(), id_column)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temporary = temporary_path(index_path)
+    index.save(temporary)
+    os.replace(temporary, index_path)
+    write_cache_meta(file_path, meta_path)
+    return index
+
+
+def vri_index(vri_path):
+    """Spatial index of the VRI polygons, in their own CRS."""
+    from data_vri_conductor import process_vri_data
+    return load_spatial_index(vri_path, 'vri', lambda: process_vri_data(vri_path), 'globalid')
+
+
+def span_index(conductor_path, target_crs=None):
+    """Spatial index of the conductor spans, reprojected to `target_crs` (e.g. the VRI CRS)."""
+    from data_vri_conductor import process_conductor_data
+    return load_spatial_index(conductor_path, 'conductor', lambda: process_conductor_data(conductor_path, target_crs),
+                              'globalid', target_crs)
+
+
+def station_index(gis_path, target_crs=None):
+    """Spatial index of the weather station points, reprojected to `target_crs`."""
+    from etl import load_data
+
+    def build():
+        stations = load_data(gis_path, schema='gis_weatherstation')
+        stations['geometry'] = geometry_from_wkt(stations['shape'])
+        stations = gpd.GeoDataFrame(stations, geometry='geometry', crs=f"EPSG:{stations['shape_srid'].iloc[0]}")
+        return stations.to_crs(target_crs) if target_crs is not None else stations
+
+    return load_spatial_index(gis_path, 'stations', build, 'weatherstationcode', target_crs)
+
+
+if __name__ == "__main__":
+    # python spatial_index.py: build (or check) the VRI, span and station indexes of data-params.json
+    import time
+
+    with open('data-params.json', 'r') as fh:
+        data_sources = json.load(fh)['data_sources']
+    start = time.perf_counter()
+    vri = vri_index(data_sources['src_vri_snapshot'])
+    spans = span_index(data_sources['dev_wings_agg_span'], vri.crs)
+    stations = station_index(data_sources['gis_weatherstation'], vri.crs)
+    print(f"{len(vri)} VRI polygons, {len(spans)} spans and {len(stations)} stations indexed "
+          f"in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,151 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from profiling import instrument
+
+# Predicates that can only hold when the bounding boxes of both geometries intersect
+BBOX_PREDICATES = {
+    'intersects', 'within', 'contains', 'contains_properly', 'overlaps',
+    'crosses', 'touches', 'covers', 'covered_by',
+}
+
+
+def partition_tiles(gdf, n_tiles):
+    """
+    Split a GeoDataFrame into spatially compact tiles of roughly equal size.
+
+    Geometries are assigned by the centre of their bounding box: first to vertical
+    stripes by x, then within each stripe to tiles by y. Every row ends up in exactly one tile.
+
+    Args:
+        gdf (gpd.GeoDataFrame): Geometries to partition.
+        n_tiles (int): Approximate number of tiles.
+
+    Returns:
+        list: Arrays of row positions, one per non-empty tile.
+    """
+    bounds = gdf.geometry.bounds.to_numpy()
+    center_x = np.nan_to_num((bounds[:, 0] + bounds[:, 2]) / 2)
+    center_y = np.nan_to_num((bounds[:, 1] + bounds[:, 3]) / 2)
+
+    n_stripes = max(int(np.ceil(np.sqrt(n_tiles))), 1)
+    x_order = np.argsort(center_x, kind='stable')
+    tiles = []
+    for stripe in np.array_split(x_order, n_stripes):
+        stripe = stripe[np.argsort(center_y[stripe], kind='stable')]
+        tiles.extend(tile for tile in np.array_split(stripe, n_stripes) if len(tile) > 0)
+    return tiles
+
+
+def serial_match_rank(right, predicate):
+    """
+    Rank right rows in the order `gpd.sjoin` lists the matches of a single left row.
+
+    For 'within', matches are sorted by right row position. For the other predicates they
+    come out in the traversal order of the spatial index of `right`, which is the order in
+    which a query covering the whole extent returns the indexed geometries. That order is a
+    detail of shapely's STRtree, pinned against `gpd.sjoin` by tests/test_spatial_join.py.
+
+    Args:
+        right (gpd.GeoDataFrame): Right GeoDataFrame of the join.
+        predicate (str): Binary predicate of the join.
+
+    Returns:
+        np.ndarray: Sort key for each right row position.
+    """
+    if predicate == 'within':
+        return np.arange(len(right))
+    rank = np.full(len(right), len(right), dtype=np.int64)
+    if right.sindex:
+        traversal = right.sindex.query(box(*right.total_bounds))
+        rank[traversal] = np.arange(len(traversal))
+    return rank
+
+
+def sjoin_tile(job):
+    """
+    Run one tile of a partitioned spatial join. Executed in a worker process.
+
+    Args:
+        job (tuple): Left and right GeoDataFrames of the tile and the predicate.
+
+    Returns:
+        gpd.GeoDataFrame: Joined rows, indexed by left row position with right row positions in the index column.
+    """
+    left, right, predicate = job
+    return gpd.sjoin(left, right, how='inner', predicate=predicate)
+
+
+@instrument
+def parallel_sjoin(left, right, predicate='intersects', n_workers=None, partition='right', min_tile_rows=1000):
+    """
+    Inner spatial join of two GeoDataFrames, spread over a process pool.
+
+    The `partition` side is split into spatial tiles. Each tile is joined with the rows of
+    the other side whose bounding boxes touch the tile's extent. Since every row of the
+    partitioned side is in exactly one tile, a geometry that crosses tile boundaries is
+    matched once per partner, never twice. The tile results are put back in the order
+    `gpd.sjoin` produces: by left row, then in the serial join's match order. The output
+    is therefore the same as the serial join.
+
+    Args:
+        left (gpd.GeoDataFrame): Left GeoDataFrame.
+        right (gpd.GeoDataFrame): Right GeoDataFrame.
+        predicate (str): Binary predicate, as in `gpd.sjoin`.
+        n_workers (int): Number of worker processes. Defaults to the number of CPUs.
+        partition (str): Side to split into tiles, 'left' or 'right'. Pick the larger side.
+        min_tile_rows (int): Minimum rows per tile; smaller inputs are joined serially.
+
+    Returns:
+        gpd.GeoDataFrame: Result identical to `gpd.sjoin(left, right, how='inner', predicate=predicate)`.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if partition not in ('left', 'right'):
+        raise ValueError('Invalid partition: Use "left" or "right".')
+
+    partitioned = right if partition == 'right' else left
+    n_tiles = min(n_workers * 4, len(partitioned) // max(min_tile_rows, 1))
+    serial = (
+        n_workers <= 1 or n_tiles <= 1 or predicate not in BBOX_PREDICATES
+        or left.index.nlevels > 1 or right.index.nlevels > 1
+    )
+    if serial:
+        return gpd.sjoin(left, right, how='inner', predicate=predicate)
+
+    # Positional indexes (keeping the index names) so tile results can be ordered and relabelled
+    left_positional = left.set_axis(pd.RangeIndex(len(left), name=left.index.name))
+    right_positional = right.set_axis(pd.RangeIndex(len(right), name=right.index.name))
+    other = left_positional if partition == 'right' else right_positional
+
+    jobs = []
+    for tile in partition_tiles(partitioned, n_tiles):
+        tile_gdf = (right_positional if partition == 'right' else left_positional).iloc[tile]
+        candidates = np.sort(other.sindex.query(box(*tile_gdf.total_bounds)))
+        if len(candidates) == 0:
+            continue
+        other_gdf = other.iloc[candidates]
+        if partition == 'right':
+            jobs.append((other_gdf, tile_gdf, predicate))
+        else:
+            jobs.append((tile_gdf, other_gdf, predicate))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pieces = [piece for piece in executor.map(sjoin_tile, jobs) if len(piece) > 0]
+    if not pieces:
+        return gpd.sjoin(left, right, how='inner', predicate=predicate)
+
+    joined = pd.concat(pieces)
+    right_index_column = joined.columns[len(left.columns)]
+    left_positions = joined.index.to_numpy()
+    right_positions = joined[right_index_column].to_numpy()
+    order = np.lexsort((serial_match_rank(right, predicate)[right_positions], left_positions))
+
+    joined = joined.iloc[order]
+    # Keep the index name sjoin gave the tiles, e.g. 'row_left' when both sides share a name
+    joined.index = left.index.take(left_positions[order]).rename(joined.index.name)
+    joined[right_index_column] = right.index.take(right_positions[order])
+    return joined
@@ -0,0 +1,403 @@
+import numpy as np
+import os
+import pandas as pd
+from pipeline import Stage
+
+# Each stage imports its modules when it runs, so a target only loads the geospatial, graph
+# and sparse libraries it needs. Stage.load reads those imports from the function's source.
+
+
+def save_output(config, df, output_dir, name):
+    """
+    Save a stage output table with the format, compression and partitioning of `output_tables`.
+
+    Args:
+        config (dict): Pipeline configuration.
+        df (pd.DataFrame): Table to save.
+        output_dir (str): Directory of the table.
+        name (str): Table name, also its key in `output_tables.partition_by`.
+
+    Returns:
+        str: Path of the table file or directory.
+    """
+    from etl import save_data
+    tables = config['parameters'].get('output_tables', {})
+    return save_data(df, output_dir, f"{name}.{tables.get('format', 'csv')}",
+                     tables.get('partition_by', {}).get(name), tables.get('compression', 'snappy'),
+                     tables.get('row_group_size'))
+
+
+def merge_stage(config, inputs):
+    """
+    Merge raw datasets of gis, station summary and wind speeds.
+
+    Returns:
+        pd.DataFrame or str: The merged data, or with `merge_memory_budget_mb` the path of the
+            streamed table. Downstream stages read a streamed table chunk by chunk.
+    """
+    from etl import merge_weather_data, stream_merge_weather_data
+    print("Merging raw datasets...")
+    gis_path = config['data_sources']['gis_weatherstation']
+    station_summary_path = config['data_sources']['station_summary_snapshot']
+    windspeed_path = config['data_sources']['windspeed_snapshot']
+    memory_budget_mb = config['parameters'].get('merge_memory_budget_mb')
+    if memory_budget_mb:
+        # Stream the windspeed snapshot in bounded chunks; the table is not loaded back at once
+        tables = config['parameters'].get('output_tables', {})
+        merged_path = stream_merge_weather_data(gis_path, station_summary_path, windspeed_path,
+                                                config['parameters']['merged_weather_output'], memory_budget_mb,
+                                                tables.get('partition_by', {}).get('merged_weather'),
+                                                tables.get('compression', 'snappy'), tables.get('row_group_size'))
+        print(f"Data processing completed. Merged weather data saved to {merged_path}.")
+        return merged_path
+    merged_data = merge_weather_data(gis_path, station_summary_path, windspeed_path)
+    print("Data processing completed. Merged weather data saved.")
+    print("Preview of merged weather data:")
+    return merged_data
+
+
+def psps_stage(config, inputs):
+    """Calculate PSPS probabilities for weather stations."""
+    from etl import load_data
+    from psps import calculate_psps_probability
+    print("Calculating PSPS probabilities...")
+    gis_weather_station = load_data(config['data_sources']['gis_weatherstation'], schema='gis_weatherstation')
+    weather_station_psps = calculate_psps_probability(
+        inputs['merge'], gis_weather_station, config['parameters']['psps_condition']
+    )
+    print(f"PSPS probabilities calculated for {len(weather_station_psps)} stations.")
+    print("Preview of PSPS probabilities:")
+    print(weather_station_psps.head())
+    return weather_station_psps
+
+
+def update_psps_stage(config, inputs):
+    """Fold new wind speed readings into the persisted per-station counts."""
+    from data_cache import file_hash
+    from etl import load_data
+    from psps_state import StationAggregateState
+    print("Updating PSPS probabilities with new wind speed readings...")
+    state_dir = config['parameters']['psps_state_dir']
+    if os.path.exists(os.path.join(state_dir, 'state.json')):
+        state = StationAggregateState.load(state_dir)
+    else:
+        state = StationAggregateState.from_sources(config['data_sources']['gis_weatherstation'],
+                                                   config['data_sources']['station_summary_snapshot'],
+                                                   config['data_sources']['windspeed_snapshot'])
+    update_path = config['data_sources']['windspeed_update']
+    # The batch is identified by the hash of its file, so re-running with the same file counts nothing
+    batch_id = file_hash(update_path)
+    if batch_id in state.applied_batches:
+        print(f"{update_path} was already applied; no new readings counted.")
+    else:
+        added = state.update(load_data(update_path, use_cache=False, schema='windspeed_snapshot'), batch_id)
+        state.save(state_dir)
+        print(f"{len(added)} new readings counted for {added['weatherstationcode'].nunique()} stations.")
+    weather_station_psps = state.psps_probability(load_data(config['data_sources']['gis_weatherstation'], schema='gis_weatherstation'),
+                                                  config['parameters']['psps_condition'])
+    print("Preview of PSPS probabilities:")
+    print(weather_station_psps.head())
+    return weather_station_psps
+
+
+def update_span_psps_stage(config, inputs):
+    """
+    Fold new wind speed readings into the persisted span PSPS probabilities.
+
+    Returns:
+        pd.DataFrame: 'span' and 'probability' of every span, highest probability first.
+    """
+    from data_cache import file_hash
+    from etl import load_data
+    from psps_state import SpanAggregateState
+    print("Updating span PSPS probabilities with new wind speed readings...")
+    state_dir = config['parameters']['psps_span_state_dir']
+    if os.path.exists(os.path.join(state_dir, 'state.json')):
+        state = SpanAggregateState.load(state_dir)
+    else:
+        state = SpanAggregateState.from_sources(config['data_sources']['gis_weatherstation'],
+                                                config['data_sources']['station_summary_snapshot'],
+                                                config['data_sources']['windspeed_snapshot'])
+    update_path = config['data_sources']['windspeed_update']
+    batch_id = file_hash(update_path)
+    if batch_id in state.stations.applied_batches:
+        print(f"{update_path} was already applied; no new readings counted.")
+    # Only spans downstream of the stations the batch touched are recomputed, unless the network changed
+    # The network key and the spans of each station come with the analyze_spans checkpoint
+    span_analysis = inputs['analyze_spans']
+    updated = state.update(load_data(update_path, use_cache=False, schema='windspeed_snapshot'),
+                           span_analysis['unique_upstream_stations'], batch_id,
+                           span_analysis['network_key'], span_analysis['station_spans'])
+    state.save(state_dir)
+    print(f"PSPS probabilities recomputed for {len(updated)} spans.")
+    span_probabilities = pd.DataFrame(list(state.span_probabilities.items()), columns=['span', 'probability'])
+    span_probabilities = span_probabilities.sort_values('probability', ascending=False, kind='stable').reset_index(drop=True)
+    print(span_probabilities.head())
+    return span_probabilities
+
+
+def filter_stage(config, inputs):
+    """Filter weather stations with the highest PSPS risk given a min threshold."""
+    from top_psps import filter_top_psps_stations
+    print("Filtering top PSPS stations...")
+    top_stations = filter_top_psps_stations(
+        inputs['psps'], config['parameters']['min_alert_threshold']
+    )
+    print(f"Filtered {len(top_stations)} high-risk PSPS stations.")
+    print("Preview of top PSPS stations:")
+    print(top_stations.head())
+    return top_stations
+
+
+def merge_vri_stage(config, inputs):
+    """Merge VRI (Vegetation Resource Inventory) and conductor data."""
+    from data_vri_conductor import merge_psps_conductor_vri
+    print("Merging VRI and conductor data...")
+    vri_path = config['data_sources']['src_vri_snapshot']
+    conductor_path = config['data_sources']['dev_wings_agg_span']
+    conductor_vri_psps = merge_psps_conductor_vri(conductor_path, vri_path, inputs['psps'],
+                                                  config['parameters'].get('sjoin_workers'),
+                                                  config['parameters'].get('sjoin_state_dir'),
+                                                  config['parameters'].get('verify_sjoin', False))
+    print(f"Merged VRI and conductor data saved. Total rows: {len(conductor_vri_psps)}.")
+    print("Preview of merged VRI-conductor data:")
+    print(conductor_vri_psps.head())
+    return conductor_vri_psps
+
+
+def analyze_spans_stage(config, inputs):
+    """
+    Analyze spans and calculate probabilities.
+
+    Returns:
+        dict: 'spans' (span data with 'probability' and 'expected_fire'), 'span_network',
+            'unique_upstream_stations', 'network_key', 'station_spans', 'station_incidence'
+            and 'span_probabilities'.
+    """
+    from etl import load_data
+    from data_vri_conductor import process_conductor_data
+    from span_analysis import (
+        formSpanNet,
+        upstream_weather_stations,
+        span_station_incidence,
+        calculate_span_PSPS_probabilities
+    )
+    from rollup import HierarchyRollup
+    from psps_state import network_key, spans_by_station
+    merged_data = inputs['merge']
+
+    # Process conductor data into a GeoDataFrame
+    dev_wings_agg_span = process_conductor_data(config['data_sources']['dev_wings_agg_span'])
+
+    # Form a directed graph based on conductor spans
+    G, merged_station_psps_spans = formSpanNet(merged_data, dev_wings_agg_span,
+                                               config['parameters'].get('span_network_backend', 'networkx'))
+
+    # Identify unique upstream weather stations associated with each span
+    uniqueUpsteamWStoSpan = upstream_weather_stations(dev_wings_agg_span, G, merged_station_psps_spans)[1]
+    # Sparse span x station counts of the full upstream lists, for span-level station aggregates
+    incidence = span_station_incidence(dev_wings_agg_span, G, merged_station_psps_spans)
+
+    # Find the span with the highest number of upstream weather stations
+    station_counts = incidence.distinct_counts()
+    highest_weather_station_count = station_counts.max()
+    greatest_weather_station_impact = station_counts.index[station_counts == highest_weather_station_count]
+
+    print("Highest Num of Stations Per Span: ", highest_weather_station_count)
+    print("Example Span: ", greatest_weather_station_impact[0])
+    print("Num of Spans with max Stations: ", len(greatest_weather_station_impact))
+
+    # Calculate probabilities for each span
+    # With several span workers, the workers share a memory-mapped copy of the exceedance matrix
+    new_span_probabilities = calculate_span_PSPS_probabilities(uniqueUpsteamWStoSpan, merged_data,
+                                                               config['parameters'].get('span_workers', 1),
+                                                               config['parameters'].get('exceedance_store', './data/exceedance'))
+
+    # Sort spans by probability and create a DataFrame
+    span_with_new_prob = dict(sorted(new_span_probabilities.items(), key=lambda item: item[1], reverse=True))
+    span_with_new_prob_df = pd.DataFrame(list(span_with_new_prob.items()), columns=['span', 'probability'])
+    print(span_with_new_prob_df)
+
+    #Parent feeder_id 222 exploration
+    #Segment data retrieval
+    dev_wings_agg_span_with_probabilities = dev_wings_agg_span.merge(span_with_new_prob_df, left_on='globalid', right_on='span')
+
+    # Feeder (segment) and circuit data retrieval, both levels in one pass
+    rollups = HierarchyRollup(dev_wings_agg_span_with_probabilities).aggregate()
+    segment_data = rollups['feeder']
+    circuit_data = rollups['circuit']
+    feeder_id = config['parameters']['parent_feeder_id']
+    circuit_idx = config['parameters']['circuit_data_idx']
+
+    print(segment_data[segment_data.index == feeder_id])
+
+    print(circuit_data[circuit_data.index == circuit_idx])
+
+    windspeed_snapshot_copy = load_data(config['data_sources']['windspeed_snapshot'], columns=['station', 'date'], schema='windspeed_snapshot')
+    windspeed_snapshot_copy["date"] = pd.to_datetime(windspeed_snapshot_copy["date"])
+    windspeed_snapshot_copy["year"] = windspeed_snapshot_copy["date"].dt.year
+
+    station_stats = windspeed_snapshot_copy.groupby("station", observed=True)["year"].agg(['min', 'max', 'count'])
+    station_stats["duration"] = station_stats["max"] - station_stats["min"]
+    station_stats["expected_fire_per_year"] = (station_stats["count"] / station_stats["duration"]).where(station_stats["duration"] > 0, 0)
+
+    # Average of the rates over each span's upstream station list, 0 for spans without stations
+    expected_fire_per_year_per_span = incidence.mean(station_stats["expected_fire_per_year"])
+    expected_fire_per_year_per_span_df = pd.DataFrame({'span': expected_fire_per_year_per_span.index,
+                                                       'expected_fire': expected_fire_per_year_per_span.to_numpy()})
+    dev_wings_agg_span_with_probabilities_expected_fire = dev_wings_agg_span_with_probabilities.merge(expected_fire_per_year_per_span_df, left_on='globalid',
+                                                                                                      right_on='span')
+
+    span_output_dir = config['parameters'].get('output_tables', {}).get('span_output_dir')
+    if span_output_dir:
+        path = save_output(config, dev_wings_agg_span_with_probabilities_expected_fire, span_output_dir, 'span_probabilities')
+        print(f"Span probabilities saved to {path}.")
+
+    print("Span analysis completed.")
+    return {
+        'spans': dev_wings_agg_span_with_probabilities_expected_fire,
+        'span_network': G,
+        'unique_upstream_stations': uniqueUpsteamWStoSpan,
+        # Saved with the checkpoint so that span PSPS updates do not rehash the network
+        'network_key': network_key(uniqueUpsteamWStoSpan),
+        'station_spans': spans_by_station(uniqueUpsteamWStoSpan),
+        'station_incidence': incidence,
+        'span_probabilities': new_span_probabilities,
+    }
+
+
+def feeder_analysis_stage(config, inputs):
+    """Perform feeder analysis for the configured parent feeder id."""
+    from span_analysis import annual_customer_counts
+    from rollup import HierarchyRollup, FEEDER_LEVEL
+    feeder_id = config['parameters']['parent_feeder_id']
+    print("Parent feeder_id exploration: ", feeder_id)
+    dev_wings_agg_span_with_probabilities_expected_fire = inputs['analyze_spans']['spans'].copy()
+
+    # Calculate annual customer count for each span
+    dev_wings_agg_span_with_probabilities_expected_fire['annual_cust_total'] = annual_customer_counts(
+        dev_wings_agg_span_with_probabilities_expected_fire
+    )
+    # Summarize annual customer impacts by feeder ID
+    segment_annual_customer = HierarchyRollup(dev_wings_agg_span_with_probabilities_expected_fire, [FEEDER_LEVEL]).aggregate(
+        {'annual_cust_total': ('annual_cust_total', 'sum')})['feeder']
+
+    # Filter data for the specified feeder ID
+    feederid = segment_annual_customer[segment_annual_customer.index == feeder_id]
+    print(feederid)
+
+    # Calculate annual and future customer impacts based on the specified years
+    annual_customer_affected = feederid.iloc[0]['annual_cust_total']
+    years = config['parameters']['impact_years']
+    next_years = annual_customer_affected * years
+
+    print(f"Annual customers affected: {annual_customer_affected}")
+    print(f"Expected Customers Affected in the next {years} years: {np.floor(next_years)}")
+    print("Feeder analysis completed.")
+    return segment_annual_customer
+
+
+def rollup_stage(config, inputs):
+    """Aggregate every circuit and feeder in one pass and save a ranked table per level."""
+    from span_analysis import annual_customer_counts
+    from rollup import HierarchyRollup, rank_rollups
+    rollup = config['parameters'].get('rollup', {})
+    spans = inputs['analyze_spans']['spans'].copy()
+    spans['annual_cust_total'] = annual_customer_counts(spans)
+    ranked = rank_rollups(HierarchyRollup(spans).aggregate(), rollup.get('rank_by', 'annual_customers_affected'))
+
+    output_dir = rollup.get('output_dir', './data/out/rollup')
+    for level, table in ranked.items():
+        save_output(config, table, output_dir, f"{level}_rollup")
+        print(f"Top {level}s:")
+        print(table.head(rollup.get('top', 10)).to_string(index=False))
+    print(f"Rollups of {', '.join(f'{len(table)} {level}s' for level, table in ranked.items())} saved to {output_dir}.")
+    return ranked
+
+
+def sweep_stage(config, inputs):
+    """Evaluate the PSPS probability of every station under a grid of conditions, multipliers and thresholds."""
+    from psps_sweep import sweep_station_probabilities, sweep_top_stations
+    sweep = config['parameters']['psps_sweep']
+    print("Sweeping PSPS scenarios...")
+    station_scenarios = sweep_station_probabilities(inputs['merge'], sweep['conditions'], sweep.get('multipliers', [1.0]))
+    top_station_scenarios = sweep_top_stations(station_scenarios, sweep.get('min_alert_thresholds', []))
+    output_dir = sweep.get('output_dir', './data/out/sweep')
+    save_output(config, station_scenarios, output_dir, 'station_scenarios')
+    save_output(config, top_station_scenarios, output_dir, 'top_station_scenarios')
+
+    # Number of high-risk stations per scenario and minimum probability
+    print(top_station_scenarios.pivot_table(index='scenario', columns='min_alert_threshold', values='weatherstationcode',
+                                            aggfunc='count', fill_value=0, sort=False)
+          .reindex(station_scenarios['scenario'].unique(), fill_value=0))
+    print(f"Sweep of {station_scenarios['scenario'].nunique()} scenarios saved to {output_dir}.")
+    return {'stations': station_scenarios, 'top_stations': top_station_scenarios}
+
+
+def sweep_spans_stage(config, inputs):
+    """Evaluate the PSPS probability of every span under each condition and multiplier of the sweep."""
+    from psps_sweep import sweep_span_probabilities
+    sweep = config['parameters']['psps_sweep']
+    print("Sweeping PSPS scenarios for spans...")
+    span_scenarios = sweep_span_probabilities(inputs['merge'], inputs['analyze_spans']['unique_upstream_stations'],
+                                              sweep['conditions'], sweep.get('multipliers', [1.0]))
+    output_dir = sweep.get('output_dir', './data/out/sweep')
+    save_output(config, span_scenarios, output_dir, 'span_scenarios')
+    print(span_scenarios.groupby('scenario', sort=False)['probability'].describe())
+    print(f"Span sweep saved to {output_dir}.")
+    return span_scenarios
+
+
+def simulate_stage(config, inputs):
+    """Simulate the customers affected per feeder over the impact years with correlated station events."""
+    from outage_simulation import OutageModel, station_exceedance_correlation, simulate_outages, summarize_outages
+    simulation = config['parameters']['outage_simulation']
+    years = simulation.get('years') or config['parameters']['impact_years']
+    correlation = simulation.get('station_correlation')
+    if correlation is None:
+        correlation = station_exceedance_correlation(inputs['merge'])
+    print(f"Simulating {simulation['trials']} trials of {years} years (station correlation {correlation:.3f})...")
+
+    model = OutageModel.from_spans(inputs['analyze_spans']['spans'], inputs['analyze_spans']['station_incidence'], correlation)
+    samples = simulate_outages(model, simulation['trials'], years, simulation.get('seed'), simulation.get('workers', 1))
+    feeder_outages = summarize_outages(model, samples, years, simulation.get('percentiles', [50, 90, 95]))
+    output_dir = simulation.get('output_dir', './data/out/simulation')
+    save_output(config, feeder_outages.reset_index(), output_dir, 'feeder_outages')
+
+    feeder_id = config['parameters']['parent_feeder_id']
+    print(feeder_outages[feeder_outages.index == feeder_id])
+    print(f"Feeder outage distributions saved to {output_dir}.")
+    return feeder_outages
+
+
+STAGES = {
+    'merge': Stage('merge', merge_stage,
+                   data_sources=('gis_weatherstation', 'station_summary_snapshot', 'windspeed_snapshot'),
+                   parameters=('merge_memory_budget_mb', 'merged_weather_output', 'output_tables')),
+    'psps': Stage('psps', psps_stage, depends_on=('merge',),
+                  data_sources=('gis_weatherstation',),
+                  parameters=('psps_condition',)),
+    'filter': Stage('filter', filter_stage, depends_on=('psps',),
+                    parameters=('min_alert_threshold',)),
+    'merge_vri': Stage('merge_vri', merge_vri_stage, depends_on=('psps',),
+                       data_sources=('src_vri_snapshot', 'dev_wings_agg_span')),
+    'analyze_spans': Stage('analyze_spans', analyze_spans_stage, depends_on=('merge',),
+                           data_sources=('dev_wings_agg_span', 'windspeed_snapshot'),
+                           parameters=('span_network_backend', 'output_tables')),
+    'feeder_analysis': Stage('feeder_analysis', feeder_analysis_stage, depends_on=('analyze_spans',),
+                             parameters=('parent_feeder_id',)),
+    'rollup': Stage('rollup', rollup_stage, depends_on=('analyze_spans',),
+                    parameters=('rollup', 'output_tables')),
+    'sweep': Stage('sweep', sweep_stage, depends_on=('merge',),
+                   parameters=('psps_sweep', 'output_tables')),
+    'sweep_spans': Stage('sweep_spans', sweep_spans_stage, depends_on=('merge', 'analyze_spans'),
+                         parameters=('psps_sweep', 'output_tables')),
+    'simulate': Stage('simulate', simulate_stage, depends_on=('merge', 'analyze_spans'),
+                      parameters=('outage_simulation', 'impact_years', 'output_tables')),
+    # Reads and writes its own persisted state, so it is never checkpointed
+    'update_psps': Stage('update_psps', update_psps_stage, checkpoint=False),
+    'update_span_psps': Stage('update_span_psps', update_span_psps_stage, depends_on=('analyze_spans',), checkpoint=False),
+}
+
+# Targets run by "all"
+ALL_TARGETS = ['merge', 'psps', 'filter', 'merge_vri', 'analyze_spans', 'feeder_analysis', 'rollup']
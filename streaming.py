@@ -0,0 +1,464 @@
+import io
+import socket
+import time
+import numpy as np
+import pandas as pd
+from etl import get_gis_data, get_station_summary_data, save_data
+from exceedance import ExceedanceMatrix
+from psps_state import spans_by_station
+from schema import apply_schema
+
+# Columns of a streamed reading, as in the windspeed snapshot
+READING_COLUMNS = ['station', 'date', 'wind_speed']
+DEFAULT_WINDOWS = {'last_7_days': 7, 'last_season': 120, 'all_time': None}
+
+
+class RollingStationWindows:
+    """
+    Per-station and per-span PSPS counts over rolling time windows, fed in micro-batches.
+
+    Readings are bucketed by day. Each window keeps running totals per station. A reading is
+    added to the totals of the windows covering its day, and its day's bucket keeps the
+    counts added for the stations it touched. When the latest day seen moves forward, the
+    buckets of the days leaving a window are subtracted from its totals. A batch therefore
+    costs time proportional to its size plus the size of the buckets that expire.
+
+    Spans are counted the same way. The number of date combinations of a span's stations,
+    and of those without an exceedance, is a sum over dates, as in the chained date merges.
+    A batch only changes the terms of the dates it has readings on, for the spans downstream
+    of its stations. Those terms are read from an ExceedanceMatrix of the readings before and
+    after the batch is added, and their differences go to the span totals of the windows and
+    to the span bucket of their day.
+
+    Windows are measured back from the latest reading date: a 7-day window holds that day and
+    the six before it. A window of None never expires. Readings older than a window when they
+    arrive are not counted in it.
+
+    Args:
+        station_info (DataFrame): Weather station codes with their threshold column, one row per GIS/summary match.
+        condition (str): Threshold column a reading is compared with.
+        windows (dict): Window name to its length in days, or None for all time.
+        stations_to_span (dict): Optional mapping of spans to their unique upstream station records.
+    """
+
+    def __init__(self, station_info, condition='alert', windows=None, stations_to_span=None):
+        self.station_info = station_info[['weatherstationcode', condition]]
+        self.condition = condition
+        self.windows = dict(DEFAULT_WINDOWS if windows is None else windows)
+        self.stations = pd.Index(pd.unique(np.asarray(station_info['weatherstationcode'], dtype=object)))
+
+        n_stations = len(self.stations)
+        self.readings = {name: np.zeros(n_stations, dtype=np.int64) for name in self.windows}
+        self.exceedances = {name: np.zeros(n_stations, dtype=np.int64) for name in self.windows}
+        # Day number -> list of (station rows, [readings, exceedances]) added on that day, kept
+        # while a finite window may still hold the day
+        self.buckets = dict()
+        self.latest_day = None
+
+        self.stations_to_span = stations_to_span
+        # Rows of the spans whose counts changed in the last update
+        self.changed_spans = set()
+        self.spans = pd.Index(list(stations_to_span or []), dtype=object)
+        if stations_to_span is not None:
+            # Spans with the same upstream stations have the same counts, so they are counted once per station set
+            set_codes = dict()
+            self.span_sets = np.asarray([set_codes.setdefault(tuple(sorted(station[0] for station in stations)), len(set_codes))
+                                         for stations in stations_to_span.values()], dtype=np.int64)
+            self.station_sets = list(set_codes)
+            # Span rows downstream of each station row, in CSR form
+            station_spans = spans_by_station(stations_to_span)
+            spans_of = [self.spans.get_indexer(pd.Index(station_spans.get(station, []), dtype=object)) for station in self.stations]
+            self.span_indptr = np.concatenate([[0], np.cumsum([len(spans) for spans in spans_of])]).astype(np.int64)
+            self.span_indices = np.concatenate(spans_of).astype(np.int64) if spans_of else np.empty(0, dtype=np.int64)
+            self.span_present = {name: np.zeros(len(self.spans)) for name in self.windows}
+            self.span_clear = {name: np.zeros(len(self.spans)) for name in self.windows}
+            # Day number -> list of (span rows, [combinations, clear combinations]) added on that day
+            self.span_buckets = dict()
+            self.engine = ExceedanceMatrix.from_merged_data(
+                pd.DataFrame({'weatherstationcode': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]'),
+                              'exceed_threshold': pd.Series(dtype='int8')}))
+
+    @classmethod
+    def from_sources(cls, gis_path, station_summary_path, condition='alert', windows=None, stations_to_span=None):
+        """
+        Build the windows for the stations of the GIS and station summary datasets.
+
+        Args:
+            gis_path (str): Path to the GIS dataset.
+            station_summary_path (str): Path to the station summary dataset.
+            condition (str): Threshold column.
+            windows (dict): Window name to its length in days, or None for all time.
+            stations_to_span (dict): Optional mapping of spans to their unique upstream station records.
+
+        Returns:
+            RollingStationWindows: Empty windows.
+        """
+        gis_data = get_gis_data(gis_path)
+        station_summary = get_station_summary_data(station_summary_path)
+        station_info = gis_data.merge(station_summary, left_on='weatherstationcode', right_on='station')
+        return cls(station_info, condition, windows, stations_to_span)
+
+    def window_start(self, name):
+        """First day number inside a window, or None for a window that never expires."""
+        length = self.windows[name]
+        if length is None or self.latest_day is None:
+            return None
+        return self.latest_day - length + 1
+
+    def update(self, batch):
+        """
+        Count a micro-batch of readings.
+
+        The rows of the spans whose counts changed, through the batch or through days that
+        expired, are left in `changed_spans`.
+
+        Args:
+            batch (DataFrame): New readings with 'station', 'date' and 'wind_speed' columns.
+
+        Returns:
+            set: Codes of the stations whose counts changed.
+        """
+        self.changed_spans = set()
+        batch = apply_schema(batch[READING_COLUMNS].copy(), 'windspeed_snapshot')
+        joined = self.station_info.merge(batch, left_on='weatherstationcode', right_on='station')
+        joined = joined[joined['date'].notna()]
+        if joined.empty:
+            return set()
+
+        codes = self.stations.get_indexer(joined['weatherstationcode'].to_numpy(dtype=object))
+        exceed = (joined['wind_speed'] > joined[self.condition]).to_numpy()
+        counted = joined['wind_speed'].notna().to_numpy()
+        days = joined['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+
+        previous_starts = {name: self.window_start(name) for name in self.windows}
+        latest = int(days.max())
+        if self.latest_day is None or latest > self.latest_day:
+            self.latest_day = latest
+        expired = self.expire(previous_starts)
+
+        n_stations = len(self.stations)
+        cells = (days - days.min()) * n_stations + codes
+        unique_cells, inverse = np.unique(cells, return_inverse=True)
+        readings = np.bincount(inverse, weights=counted).astype(np.int64)
+        exceedances = np.bincount(inverse, weights=exceed).astype(np.int64)
+        self.add_by_day([self.readings, self.exceedances], self.buckets,
+                        unique_cells // n_stations + days.min(), unique_cells % n_stations, [readings, exceedances])
+
+        if self.stations_to_span is not None:
+            rows = joined[['weatherstationcode', 'date']].copy()
+            rows['exceed_threshold'] = exceed.astype('int8')
+            self.add_span_rows(rows[counted])
+        return set(self.stations[sorted(set(codes.tolist()) | expired)])
+
+    def add_span_rows(self, rows):
+        """
+        Add counted readings to the exceedance matrix and to the span totals of each window.
+
+        Args:
+            rows (DataFrame): 'weatherstationcode', 'date' and 'exceed_threshold' of the readings.
+        """
+        if rows.empty:
+            return
+        pairs = rows[['weatherstationcode', 'date']].drop_duplicates()
+        station_rows = self.stations.get_indexer(pairs['weatherstationcode'].to_numpy(dtype=object))
+        # Every span downstream of each (station, date) pair changes on that date
+        starts, counts = self.span_indptr[station_rows], self.span_indptr[station_rows + 1] - self.span_indptr[station_rows]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        affected = pd.DataFrame({
+            'span': self.span_indices[np.repeat(starts, counts) + offsets],
+            'date': pairs['date'].to_numpy()[np.repeat(np.arange(len(pairs)), counts)],
+        }).drop_duplicates()
+
+        present_before, clear_before = self.span_date_counts(affected)
+        self.engine.add_rows(rows)
+        present_after, clear_after = self.span_date_counts(affected)
+        spans = affected['span'].to_numpy()
+        days = affected['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        self.add_by_day([self.span_present, self.span_clear], self.span_buckets, days, spans,
+                        [present_after - present_before, clear_after - clear_before])
+        self.changed_spans.update(spans.tolist())
+
+    def span_date_counts(self, affected):
+        """
+        Date combinations of some spans' stations on some dates, from the exceedance matrix.
+
+        Args:
+            affected (DataFrame): 'span' rows and 'date' values.
+
+        Returns:
+            tuple: Number of combinations of each pair, and number of those without an exceedance.
+        """
+        pairs = pd.DataFrame({'set': self.span_sets[affected['span'].to_numpy()], 'date': affected['date'].to_numpy()})
+        set_dates = pairs.drop_duplicates()
+        present = np.zeros(len(set_dates))
+        clear = np.zeros(len(set_dates))
+        date_codes = self.engine.dates.get_indexer(set_dates['date'])
+        for station_set, positions in set_dates.groupby('set').indices.items():
+            rows = self.engine.stations.get_indexer(pd.Index(self.station_sets[station_set], dtype=object))
+            positions = positions[date_codes[positions] >= 0]
+            # Dates or stations without readings yet have no combinations
+            if len(rows) and (rows >= 0).all() and len(positions):
+                present[positions], clear[positions] = self.engine.date_counts(rows, date_codes[positions])
+        # Back to the (span, date) pairs
+        lookup = pd.MultiIndex.from_frame(set_dates).get_indexer(pd.MultiIndex.from_frame(pairs))
+        return present[lookup], clear[lookup]
+
+    def add_by_day(self, totals, buckets, days, codes, values):
+        """
+        Add deltas to the windows covering their day, and keep them in their day's bucket.
+
+        Args:
+            totals (list): Window name to totals array, one mapping per delta array.
+            buckets (dict): Day number to the deltas kept for that day.
+            days (np.ndarray): Day number of each delta.
+            codes (np.ndarray): Position of each delta in the totals arrays.
+            values (list): Delta arrays, one per totals mapping.
+        """
+        oldest_kept = self.oldest_kept_day()
+        for day in np.unique(days).tolist():
+            in_day = days == day
+            day_codes, day_values = codes[in_day], [value[in_day] for value in values]
+            if oldest_kept is not None and day >= oldest_kept:
+                buckets.setdefault(day, []).append((day_codes, day_values))
+            for name in self.windows:
+                start = self.window_start(name)
+                if start is None or day >= start:
+                    for total, value in zip(totals, day_values):
+                        np.add.at(total[name], day_codes, value)
+
+    def oldest_kept_day(self):
+        """First day still needed by a finite window, or None when every window is all time."""
+        starts = [self.window_start(name) for name in self.windows if self.windows[name] is not None]
+        return min(starts) if starts else None
+
+    def expire(self, previous_starts):
+        """
+        Subtract the day buckets that left each window, and drop buckets no window needs.
+
+        Args:
+            previous_starts (dict): Window name to its first day before the latest day moved.
+
+        Returns:
+            set: Rows of the stations whose counts went down.
+        """
+        bucket_totals = [(self.buckets, [self.readings, self.exceedances])]
+        if self.stations_to_span is not None:
+            bucket_totals.append((self.span_buckets, [self.span_present, self.span_clear]))
+        expired = [set(), self.changed_spans]
+        for name, previous in previous_starts.items():
+            start = self.window_start(name)
+            if start is None or previous is None or start <= previous:
+                continue
+            for (buckets, totals), changed in zip(bucket_totals, expired):
+                for day in [day for day in buckets if previous <= day < start]:
+                    for codes, values in buckets[day]:
+                        for total, value in zip(totals, values):
+                            np.subtract.at(total[name], codes, value)
+                        changed.update(codes.tolist())
+        oldest_kept = self.oldest_kept_day()
+        if oldest_kept is not None:
+            for buckets, _ in bucket_totals:
+                for day in [day for day in buckets if day < oldest_kept]:
+                    del buckets[day]
+        return expired[0]
+
+    def station_probabilities(self, stations=None):
+        """
+        Reading counts and PSPS probability per station and window.
+
+        Args:
+            stations (iterable): Station codes to report; all stations by default.
+
+        Returns:
+            DataFrame: 'window', 'weatherstationcode', 'wind_speed_count', 'above_threshold_count'
+                and 'PSPS_probability', 0 for stations without readings in a window.
+        """
+        rows = np.arange(len(self.stations)) if stations is None else self.stations.get_indexer(pd.Index(sorted(stations), dtype=object))
+        rows = rows[rows >= 0]
+        tables = []
+        for name in self.windows:
+            readings = self.readings[name][rows]
+            exceedances = self.exceedances[name][rows]
+            probability = np.divide(exceedances, readings, out=np.zeros(len(rows)), where=readings > 0)
+            tables.append(pd.DataFrame({'window': name, 'weatherstationcode': self.stations[rows],
+                                        'wind_speed_count': readings, 'above_threshold_count': exceedances,
+                                        'PSPS_probability': probability}))
+        return pd.concat(tables, ignore_index=True)
+
+    def span_probabilities(self, spans=None):
+        """
+        PSPS probability per window of some spans, from the running span totals.
+
+        Args:
+            spans (iterable): Span ids to report; all spans by default.
+
+        Returns:
+            DataFrame: 'window', 'span' and 'probability', 0 for spans whose stations share no
+                dates in a window; empty without a span mapping.
+        """
+        if self.stations_to_span is None:
+            return pd.DataFrame(columns=['window', 'span', 'probability'])
+        rows = np.arange(len(self.spans)) if spans is None else self.spans.get_indexer(pd.Index(list(spans), dtype=object))
+        rows = rows[rows >= 0]
+        tables = []
+        for name in self.windows:
+            present = self.span_present[name][rows]
+            clear = self.span_clear[name][rows]
+            probability = np.divide(present - clear, present, out=np.zeros(len(rows)), where=present > 0)
+            tables.append(pd.DataFrame({'window': name, 'span': self.spans[rows], 'probability': probability}))
+        return pd.concat(tables, ignore_index=True)
+
+    def process(self, batches):
+        """
+        Count micro-batches as they arrive and emit the updated probabilities after each.
+
+        Args:
+            batches (iterable): DataFrames of readings, e.g. from micro_batches.
+
+        Yields:
+            dict: 'stations' and 'spans' probabilities of the stations and spans whose counts
+                changed, and 'readings', the number of readings in the batch.
+        """
+        for batch in batches:
+            changed = self.update(batch)
+            yield {
+                'readings': len(batch),
+                'stations': self.station_probabilities(changed),
+                'spans': self.span_probabilities(self.spans[sorted(self.changed_spans)]),
+            }
+
+
+def micro_batches(records, batch_size=1000):
+    """
+    Group readings into DataFrame micro-batches.
+
+    Args:
+        records (iterable): Readings as (station, date, wind_speed) tuples, dicts or CSV lines.
+            None flushes the readings gathered so far, so idle sources emit partial batches.
+        batch_size (int): Readings per batch.
+
+    Yields:
+        DataFrame: Readings with 'station', 'date' and 'wind_speed' columns.
+    """
+    rows, lines = [], []
+
+    def flush():
+        # CSV lines are parsed once per batch
+        frames = []
+        if rows:
+            frames.append(pd.DataFrame(rows, columns=READING_COLUMNS))
+        if lines:
+            frames.append(pd.read_csv(io.StringIO(''.join(lines)), header=None, names=READING_COLUMNS))
+        rows.clear()
+        lines.clear()
+        return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+    for record in records:
+        if isinstance(record, str):
+            if record.strip():
+                lines.append(record if record.endswith('\n') else record + '\n')
+        elif isinstance(record, dict):
+            rows.append(tuple(record[column] for column in READING_COLUMNS))
+        elif record is not None:
+            rows.append(tuple(record))
+        if (rows or lines) and (record is None or len(rows) + len(lines) >= batch_size):
+            yield flush()
+    if rows or lines:
+        yield flush()
+
+
+def tail_lines(path, poll_seconds=1.0, idle_timeout=None):
+    """
+    Follow a CSV file like `tail -f`, starting at its first data row.
+
+    Args:
+        path (str): File to follow; its first line is the header.
+        poll_seconds (float): Wait between checks for new data.
+        idle_timeout (float): Stop after this many seconds without new lines; None follows forever.
+
+    Yields:
+        str: Data lines in station,date,wind_speed order, or None when the file is idle.
+    """
+    with open(path, 'r') as fh:
+        header = fh.readline().rstrip('\r\n').split(',')
+        positions = [header.index(column) for column in READING_COLUMNS]
+        partial = ''
+        idle_since = time.monotonic()
+        while True:
+            line = fh.readline()
+            if line.endswith('\n'):
+                fields = (partial + line).rstrip('\r\n').split(',')
+                partial = ''
+                idle_since = time.monotonic()
+                yield ','.join(fields[position] for position in positions)
+                continue
+            # Keep half-written lines until the writer finishes them
+            partial += line
+            yield None
+            if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                return
+            time.sleep(poll_seconds)
+
+
+def socket_lines(host='127.0.0.1', port=8051, idle_seconds=1.0):
+    """
+    Accept local connections and read station,date,wind_speed lines from them.
+
+    Args:
+        host (str): Interface to listen on; local only by default.
+        port (int): Port to listen on.
+        idle_seconds (float): Quiet time after which the lines received so far are flushed.
+
+    Yields:
+        str: Data lines, or None when the connection is idle.
+    """
+    with socket.create_server((host, port)) as server:
+        print(f"Listening for readings on {host}:{port}")
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                connection.settimeout(idle_seconds)
+                buffer = b''
+                while True:
+                    try:
+                        data = connection.recv(65536)
+                    except (socket.timeout, TimeoutError):
+                        yield None
+                        continue
+                    if not data:
+                        break
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        yield line.decode() + '\n'
+                if buffer:
+                    yield buffer.decode() + '\n'
+            yield None
+
+if __name__ == "__main__":
+    # python streaming.py tail <csv> | socket [port]: stream readings and print the rolling probabilities
+    import json
+    import sys
+    from query_service import PSPSQueryService
+
+    with open('data-params.json', 'r') as fh:
+        config = json.load(fh)
+    streaming = config['parameters'].get('streaming', {})
+    stations_to_span = None
+    if streaming.get('spans', True):
+        stations_to_span = PSPSQueryService.from_pipeline(config).upstream_stations
+    state = RollingStationWindows.from_sources(config['data_sources']['gis_weatherstation'],
+                                               config['data_sources']['station_summary_snapshot'],
+                                               config['parameters']['psps_condition'],
+                                               streaming.get('windows'), stations_to_span)
+
+    if sys.argv[1] == 'tail':
+        lines = tail_lines(sys.argv[2], streaming.get('poll_seconds', 1.0))
+    else:
+        lines = socket_lines(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8051)
+    output_dir = streaming.get('output_dir', './data/out/stream')
+    for update in state.process(micro_batches(lines, streaming.get('batch_size', 1000))):
+        save_data(update['stations'], output_dir, 'station_windows.csv')
+        save_data(update['spans'], output_dir, 'span_windows.csv')
+        print(f"{update['readings']} readings: {update['stations']['weatherstationcode'].nunique()} stations "
+              f"and {update['spans']['span'].nunique()} spans updated")
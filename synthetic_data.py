@@ -0,0 +1,297 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.strtree import STRtree
+
+# Longitude/latitude bounds of the generated network, roughly San Diego County
+DEFAULT_BOUNDS = (-117.6, 32.5, -116.1, 33.5)
+
+
+def generate_stations(n_stations, rng, bounds=DEFAULT_BOUNDS, missing_summary_fraction=0.05):
+    """
+    Generate weather station locations and their wind speed thresholds.
+
+    Args:
+        n_stations (int): Number of weather stations.
+        rng (np.random.Generator): Random generator.
+        bounds (tuple): (min lon, min lat, max lon, max lat) of the stations.
+        missing_summary_fraction (float): Share of stations left out of the station summary.
+
+    Returns:
+        tuple: GIS weather station DataFrame and station summary DataFrame.
+    """
+    codes = np.array([f"WS{i:05d}" for i in range(n_stations)], dtype=object)
+    lon = rng.uniform(bounds[0], bounds[2], n_stations)
+    lat = rng.uniform(bounds[1], bounds[3], n_stations)
+    gis_weatherstation = pd.DataFrame({
+        'weatherstationcode': codes,
+        'shape': shapely.to_wkt(shapely.points(lon, lat), rounding_precision=6),
+        'shape_srid': 4326,
+        'elevation': rng.integers(0, 2000, n_stations),
+    })
+
+    in_summary = rng.random(n_stations) >= missing_summary_fraction
+    alert = np.round(rng.uniform(20, 45, in_summary.sum()), 1)
+    station_summary = pd.DataFrame({
+        'station': codes[in_summary],
+        'alert': alert,
+        'max_gust': np.round(alert + rng.uniform(10, 30, len(alert)), 1),
+    })
+    return gis_weatherstation, station_summary
+
+
+def generate_windspeed(station_codes, rng, years=3, start='2020-01-01', coverage=0.9):
+    """
+    Generate daily wind speed readings for each station.
+
+    Args:
+        station_codes (array-like): Station codes.
+        rng (np.random.Generator): Random generator.
+        years (int): Length of the history in years.
+        start (str): First date of the history.
+        coverage (float): Share of days with a reading at each station.
+
+    Returns:
+        DataFrame: Readings with 'station', 'date' and 'wind_speed' columns.
+    """
+    dates = pd.date_range(start, periods=365 * years, freq='D').strftime('%Y-%m-%d').to_numpy(dtype=object)
+    station_codes = np.asarray(station_codes, dtype=object)
+    observed = rng.random((len(station_codes), len(dates))) < coverage
+    station_index, date_index = np.nonzero(observed)
+
+    # Gusty stations have a higher mean, and some days are windy everywhere
+    station_scale = rng.uniform(3, 6, len(station_codes))
+    windy_days = rng.gamma(2.0, 0.5, len(dates))
+    wind_speed = rng.gamma(4.0, station_scale[station_index] * windy_days[date_index])
+    return pd.DataFrame({
+        'station': station_codes[station_index],
+        'date': dates[date_index],
+        'wind_speed': np.round(wind_speed, 1),
+    })
+
+
+def generate_feeder_trees(n_spans, rng, depth=60, branching=3, spans_per_feeder=2000, branch_probability=0.15,
+                          bounds=DEFAULT_BOUNDS, step=0.002):
+    """
+    Generate radial feeder trees of spans.
+
+    Each feeder starts at a root span and grows level by level. A span continues as a single
+    line, or with probability `branch_probability` splits into 2 to `branching` child spans.
+    A feeder stops growing at `depth` levels or `spans_per_feeder` spans. Feeders are added
+    until there are `n_spans` spans. Span end points are random walks from their upstream span.
+
+    Args:
+        n_spans (int): Number of spans.
+        rng (np.random.Generator): Random generator.
+        depth (int): Maximum number of spans from a feeder root to its ends.
+        branching (int): Maximum number of child spans of a span.
+        spans_per_feeder (int): Maximum number of spans of a feeder.
+        branch_probability (float): Probability that a span splits.
+        bounds (tuple): (min lon, min lat, max lon, max lat) of the feeder roots.
+        step (float): Standard deviation of a span's length in degrees.
+
+    Returns:
+        dict: Arrays 'parent' (index of the upstream span, -1 for roots), 'feeder',
+            'circuit', 'depth', 'x' and 'y' (end point of each span).
+    """
+    parts = {name: [] for name in ('parent', 'feeder', 'circuit', 'depth', 'x', 'y')}
+    total = 0
+    n_feeders = 0
+    while total < n_spans:
+        batch = int(np.ceil((n_spans - total) / spans_per_feeder))
+        feeder_sizes = np.zeros(batch, dtype=np.int64)
+        level = {
+            'index': np.arange(total, total + batch),
+            'parent': np.full(batch, -1),
+            'feeder': np.arange(batch),
+            'circuit': np.zeros(batch, dtype=np.int64),
+            'x': rng.uniform(bounds[0], bounds[2], batch),
+            'y': rng.uniform(bounds[1], bounds[3], batch),
+        }
+        for level_depth in range(depth):
+            parts['parent'].append(level['parent'])
+            parts['feeder'].append(level['feeder'] + n_feeders)
+            parts['circuit'].append(level['circuit'])
+            parts['depth'].append(np.full(len(level['index']), level_depth))
+            parts['x'].append(level['x'])
+            parts['y'].append(level['y'])
+            total += len(level['index'])
+            feeder_sizes += np.bincount(level['feeder'], minlength=batch)
+            if total >= n_spans or level_depth == depth - 1:
+                break
+
+            splits = rng.random(len(level['index'])) < branch_probability
+            children = np.where(splits, rng.integers(2, branching + 1, len(splits)), 1) if branching > 1 else np.ones(len(splits), dtype=np.int64)
+            if level_depth == 0:
+                # Every feeder root feeds `branching` circuits
+                children[:] = branching
+            child_feeder = np.repeat(level['feeder'], children)
+            # Nodes of a level are ordered by feeder, so the rank of a child within its feeder
+            # decides whether the feeder still has room for it
+            group_start = np.searchsorted(child_feeder, child_feeder, side='left')
+            keep = np.arange(len(child_feeder)) - group_start < spans_per_feeder - feeder_sizes[child_feeder]
+            if not keep.any():
+                break
+            child_parent = np.repeat(level['index'], children)
+            # The spans leaving a feeder root start separate circuits
+            if level_depth == 0:
+                child_circuit = np.concatenate([np.arange(count) for count in children])
+            else:
+                child_circuit = np.repeat(level['circuit'], children)
+            child_x = np.repeat(level['x'], children) + rng.normal(0, step, len(child_parent))
+            child_y = np.repeat(level['y'], children) + rng.normal(0, step, len(child_parent))
+            level = {
+                'index': np.arange(total, total + keep.sum()),
+                'parent': child_parent[keep],
+                'feeder': child_feeder[keep],
+                'circuit': child_circuit[keep],
+                'x': child_x[keep],
+                'y': child_y[keep],
+            }
+        n_feeders += batch
+
+    return {name: np.concatenate(values)[:n_spans] for name, values in parts.items()}
+
+
+def generate_spans(n_spans, gis_weatherstation, rng, depth=60, branching=3, spans_per_feeder=2000, bounds=DEFAULT_BOUNDS):
+    """
+    Generate the aggregated span table with WKT line geometries.
+
+    Each span is a line from its upstream span's end point to its own, and is assigned to
+    the nearest weather station.
+
+    Args:
+        n_spans (int): Number of spans.
+        gis_weatherstation (DataFrame): Weather stations from generate_stations.
+        rng (np.random.Generator): Random generator.
+        depth (int): Maximum feeder depth.
+        branching (int): Maximum number of child spans of a span.
+        spans_per_feeder (int): Maximum number of spans of a feeder.
+        bounds (tuple): (min lon, min lat, max lon, max lat) of the feeder roots.
+
+    Returns:
+        DataFrame: Spans in the layout of the dev_wings_agg_span snapshot.
+    """
+    trees = generate_feeder_trees(n_spans, rng, depth, branching, spans_per_feeder, bounds=bounds)
+    parent = trees['parent']
+    x, y = trees['x'], trees['y']
+    is_root = parent < 0
+    start_x = np.where(is_root, x + 0.0005, x[np.maximum(parent, 0)])
+    start_y = np.where(is_root, y + 0.0005, y[np.maximum(parent, 0)])
+    lines = shapely.linestrings(np.stack([np.stack([start_x, start_y], axis=1), np.stack([x, y], axis=1)], axis=1))
+
+    globalid = np.array([f"{{{i:08X}-SPAN}}" for i in range(n_spans)], dtype=object)
+    upstream_span_id = np.where(is_root, None, globalid[np.maximum(parent, 0)])
+    station_points = geometry_points(gis_weatherstation['shape'])
+    nearest = STRtree(station_points).query_nearest(shapely.points(x, y), return_distance=False, all_matches=False)[1]
+    feeder_ids = np.array([f"F{feeder_id}" for feeder_id in range(trees['feeder'].max() + 1)], dtype=object)
+
+    return pd.DataFrame({
+        'globalid': globalid,
+        'upstream_span_id': upstream_span_id,
+        'station': gis_weatherstation['weatherstationcode'].to_numpy(dtype=object)[nearest],
+        'parent_feederid': feeder_ids[trees['feeder']],
+        'upstreamardfacilityid': [f"{feeder_id}-{circuit}R" for feeder_id, circuit in zip(feeder_ids[trees['feeder']], trees['circuit'])],
+        'cust_total': rng.integers(0, 60, n_spans),
+        'shape': shapely.to_wkt(lines, rounding_precision=6),
+        'shape_srid': 4326,
+    })
+
+
+def geometry_points(shapes):
+    """Decode WKT point strings into a shapely geometry array."""
+    return shapely.from_wkt(np.asarray(shapes, dtype=object))
+
+
+def generate_vri(rng, bounds=DEFAULT_BOUNDS, cell_size=0.05, srid=3857):
+    """
+    Generate vegetation risk polygons as a grid over the network area.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        bounds (tuple): (min lon, min lat, max lon, max lat) covered by the polygons.
+        cell_size (float): Width of a grid cell in degrees.
+        srid (int): EPSG code the polygons are stored in, as in the VRI snapshot.
+
+    Returns:
+        DataFrame: VRI polygons with WKT 'shape' and 'shape_srid' columns.
+    """
+    xs = np.arange(bounds[0], bounds[2], cell_size)
+    ys = np.arange(bounds[1], bounds[3], cell_size)
+    cell_x, cell_y = (grid.ravel() for grid in np.meshgrid(xs, ys))
+    polygons = gpd.GeoSeries(shapely.box(cell_x, cell_y, cell_x + cell_size, cell_y + cell_size), crs=4326).to_crs(srid)
+    return pd.DataFrame({
+        'globalid': [f"{{{i:08X}-VRI}}" for i in range(len(polygons))],
+        'vri_risk': rng.choice(['High', 'Moderate', 'Low'], len(polygons), p=[0.2, 0.3, 0.5]),
+        'shape': polygons.to_wkt(rounding_precision=1).to_numpy(),
+        'shape_srid': srid,
+    })
+
+
+def write_dataset(output_dir, n_spans, n_stations=None, years=3, depth=60, branching=3, spans_per_feeder=2000, seed=0):
+    """
+    Write a synthetic version of the five input datasets and a matching data-params.json.
+
+    The data sources in data-params.json are absolute paths, so the pipeline can be run from
+    the output directory or from anywhere else with that file.
+
+    Args:
+        output_dir (str): Directory for the CSV files.
+        n_spans (int): Number of spans.
+        n_stations (int): Number of weather stations. Defaults to one per 500 spans, between 20 and 2000.
+        years (int): Length of the windspeed history in years.
+        depth (int): Maximum feeder depth.
+        branching (int): Maximum number of child spans of a span.
+        spans_per_feeder (int): Maximum number of spans of a feeder.
+        seed (int): Random seed.
+
+    Returns:
+        str: Path to the written data-params.json.
+    """
+    rng = np.random.default_rng(seed)
+    if n_stations is None:
+        n_stations = int(np.clip(n_spans // 500, 20, 2000))
+    os.makedirs(output_dir, exist_ok=True)
+
+    gis_weatherstation, station_summary = generate_stations(n_stations, rng)
+    windspeed = generate_windspeed(gis_weatherstation['weatherstationcode'], rng, years)
+    spans = generate_spans(n_spans, gis_weatherstation, rng, depth, branching, spans_per_feeder)
+    vri = generate_vri(rng)
+
+    data_dir = os.path.abspath(output_dir)
+    data_sources = {
+        'gis_weatherstation': os.path.join(data_dir, 'gis_weatherstation.csv'),
+        'station_summary_snapshot': os.path.join(data_dir, 'station_summary_snapshot.csv'),
+        'windspeed_snapshot': os.path.join(data_dir, 'windspeed_snapshot.csv'),
+        'src_vri_snapshot': os.path.join(data_dir, 'src_vri_snapshot.csv'),
+        'dev_wings_agg_span': os.path.join(data_dir, 'dev_wings_agg_span.csv'),
+    }
+    gis_weatherstation.to_csv(data_sources['gis_weatherstation'], index=False)
+    station_summary.to_csv(data_sources['station_summary_snapshot'], index=False)
+    windspeed.to_csv(data_sources['windspeed_snapshot'], index=False)
+    vri.to_csv(data_sources['src_vri_snapshot'], index=False)
+    # The span snapshot was exported with its index
+    spans.to_csv(data_sources['dev_wings_agg_span'])
+    print(f"Synthetic data written to {output_dir}: {n_spans} spans, {n_stations} stations, "
+          f"{len(windspeed)} wind speed readings, {len(vri)} VRI polygons.")
+
+    # Point the example feeder and circuit parameters at the largest generated feeder
+    largest_feeder = spans['parent_feederid'].value_counts().index[0]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data-params.json'), 'r') as fh:
+        config = json.load(fh)
+    config['data_sources'].update(data_sources)
+    config['parameters']['parent_feeder_id'] = largest_feeder
+    config['parameters']['circuit_data_idx'] = f"{largest_feeder}-0R"
+    params_path = os.path.join(output_dir, 'data-params.json')
+    with open(params_path, 'w') as fh:
+        json.dump(config, fh, indent=4)
+    return params_path
+
+
+if __name__ == "__main__":
+    # python synthetic_data.py <output dir> <number of spans> [seed]
+    import sys
+    write_dataset(sys.argv[1], int(sys.argv[2]), seed=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
@@ -0,0 +1,327 @@
+import json
+import os
+import shutil
+import sys
+from urllib.parse import quote
+import pandas as pd
+from data_cache import PARQUET_AVAILABLE
+from profiling import instrument
+
+if PARQUET_AVAILABLE:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+TABLE_FORMATS = {'.parquet': 'parquet', '.csv': 'csv'}
+MANIFEST_NAME = '_manifest.json'
+# Directory name of rows whose partition key is missing, as in Hive-style layouts
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Rows per chunk when iterating over a CSV table
+CSV_CHUNK_ROWS = 1 << 18
+# Parquet files kept open at once; a partition written again after its file was closed gets a new part file
+MAX_OPEN_WRITERS = 64
+
+
+def table_format(file_name):
+    """
+    Format of a table from its file name, falling back to CSV when Parquet is unavailable.
+
+    Args:
+        file_name (str): File name ending in .parquet or .csv.
+
+    Returns:
+        tuple: Format ('parquet' or 'csv') and the file name to use.
+    """
+    base, extension = os.path.splitext(file_name)
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format: {file_name}. Use .parquet or .csv.")
+    if TABLE_FORMATS[extension] == 'parquet' and not PARQUET_AVAILABLE:
+        print(f"pyarrow is not installed; writing {base}.csv instead of {file_name}.")
+        return 'csv', f"{base}.csv"
+    return TABLE_FORMATS[extension], file_name
+
+
+def is_geodataframe(df):
+    """Whether a frame is a GeoDataFrame, without importing geopandas when nothing else has."""
+    geopandas = sys.modules.get('geopandas')
+    return geopandas is not None and isinstance(df, geopandas.GeoDataFrame)
+
+
+def partition_path(columns, values):
+    """Relative directory of a partition, e.g. 'parent_feederid=F1', with the values URL-encoded."""
+    return os.path.join(*[f"{column}={NULL_PARTITION if pd.isna(value) else quote(str(value), safe='')}"
+                          for column, value in zip(columns, values)])
+
+
+class TableWriter:
+    """
+    Write a table in one go or chunk by chunk, optionally partitioned by key columns.
+
+    An unpartitioned table is a single file. A partitioned table is a directory holding one
+    `key=value` subdirectory per partition, an empty file with the table schema and a
+    manifest of the partitions in the order they were first written. The key columns stay
+    in the files, so each partition keeps its dtypes when read on its own.
+
+    Parquet chunks of a partition are appended to one file as row groups, with at most
+    MAX_OPEN_WRITERS files open at a time. GeoDataFrames
+    are written as GeoParquet, one file per chunk and partition. Everything is written next
+    to the destination and moved into place by `close`, so readers never see a partial table.
+
+    Args:
+        output_path (str): Directory of the table.
+        file_name (str): Table name ending in .parquet or .csv.
+        partition_by (list): Key columns of the partitions, or None for a single file.
+        compression (str): Parquet compression codec.
+        row_group_size (int): Maximum rows per Parquet row group.
+    """
+
+    def __init__(self, output_path, file_name, partition_by=None, compression='snappy', row_group_size=None):
+        self.file_format, file_name = table_format(file_name)
+        self.partition_by = [partition_by] if isinstance(partition_by, str) else list(partition_by or [])
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.extension = '.parquet' if self.file_format == 'parquet' else '.csv'
+        os.makedirs(output_path, exist_ok=True)
+        self.path = os.path.join(output_path, os.path.splitext(file_name)[0] if self.partition_by else file_name)
+        self.temp_path = f"{self.path}.tmp-{os.getpid()}"
+        if self.partition_by:
+            if os.path.exists(self.temp_path):
+                shutil.rmtree(self.temp_path)
+            os.makedirs(self.temp_path)
+        self.partitions = dict()
+        self.writers = dict()
+        self.geometry = False
+        self.schema_frame = None
+        self.schema = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @instrument
+    def write(self, df):
+        """
+        Append a chunk of rows.
+
+        Args:
+            df (pd.DataFrame or gpd.GeoDataFrame): Rows with the columns of the first chunk.
+        """
+        if self.schema_frame is None:
+            self.schema_frame = df.iloc[:0]
+            self.geometry = is_geodataframe(df)
+        if not self.partition_by:
+            self.append(None, self.temp_path, df)
+            return
+        if df.empty:
+            return
+        for values, rows in df.groupby(self.partition_by, sort=False, dropna=False, observed=True):
+            values = values if isinstance(values, tuple) else (values,)
+            key = partition_path(self.partition_by, values)
+            if key not in self.partitions:
+                os.makedirs(os.path.join(self.temp_path, key), exist_ok=True)
+                self.partitions[key] = {'values': [None if pd.isna(value) else str(value) for value in values], 'files': []}
+            self.append(key, os.path.join(self.temp_path, key), rows)
+
+    def append(self, key, path, df):
+        """Append rows to one partition (`path` is its directory) or to the single file."""
+        partition = self.partitions.get(key)
+        if key is not None:
+            part_name = f"part-{len(partition['files']):05d}{self.extension}"
+        if self.file_format == 'csv':
+            file_path = path if key is None else os.path.join(path, 'part-00000.csv')
+            new_file = key not in self.writers
+            df.to_csv(file_path, mode='w' if new_file else 'a', header=new_file, index=False)
+            self.writers[key] = file_path
+            if key is not None and new_file:
+                partition['files'].append('part-00000.csv')
+        elif self.geometry:
+            # GeoParquet metadata is written per file, so each chunk gets its own file
+            file_path = path if key is None else os.path.join(path, part_name)
+            if key is None and key in self.writers:
+                raise ValueError('An unpartitioned GeoParquet table must be written in one chunk.')
+            df.to_parquet(file_path, index=False, compression=self.compression, row_group_size=self.row_group_size)
+            self.writers[key] = file_path
+            if key is not None:
+                partition['files'].append(part_name)
+        else:
+            if key not in self.writers:
+                if self.schema is None:
+                    self.schema = pa.Table.from_pandas(df, preserve_index=False).schema
+                if len(self.writers) >= MAX_OPEN_WRITERS:
+                    # Close the writer opened first
+                    self.writers.pop(next(iter(self.writers))).close()
+                file_path = path if key is None else os.path.join(path, part_name)
+                self.writers[key] = pq.ParquetWriter(file_path, self.schema, compression=self.compression)
+                if key is not None:
+                    partition['files'].append(part_name)
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            self.writers[key].write_table(table, row_group_size=self.row_group_size)
+
+    def close_files(self):
+        """Close the open Parquet writers."""
+        for writer in self.writers.values():
+            if not isinstance(writer, str):
+                writer.close()
+        self.writers = dict()
+
+    def close(self):
+        """
+        Finish the table and move it into place, replacing any previous version.
+
+        Returns:
+            str: Path of the table file or directory.
+        """
+        self.close_files()
+        if self.partition_by:
+            schema_file = f"_schema{self.extension}"
+            schema_frame = self.schema_frame if self.schema_frame is not None else pd.DataFrame()
+            if self.file_format == 'csv':
+                schema_frame.to_csv(os.path.join(self.temp_path, schema_file), index=False)
+            else:
+                schema_frame.to_parquet(os.path.join(self.temp_path, schema_file), index=False)
+            manifest = {
+                'format': self.file_format, 'partition_by': self.partition_by, 'geometry': self.geometry,
+                'schema': schema_file,
+                'partitions': [{'path': key, **partition} for key, partition in self.partitions.items()],
+            }
+            with open(os.path.join(self.temp_path, MANIFEST_NAME), 'w') as fh:
+                json.dump(manifest, fh, indent=2)
+        elif self.schema_frame is None:
+            # Nothing was written: still leave an empty table
+            (pd.DataFrame().to_csv if self.file_format == 'csv' else pd.DataFrame().to_parquet)(self.temp_path, index=False)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Drop a partly written table."""
+        self.close_files()
+        if os.path.isdir(self.temp_path):
+            shutil.rmtree(self.temp_path)
+        elif os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+@instrument
+def write_table(df, output_path, file_name, partition_by=None, compression='snappy', row_group_size=None):
+    """
+    Save a DataFrame as a Parquet (GeoParquet for GeoDataFrames) or CSV table.
+
+    Args:
+        df (pd.DataFrame): Data to save.
+        output_path (str): Directory of the table.
+        file_name (str): Table name ending in .parquet or .csv.
+        partition_by (list): Key columns to partition by, or None for a single file.
+        compression (str): Parquet compression codec.
+        row_group_size (int): Maximum rows per Parquet row group.
+
+    Returns:
+        str: Path of the table file or directory.
+    """
+    with TableWriter(output_path, file_name, partition_by, compression, row_group_size) as writer:
+        writer.write(df)
+    return writer.path
+
+
+def read_file(file_path, file_format, geometry, columns=None, filters=None):
+    """Read one table file, keeping the rows whose columns take the listed values."""
+    if file_format == 'csv':
+        df = pd.read_csv(file_path, usecols=columns, low_memory=False)
+        for column, values in (filters or {}).items():
+            df = df[df[column].isin(list(values))]
+        return df
+    # Row groups whose statistics rule out every listed value are skipped
+    arrow_filters = [(column, 'in', list(values)) for column, values in (filters or {}).items()] or None
+    if geometry:
+        import geopandas as gpd
+        return gpd.read_parquet(file_path, columns=columns, filters=arrow_filters)
+    return pd.read_parquet(file_path, columns=columns, filters=arrow_filters)
+
+
+@instrument
+def read_table(path, filters=None, columns=None):
+    """
+    Read a table written by TableWriter, loading only the partitions that are needed.
+
+    Args:
+        path (str): Table file or partitioned table directory.
+        filters (dict): Column -> values to keep, e.g. {'parent_feederid': ['F1']}. Partitions
+            are pruned by their key; other columns are filtered while reading.
+        columns (list): Columns to load, or None for all.
+
+    Returns:
+        pd.DataFrame: The rows, partitions in the order they were written.
+    """
+    filters = dict(filters or {})
+    if not os.path.isdir(path):
+        file_format = 'csv' if path.endswith('.csv') else 'parquet'
+        geometry = file_format == 'parquet' and b'geo' in (pq.read_schema(path).metadata or {})
+        return read_file(path, file_format, geometry, columns, filters)
+
+    with open(os.path.join(path, MANIFEST_NAME), 'r') as fh:
+        manifest = json.load(fh)
+    keys = manifest['partition_by']
+    wanted = {column: {None if pd.isna(value) else str(value) for value in values}
+              for column, values in filters.items() if column in keys}
+    file_filters = {column: values for column, values in filters.items() if column not in keys}
+    files = [os.path.join(path, partition['path'], file_name) for partition in manifest['partitions']
+             if all(value in wanted.get(column, (value,)) for column, value in zip(keys, partition['values']))
+             for file_name in partition['files']]
+
+    if not files:
+        # Keep the columns and dtypes of the table when no partition matches
+        files = [os.path.join(path, manifest['schema'])]
+    pieces = [read_file(file_path, manifest['format'], manifest['geometry'], columns, file_filters) for file_path in files]
+    return pd.concat(pieces, ignore_index=True) if len(pieces) > 1 else pieces[0].reset_index(drop=True)
+
+
+def iter_file(file_path, file_format, geometry, columns=None):
+    """Read one table file in chunks: one per Parquet row group, or CSV_CHUNK_ROWS rows of CSV."""
+    if file_format == 'csv':
+        yield from pd.read_csv(file_path, usecols=columns, low_memory=False, chunksize=CSV_CHUNK_ROWS)
+    elif geometry:
+        yield read_file(file_path, file_format, geometry, columns)
+    else:
+        parquet_file = pq.ParquetFile(file_path)
+        for row_group in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+
+
+def iter_table(path, columns=None):
+    """
+    Iterate over a table written by TableWriter without loading it at once.
+
+    Args:
+        path (str): Table file or partitioned table directory.
+        columns (list): Columns to load, or None for all.
+
+    Yields:
+        pd.DataFrame: Chunks of rows, in the order they were written. A table without rows
+            yields one empty chunk with its columns.
+    """
+    if not os.path.isdir(path):
+        file_format = 'csv' if path.endswith('.csv') else 'parquet'
+        geometry = file_format == 'parquet' and b'geo' in (pq.read_schema(path).metadata or {})
+        files = [path]
+    else:
+        with open(os.path.join(path, MANIFEST_NAME), 'r') as fh:
+            manifest = json.load(fh)
+        file_format, geometry = manifest['format'], manifest['geometry']
+        files = [os.path.join(path, partition['path'], file_name)
+                 for partition in manifest['partitions'] for file_name in partition['files']]
+        files = files or [os.path.join(path, manifest['schema'])]
+
+    empty = True
+    for file_path in files:
+        for chunk in iter_file(file_path, file_format, geometry, columns):
+            if len(chunk):
+                empty = False
+                yield chunk
+    if empty:
+        # Every file is empty, so reading one whole is cheap
+        yield read_file(files[0], file_format, geometry, columns).iloc[:0]
@@ -0,0 +1,16 @@
+import json
+import os
+import sys
+import pytest
+
+# The pipeline modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def synthetic_config(tmp_path_factory):
+    """Contents of the data-params.json of a small synthetic dataset."""
+    from synthetic_data import write_dataset
+    params_path = write_dataset(str(tmp_path_factory.mktemp('synthetic')), 2000, years=1, seed=0)
+    with open(params_path, 'r') as fh:
+        return json.load(fh)
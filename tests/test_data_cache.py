@@ -0,0 +1,48 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from data_cache import PARQUET_AVAILABLE, cache_paths, is_cache_valid, read_cached_csv
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='the cache needs pyarrow')
+def test_concurrent_builds_leave_a_complete_cache(tmp_path):
+    source = str(tmp_path / 'readings.csv')
+    expected = pd.DataFrame({'station': np.arange(200_000) % 97, 'wind_speed': np.linspace(0, 50, 200_000)})
+    expected.to_csv(source, index=False)
+
+    # Stages running in parallel all find the cache missing and build it at the same time
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(read_cached_csv, [source] * 8))
+    for result in results:
+        pd.testing.assert_frame_equal(result, expected)
+
+    parquet_path, meta_path = cache_paths(source)
+    assert is_cache_valid(source, meta_path)
+    pd.testing.assert_frame_equal(pd.read_parquet(parquet_path), expected)
+    assert not glob.glob(os.path.join(os.path.dirname(parquet_path), '*.tmp*'))
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='the cache needs pyarrow')
+def test_failed_parquet_write_is_remembered(tmp_path, monkeypatch, capsys):
+    source = str(tmp_path / 'mixed.csv')
+    expected = pd.DataFrame({'station': ['a', 'b', 'c'], 'value': [1, 2, 3]})
+    expected.to_csv(source, index=False)
+
+    def refuse(*args, **kwargs):
+        raise ValueError('mixed types')
+    monkeypatch.setattr(pd.DataFrame, 'to_parquet', refuse)
+
+    pd.testing.assert_frame_equal(read_cached_csv(source), expected)
+    assert 'Could not cache' in capsys.readouterr().out
+    # Later loads read the CSV without trying Parquet again
+    pd.testing.assert_frame_equal(read_cached_csv(source, columns=['value']), expected[['value']])
+    assert capsys.readouterr().out == ''
+
+    # A changed source is tried again
+    expected.assign(value=[4, 5, 6]).to_csv(source, index=False)
+    os.utime(source, ns=(0, 0))
+    read_cached_csv(source)
+    assert 'Could not cache' in capsys.readouterr().out
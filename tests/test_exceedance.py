@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+from etl import merge_weather_data
+from exceedance import ExceedanceMatrix
+from span_analysis import calculate_span_PSPS_probabilities, calculate_span_PSPS_probability
+
+
+@pytest.fixture(scope='module')
+def merged(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    return merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                              data_sources['windspeed_snapshot'])
+
+
+def station_sets(merged, rng, n_sets=40):
+    """Random upstream station lists, repeats included, as upstream_weather_stations lists them."""
+    codes = pd.unique(merged['weatherstationcode'].astype(object))
+    sets = [[(code,) for code in rng.choice(codes, size=rng.integers(1, 4))] for _ in range(n_sets)]
+    return sets + [[('no-such-station',)], []]
+
+
+def test_bitmaps_match_the_date_merges(merged):
+    matrix = ExceedanceMatrix.from_merged_data(merged)
+    assert matrix.packed
+    for stations in station_sets(merged, np.random.default_rng(0)):
+        assert matrix.probability(stations) == pytest.approx(calculate_span_PSPS_probability(stations, merged))
+
+
+def test_repeated_readings_switch_to_counts(merged):
+    # A second reading on the same station and date multiplies the merged rows
+    repeated = pd.concat([merged, merged.iloc[::5].assign(exceed_threshold=1)], ignore_index=True)
+    matrix = ExceedanceMatrix.from_merged_data(repeated)
+    assert not matrix.packed
+    for stations in station_sets(repeated, np.random.default_rng(1)):
+        assert matrix.probability(stations) == pytest.approx(calculate_span_PSPS_probability(stations, repeated))
+
+
+def test_added_rows_match_a_full_build(merged):
+    half = len(merged) // 2
+    matrix = ExceedanceMatrix.from_merged_data(merged.iloc[:half])
+    matrix.add_rows(merged.iloc[half:])
+    full = ExceedanceMatrix.from_merged_data(merged)
+    for stations in station_sets(merged, np.random.default_rng(2)):
+        assert matrix.probability(stations) == full.probability(stations)
+
+
+@pytest.mark.parametrize('repeat', [False, True])
+def test_date_counts_add_up_to_the_span_counts(merged, repeat):
+    if repeat:
+        merged = pd.concat([merged, merged.iloc[::5].assign(exceed_threshold=1)], ignore_index=True)
+    matrix = ExceedanceMatrix.from_merged_data(merged)
+    assert matrix.packed != repeat
+    date_codes = np.arange(len(matrix.dates))
+    for stations in station_sets(merged, np.random.default_rng(3))[:-2]:
+        rows = matrix.stations.get_indexer(pd.Index([code for code, in stations], dtype=object))
+        present, clear = matrix.date_counts(rows, date_codes)
+        assert (present.sum(), clear.sum()) == tuple(float(count) for count in matrix.counts(rows))
+
+
+@pytest.mark.parametrize('repeat', [False, True])
+def test_memory_mapped_store_matches_the_matrix(merged, tmp_path, repeat):
+    if repeat:
+        merged = pd.concat([merged, merged.iloc[::5].assign(exceed_threshold=1)], ignore_index=True)
+    # A grown matrix saves only its filled part
+    half = len(merged) // 2
+    matrix = ExceedanceMatrix.from_merged_data(merged.iloc[:half])
+    matrix.add_rows(merged.iloc[half:])
+    opened = ExceedanceMatrix.open(matrix.save(str(tmp_path / 'store')))
+    assert isinstance(opened.present, np.memmap) and isinstance(opened.clear, np.memmap)
+    assert opened.packed == matrix.packed
+    with pytest.raises(ValueError):
+        opened.present[0, 0] = 0
+    for stations in station_sets(merged, np.random.default_rng(4)):
+        assert opened.probability(stations) == matrix.probability(stations)
+
+
+def test_workers_attached_to_the_store_match_the_serial_probabilities(merged, tmp_path):
+    stations_to_span = {f"S{number}": stations for number, stations in enumerate(station_sets(merged, np.random.default_rng(5), 200))}
+    serial = calculate_span_PSPS_probabilities(stations_to_span, merged)
+    parallel = calculate_span_PSPS_probabilities(stations_to_span, merged, n_workers=2, store_dir=str(tmp_path / 'store'))
+    assert parallel == serial
+    assert (tmp_path / 'store' / 'present.npy').exists()
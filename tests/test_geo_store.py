@@ -0,0 +1,38 @@
+import os
+import shutil
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely import wkt
+from data_cache import PARQUET_AVAILABLE, cache_paths
+from data_vri_conductor import process_conductor_data, process_vri_data
+
+
+def baseline_geometries(path):
+    """Geometries as the pipeline parsed them before the store: one wkt.loads per row."""
+    data = pd.read_csv(path, low_memory=False)
+    data = data[pd.notna(data['shape'])]
+    return gpd.GeoSeries(data['shape'].apply(wkt.loads).to_numpy(), crs=f"EPSG:{data['shape_srid'].iloc[0]}")
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='the geometry store needs pyarrow')
+@pytest.mark.parametrize('source, process, name', [
+    ('src_vri_snapshot', process_vri_data, 'vri'),
+    ('dev_wings_agg_span', process_conductor_data, 'conductor'),
+])
+@pytest.mark.parametrize('target_crs', [None, 'EPSG:4326'])
+def test_store_round_trip_matches_baseline_parsing(tmp_path, synthetic_config, source, process, name, target_crs):
+    path = shutil.copy(synthetic_config['data_sources'][source], tmp_path)
+    expected = baseline_geometries(path)
+    if target_crs is not None:
+        expected = expected.to_crs(target_crs)
+
+    built = process(path, target_crs)
+    store_path = cache_paths(path, variant=f"{name}-{'native' if target_crs is None else 'epsg4326'}")[0]
+    assert os.path.exists(store_path)
+    loaded = process(path, target_crs)
+
+    for result in (built, loaded):
+        assert result.crs == expected.crs
+        assert result.geometry.reset_index(drop=True).geom_equals_exact(expected, tolerance=0).all()
+    pd.testing.assert_frame_equal(loaded, built)
@@ -0,0 +1,15 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from outage_simulation import OutageModel, simulate_outages
+
+
+def test_customer_totals_are_exact():
+    # One span that fails every year, feeding more customers than float32 holds exactly
+    customers = 2 ** 24 + 1
+    model = OutageModel(sparse.csr_matrix(np.ones((1, 1))), np.array([np.inf]), sparse.csr_matrix([[float(customers)]]),
+                        pd.Index(['F1'], dtype=object), 0.5, np.array([float(customers)]))
+    samples = simulate_outages(model, n_trials=3, years=4, seed=0)
+    assert samples.dtype == np.float64
+    assert (samples == 4 * customers).all()
+    assert simulate_outages(model, n_trials=0, years=4, seed=0).shape == (1, 0)
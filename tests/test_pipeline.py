@@ -0,0 +1,58 @@
+import glob
+import importlib
+import os
+import copy
+import shutil
+from pipeline import code_fingerprint, function_imports, run_pipeline, stage_plan
+from stages import STAGES, analyze_spans_stage, merge_stage, rollup_stage
+
+
+def test_function_imports_reads_the_stage_source():
+    assert function_imports(analyze_spans_stage) == ['etl', 'data_vri_conductor', 'span_analysis', 'rollup', 'psps_state']
+    # rollup_stage writes its tables through save_output, which imports etl
+    assert 'etl' in function_imports(rollup_stage)
+
+
+def test_every_stage_import_resolves():
+    for stage in STAGES.values():
+        for module in function_imports(stage.func):
+            assert importlib.util.find_spec(module) is not None, (stage.name, module)
+
+
+def test_code_fingerprint_covers_only_the_code_a_stage_reaches(tmp_path):
+    code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in glob.glob(os.path.join(code_dir, '*.py')):
+        shutil.copy(path, tmp_path)
+    before = {name: code_fingerprint(STAGES[name].func, str(tmp_path)) for name in ('merge', 'analyze_spans')}
+
+    # Tools outside the stages do not invalidate any checkpoint
+    with open(tmp_path / 'benchmark.py', 'a') as fh:
+        fh.write('\n# edited\n')
+    assert code_fingerprint(merge_stage, str(tmp_path)) == before['merge']
+    # A module analyze_spans reaches through span_analysis changes its key, but not the merge's
+    with open(tmp_path / 'span_network.py', 'a') as fh:
+        fh.write('\n# edited\n')
+    assert code_fingerprint(merge_stage, str(tmp_path)) == before['merge']
+    assert code_fingerprint(analyze_spans_stage, str(tmp_path)) != before['analyze_spans']
+    # So does a module imported by the merge, through etl
+    with open(tmp_path / 'table_store.py', 'a') as fh:
+        fh.write('\n# edited\n')
+    assert code_fingerprint(merge_stage, str(tmp_path)) != before['merge']
+
+
+def test_streamed_merge_reruns_when_its_output_changed(synthetic_config, tmp_path):
+    config = copy.deepcopy(synthetic_config)
+    config['parameters'].update({'merge_memory_budget_mb': 1, 'merged_weather_output': str(tmp_path / 'merged.csv'),
+                                 'output_tables': {}})
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    run_pipeline(STAGES, ['psps'], config, checkpoint_dir)
+    assert stage_plan(STAGES, ['psps'], config, checkpoint_dir)[0] == ['psps']
+
+    # The merge checkpoint is only its path, so it is not reused once the file changed or is gone
+    stat = os.stat(tmp_path / 'merged.csv')
+    os.utime(tmp_path / 'merged.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert stage_plan(STAGES, ['psps'], config, checkpoint_dir)[0] == ['merge', 'psps']
+    run_pipeline(STAGES, ['psps'], config, checkpoint_dir)
+    assert stage_plan(STAGES, ['psps'], config, checkpoint_dir)[0] == ['psps']
+    os.remove(tmp_path / 'merged.csv')
+    assert stage_plan(STAGES, ['psps'], config, checkpoint_dir)[0] == ['merge', 'psps']
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import numpy as np
+import pytest
+from profiling import current_rss_mb, profile_stage
+
+pytestmark = pytest.mark.skipif(current_rss_mb() is None, reason='needs /proc to sample the RSS')
+
+
+def large_stage(config, inputs):
+    values = np.ones(40_000_000)
+    # A child process holding 200 MB
+    subprocess.run([sys.executable, '-c', "import time; data = b'x' * (200 << 20); time.sleep(0.5)"], check=True)
+    return float(values.sum())
+
+
+def small_stage(config, inputs):
+    return float(np.ones(1000).sum())
+
+
+def test_small_stage_after_a_large_one_reports_its_own_peak():
+    _, large = profile_stage('large', large_stage, {}, {})
+    _, small = profile_stage('small', small_stage, {}, {})
+    # The 320 MB array and the child process count for the large stage only
+    assert large['peak_rss_mb'] > 250
+    assert large['peak_child_rss_mb'] > 150
+    assert small['peak_rss_mb'] < 50
+    assert small['peak_child_rss_mb'] < 50
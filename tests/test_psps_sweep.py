@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+import psps_sweep
+from data_vri_conductor import process_conductor_data
+from etl import merge_weather_data
+from psps import station_exceedance_counts
+from psps_sweep import scenario_grid, sweep_span_probabilities, sweep_station_probabilities, sweep_top_stations
+from span_analysis import calculate_span_PSPS_probability, formSpanNet, upstream_weather_stations
+from top_psps import filter_top_psps_stations
+
+CONDITIONS = ['alert', 'max_gust']
+MULTIPLIERS = [0.8, 1.0, 1.2]
+
+
+@pytest.fixture(scope='module')
+def merged(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    return merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                              data_sources['windspeed_snapshot'])
+
+
+def scaled(merged, condition, multiplier):
+    """The merged data of one scenario, as the psps stage would see it with scaled thresholds."""
+    thresholds = merged[condition].astype(np.float64) * multiplier
+    return merged.assign(threshold=thresholds, exceed_threshold=(merged['wind_speed'] > thresholds).astype(int))
+
+
+@pytest.mark.parametrize('chunk_cells', [psps_sweep.SWEEP_CHUNK_CELLS, 7])
+def test_station_sweep_matches_one_run_per_scenario(merged, monkeypatch, chunk_cells):
+    # Tiny chunks split the readings of a station over several reduceat calls
+    monkeypatch.setattr(psps_sweep, 'SWEEP_CHUNK_CELLS', chunk_cells)
+    table = sweep_station_probabilities(merged, CONDITIONS, MULTIPLIERS)
+    assert table['scenario'].unique().tolist() == scenario_grid(CONDITIONS, MULTIPLIERS)['scenario'].tolist()
+    thresholds = [0.1, 0.3]
+    top = sweep_top_stations(table, thresholds)
+    for scenario in scenario_grid(CONDITIONS, MULTIPLIERS).itertuples(index=False):
+        expected = station_exceedance_counts(scaled(merged, scenario.condition, scenario.multiplier), 'threshold')
+        expected.index = expected.index.astype(object)
+        result = table[table['scenario'] == scenario.scenario].set_index('weatherstationcode')
+        assert result['wind_speed_count'].to_dict() == expected['wind_speed_count'].astype(float).to_dict()
+        assert result['above_threshold_count'].to_dict() == expected['above_threshold_count'].astype(float).to_dict()
+
+        expected['PSPS_probability'] = expected['above_threshold_count'] / expected['wind_speed_count']
+        for threshold in thresholds:
+            selected = top[(top['scenario'] == scenario.scenario) & (top['min_alert_threshold'] == threshold)]
+            assert sorted(selected['weatherstationcode']) == sorted(filter_top_psps_stations(expected, threshold).index)
+
+
+def test_span_sweep_matches_the_date_merges(synthetic_config, merged):
+    spans = process_conductor_data(synthetic_config['data_sources']['dev_wings_agg_span'])
+    G, merged_spans = formSpanNet(merged, spans, 'array')
+    stations_to_span = upstream_weather_stations(spans, G, merged_spans)[1]
+    sample = {span: stations_to_span[span] for span in list(stations_to_span)[::100]}
+    table = sweep_span_probabilities(merged, sample, CONDITIONS, MULTIPLIERS)
+    assert len(table) == len(sample) * len(CONDITIONS) * len(MULTIPLIERS)
+    for scenario in scenario_grid(CONDITIONS, MULTIPLIERS).itertuples(index=False):
+        data = scaled(merged, scenario.condition, scenario.multiplier)
+        result = table[table['scenario'] == scenario.scenario].set_index('span')['probability']
+        for span, stations in sample.items():
+            assert result[span] == pytest.approx(calculate_span_PSPS_probability(list(stations), data))
+
+
+def test_unit_multiplier_reproduces_the_pipeline_flags(merged):
+    # The merge flags exceedances against 'alert'; a multiplier of 1 must give the same counts
+    table = sweep_station_probabilities(merged, ['alert'], [1.0]).set_index('weatherstationcode')
+    flagged = merged.groupby('weatherstationcode', observed=True)['exceed_threshold'].sum()
+    flagged.index = flagged.index.astype(object)
+    assert table['above_threshold_count'].to_dict() == flagged.astype(float).to_dict()
+    assert pd.Series(table['PSPS_probability']).between(0, 1).all()
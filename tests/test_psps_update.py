@@ -0,0 +1,104 @@
+import copy
+import json
+import os
+import pandas as pd
+import pytest
+from etl import load_data, merge_weather_data
+from exceedance import ExceedanceMatrix
+from pipeline import run_pipeline
+from psps import calculate_psps_probability
+from stages import STAGES
+
+
+@pytest.fixture(scope='module')
+def update_config(synthetic_config, tmp_path_factory):
+    """The synthetic dataset with its last two months of readings moved to two update files."""
+    root = tmp_path_factory.mktemp('update')
+    windspeed = pd.read_csv(synthetic_config['data_sources']['windspeed_snapshot'])
+    dates = pd.to_datetime(windspeed['date'])
+    batch = (dates >= dates.max() - pd.Timedelta(days=60)).astype(int) + (dates >= dates.max() - pd.Timedelta(days=30))
+    config = copy.deepcopy(synthetic_config)
+    config['data_sources']['windspeed_full'] = synthetic_config['data_sources']['windspeed_snapshot']
+    for number, name in enumerate(['windspeed_snapshot', 'windspeed_update_1', 'windspeed_update_2']):
+        config['data_sources'][name] = str(root / f"{name}.csv")
+        windspeed[batch == number].to_csv(config['data_sources'][name], index=False)
+    config['parameters'].update({'psps_state_dir': str(root / 'psps'), 'psps_span_state_dir': str(root / 'psps_spans'),
+                                 'merge_memory_budget_mb': None, 'output_tables': {}, 'span_workers': 1})
+    config['checkpoint_dir'] = str(root / 'checkpoints')
+    return config
+
+
+def run_updates(config, update):
+    config['data_sources']['windspeed_update'] = config['data_sources'][update]
+    return run_pipeline(STAGES, ['update_psps', 'update_span_psps'], config, config['checkpoint_dir'])
+
+
+def test_updates_match_full_recompute_and_are_applied_once(update_config):
+    data_sources = update_config['data_sources']
+    full = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                              data_sources['windspeed_full'])
+    gis = load_data(data_sources['gis_weatherstation'], schema='gis_weatherstation')
+    expected_psps = calculate_psps_probability(full, gis, update_config['parameters']['psps_condition'])
+
+    run_updates(update_config, 'windspeed_update_1')
+    # Applying the first batch again must not count its readings twice
+    run_updates(update_config, 'windspeed_update_1')
+    results = [run_updates(update_config, 'windspeed_update_2'), run_updates(update_config, 'windspeed_update_2')]
+
+    stations_to_span = results[0]['analyze_spans']['unique_upstream_stations']
+    expected_spans = ExceedanceMatrix.from_merged_data(full).span_probabilities(stations_to_span)
+    for result in results:
+        pd.testing.assert_frame_equal(result['update_psps'].reset_index(drop=True), expected_psps.reset_index(drop=True),
+                                      check_dtype=False, check_categorical=False)
+        probabilities = dict(zip(result['update_span_psps']['span'], result['update_span_psps']['probability']))
+        assert probabilities == pytest.approx(expected_spans)
+    span_state_dir = update_config['parameters']['psps_span_state_dir']
+    with open(f"{span_state_dir}/state.json", 'r') as fh:
+        last_part = json.load(fh)['parts'][-1]
+    for state_dir in (update_config['parameters']['psps_state_dir'], f"{span_state_dir}/{last_part}/stations"):
+        with open(f"{state_dir}/state.json", 'r') as fh:
+            assert len(json.load(fh)['applied_batches']) == 2
+
+
+def test_span_state_saves_only_the_changes(update_config, tmp_path, monkeypatch):
+    import psps_state
+    from psps_state import SpanAggregateState
+    data_sources = update_config['data_sources']
+    stations_to_span = run_updates(update_config, 'windspeed_update_1')['analyze_spans']['unique_upstream_stations']
+    state = SpanAggregateState.from_sources(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                            data_sources['windspeed_snapshot'])
+    state.update(pd.DataFrame(columns=['station', 'date', 'wind_speed']), stations_to_span)
+    state_dir = str(tmp_path / 'state')
+    state.save(state_dir)
+
+    batch = load_data(data_sources['windspeed_update_1'], use_cache=False, schema='windspeed_snapshot')
+    updated = state.update(batch, stations_to_span, 'batch-1')
+    state.save(state_dir)
+    with open(f"{state_dir}/state.json", 'r') as fh:
+        assert json.load(fh)['parts'] == ['part-0', 'part-1']
+    # The update part holds the recomputed spans only
+    assert set(pd.read_csv(f"{state_dir}/part-1/span_probabilities.csv")['span']) == updated
+    loaded = SpanAggregateState.load(state_dir)
+    assert loaded.span_probabilities == pytest.approx(state.span_probabilities)
+    assert loaded.stations.applied_batches == ['batch-1']
+
+    # A save that stops before state.json is replaced leaves the previous state
+    loaded.update(load_data(data_sources['windspeed_update_2'], use_cache=False, schema='windspeed_snapshot'),
+                  stations_to_span, 'batch-2')
+    monkeypatch.setattr(psps_state, 'write_meta', lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        loaded.save(state_dir)
+    monkeypatch.undo()
+    reloaded = SpanAggregateState.load(state_dir)
+    assert reloaded.stations.applied_batches == ['batch-1']
+    assert reloaded.span_probabilities == pytest.approx(state.span_probabilities)
+
+    # Applying the second batch to the reloaded state matches the full history
+    reloaded.update(load_data(data_sources['windspeed_update_2'], use_cache=False, schema='windspeed_snapshot'),
+                    stations_to_span, 'batch-2')
+    reloaded.save(state_dir)
+    assert sorted(name for name in os.listdir(state_dir) if name.startswith('part-')) == ['part-0', 'part-1', 'part-2']
+    full = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                              data_sources['windspeed_full'])
+    expected = ExceedanceMatrix.from_merged_data(full).span_probabilities(stations_to_span)
+    assert SpanAggregateState.load(state_dir).span_probabilities == pytest.approx(expected)
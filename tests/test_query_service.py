@@ -0,0 +1,114 @@
+import copy
+import json
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import pandas as pd
+import pytest
+from etl import merge_weather_data
+from pipeline import run_pipeline
+from query_service import PSPSQueryService, make_handler
+from span_analysis import formSpanNet, getDownstream, getUpstream, upstream_weather_stations
+from stages import STAGES
+
+
+@pytest.fixture(scope='module')
+def analysis(synthetic_config, tmp_path_factory):
+    """The analyze_spans result of the synthetic dataset."""
+    tmp_path = tmp_path_factory.mktemp('query_service')
+    config = copy.deepcopy(synthetic_config)
+    config['parameters'].update({'merged_weather_output': str(tmp_path / 'merged.csv'), 'output_tables': {}})
+    return run_pipeline(STAGES, ['analyze_spans'], config, str(tmp_path / 'checkpoints'))['analyze_spans']
+
+
+@pytest.fixture(scope='module')
+def service(analysis):
+    return PSPSQueryService(analysis['spans'], analysis['span_network'], analysis['unique_upstream_stations'])
+
+
+def test_lookups_match_the_span_records(analysis, service):
+    spans = analysis['spans']
+    for row in spans.iloc[::97].itertuples(index=False):
+        record = service.span(row.globalid)
+        assert record['probability'] == row.probability and record['expected_fire'] == row.expected_fire
+        assert record['cust_total'] == row.cust_total
+        assert sorted(station['station'] for station in record['upstream_stations']) == \
+            sorted(station[0] for station in analysis['unique_upstream_stations'][row.globalid])
+    with pytest.raises(KeyError):
+        service.span('no-such-span')
+
+    circuits = spans.groupby('upstreamardfacilityid').agg(span_count=('globalid', 'count'), psps=('probability', 'mean'),
+                                                         customers=('cust_total', 'sum'), spans=('globalid', list))
+    for circuit_id, expected in circuits.iterrows():
+        record = service.circuit(circuit_id, include_spans=True)
+        assert record['span_count'] == expected['span_count'] and record['sum_of_customers'] == expected['customers']
+        assert record['circuit_psps_value'] == pytest.approx(expected['psps'])
+        assert record['spans'] == expected['spans']
+    feeder_id = spans['parent_feederid'].iloc[0]
+    assert service.feeder(feeder_id)['span_count'] == (spans['parent_feederid'] == feeder_id).sum()
+
+    # Batches keep the request order and leave unknown ids out
+    ids = spans['globalid'].iloc[[5, 1, 3]].tolist()
+    assert service.spans_batch(ids[:2] + ['no-such-span'] + ids[2:])['globalid'].tolist() == ids
+    assert service.circuits_batch(['no-such-circuit']).empty
+
+
+def test_traversals_match_the_network(synthetic_config, analysis, service):
+    data_sources = synthetic_config['data_sources']
+    merged = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                data_sources['windspeed_snapshot'])
+    nx_graph = formSpanNet(merged, analysis['spans'], 'networkx')[0]
+    nx_service = PSPSQueryService(analysis['spans'], nx_graph, analysis['unique_upstream_stations'])
+    assert service.reachability is not None and nx_service.reachability is not None
+    for span_id in analysis['spans']['globalid'].tolist()[::41]:
+        assert service.upstream(span_id) == nx_service.upstream(span_id) == getUpstream(nx_graph, span_id)
+        assert service.downstream(span_id) == nx_service.downstream(span_id) == getDownstream(nx_graph, span_id)
+        for other in getUpstream(nx_graph, span_id)[:3]:
+            assert service.is_upstream(other, span_id) and not service.is_upstream(span_id, other)
+    top = analysis['spans'].loc[analysis['spans']['upstream_span_id'].isna(), 'globalid'].iloc[0]
+    assert sorted(service.deenergized([top])) == sorted([top] + getDownstream(nx_graph, top))
+
+
+def test_networks_that_are_not_forests_are_traversed():
+    # B has two upstream spans, so the network has no reachability index
+    spans = pd.DataFrame({
+        'globalid': ['T1', 'T2', 'A', 'B', 'B', 'C'],
+        'upstream_span_id': [None, None, 'T1', 'A', 'T2', 'B'],
+        'station': ['s1', 's2', 's1', 's2', 's2', 's1'],
+        'parent_feederid': ['F0'] * 6,
+        'upstreamardfacilityid': ['R0'] * 6,
+        'cust_total': [10, 20, 30, 40, 40, 50],
+        'probability': [0.1, 0.2, 0.3, 0.4, 0.4, 0.5],
+        'expected_fire': [1.0] * 6,
+    })
+    merged = pd.DataFrame({'weatherstationcode': ['s1', 's2'], 'wind_speed': [5.0, 1.0], 'alert': [2.0, 2.0],
+                           'date': pd.to_datetime(['2020-01-01', '2020-01-01'])})
+    for backend in ('networkx', 'array'):
+        network, merged_spans = formSpanNet(merged, spans, backend)
+        service = PSPSQueryService(spans, network, upstream_weather_stations(spans, network, merged_spans)[1])
+        assert service.reachability is None
+        for span_id in ('C', 'B', 'T1'):
+            assert service.upstream(span_id) == getUpstream(network, span_id)
+            assert service.downstream(span_id) == getDownstream(network, span_id)
+        with pytest.raises(ValueError):
+            service.is_upstream('A', 'C')
+
+
+def test_http_routes(analysis, service):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(service))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        span_id = analysis['spans']['globalid'].iloc[-1]
+        with urlopen(f"{url}/span/{span_id}/upstream") as response:
+            assert json.load(response) == service.upstream(span_id)
+        with urlopen(f"{url}/spans?ids={span_id},no-such-span") as response:
+            assert [record['globalid'] for record in json.load(response)] == [span_id]
+        with pytest.raises(HTTPError) as raised:
+            urlopen(f"{url}/span/no-such-span")
+        assert raised.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
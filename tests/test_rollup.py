@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_vri_conductor import process_conductor_data
+from rollup import HierarchyRollup
+
+
+@pytest.mark.parametrize('compact', [True, False])
+def test_rollups_match_the_groupby_tables(synthetic_config, compact):
+    path = synthetic_config['data_sources']['dev_wings_agg_span']
+    spans = pd.DataFrame(process_conductor_data(path)) if compact else pd.read_csv(path)
+    rng = np.random.default_rng(0)
+    probability = rng.uniform(0, 0.5, len(spans))
+    probability[rng.choice(len(spans), 50, replace=False)] = np.nan
+    # Feeder ids first seen out of order, which the tables list sorted
+    feeders = pd.Series(rng.choice(['F7', 'F10', 'F2', 'F0'], len(spans)))
+    spans = spans.assign(probability=probability, annual_cust_total=rng.uniform(0, 10, len(spans)),
+                         parent_feederid=feeders.astype('category') if compact else feeders)
+    # Spans without a circuit are left out of the circuit table
+    spans.loc[spans.index[:30], 'upstreamardfacilityid'] = None
+
+    tables = HierarchyRollup(spans).aggregate()
+    plain = pd.read_csv(path).assign(probability=probability, annual_cust_total=spans['annual_cust_total'].to_numpy(),
+                                      parent_feederid=feeders)
+    plain.loc[plain.index[:30], 'upstreamardfacilityid'] = None
+    for name, column, mean_name in [('circuit', 'upstreamardfacilityid', 'circuit_psps_value'),
+                                    ('feeder', 'parent_feederid', 'segment_psps_value')]:
+        expected = plain.groupby(column).agg(**{
+            'span_count': ('globalid', 'count'),
+            mean_name: ('probability', 'mean'),
+            'sum_of_customers': ('cust_total', 'sum'),
+            'annual_customers_affected': ('annual_cust_total', 'sum'),
+        })
+        assert len(expected) > 1
+        pd.testing.assert_frame_equal(tables[name], expected, check_exact=False)
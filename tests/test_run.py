@@ -0,0 +1,16 @@
+import pytest
+from run import parse_args
+
+
+def test_targets_and_options_can_be_mixed():
+    args = parse_args(['feeder_analysis', '--jobs', '3', 'rollup', '--force'])
+    assert args.targets == ['feeder_analysis', 'rollup']
+    assert args.jobs == 3 and args.force and not args.profile
+
+
+@pytest.mark.parametrize('argv', [['all', '--jobs'], ['--jobs', 'two', 'all'], ['--jobs', '0', 'all']])
+def test_invalid_jobs_print_usage(argv, capsys):
+    with pytest.raises(SystemExit) as raised:
+        parse_args(argv)
+    assert raised.value.code == 2
+    assert capsys.readouterr().err.startswith('usage: run.py')
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from etl import merge_weather_data, save_data
+from psps import calculate_psps_probability
+from schema import restore_dtypes
+
+
+def merge_both_ways(data_sources):
+    paths = [data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'], data_sources['windspeed_snapshot']]
+    return merge_weather_data(*paths), merge_weather_data(*paths, compact=False)
+
+
+def test_readings_just_above_a_threshold_still_exceed_it(tmp_path):
+    # Both values round to the same float32, so a float32 comparison would call this a tie
+    wind_speed, alert = 20.0000011, 20.000001
+    assert np.float32(wind_speed) == np.float32(alert)
+    data_sources = {name: str(tmp_path / f"{name}.csv") for name in ('gis_weatherstation', 'station_summary_snapshot', 'windspeed_snapshot')}
+    pd.DataFrame({'weatherstationcode': ['WS1'], 'shape': ['POINT (0 0)'], 'shape_srid': [4326]}).to_csv(data_sources['gis_weatherstation'], index=False)
+    pd.DataFrame({'station': ['WS1'], 'alert': [alert]}).to_csv(data_sources['station_summary_snapshot'], index=False)
+    pd.DataFrame({'station': ['WS1'] * 3, 'date': ['2020-01-01', '2020-01-02', '2020-01-03'],
+                  'wind_speed': [wind_speed, 1.0, 30.0]}).to_csv(data_sources['windspeed_snapshot'], index=False)
+    compact, baseline = merge_both_ways(data_sources)
+    assert compact['exceed_threshold'].tolist() == baseline['exceed_threshold'].tolist() == [1, 0]
+
+
+def test_saved_tables_keep_the_baseline_dtypes(synthetic_config, tmp_path):
+    data_sources = synthetic_config['data_sources']
+    compact, baseline = merge_both_ways(data_sources)
+    assert (compact['exceed_threshold'] == baseline['exceed_threshold']).all()
+    gis = pd.read_csv(data_sources['gis_weatherstation'])
+    pd.testing.assert_frame_equal(calculate_psps_probability(compact, gis, 'alert').reset_index(drop=True),
+                                  calculate_psps_probability(baseline, gis, 'alert').reset_index(drop=True),
+                                  check_dtype=False, check_categorical=False)
+
+    # Only the dates stay parsed; everything else is restored to what pandas reads from the CSV files
+    restored = restore_dtypes(compact)
+    assert pd.api.types.is_datetime64_any_dtype(restored['date'])
+    pd.testing.assert_series_equal(restored.dtypes.drop('date'), baseline.dtypes.drop('date'))
+    # CSV output is the same text as without the schemas
+    save_data(compact, str(tmp_path), 'compact.csv')
+    save_data(baseline, str(tmp_path), 'baseline.csv')
+    assert (tmp_path / 'compact.csv').read_text() == (tmp_path / 'baseline.csv').read_text()
+    save_data(compact, str(tmp_path), 'compact.parquet')
+    pd.testing.assert_series_equal(pd.read_parquet(tmp_path / 'compact.parquet').dtypes, restored.dtypes)
@@ -0,0 +1,81 @@
+import pytest
+from data_vri_conductor import process_conductor_data
+from etl import merge_weather_data
+from reachability import ReachabilityIndex
+from span_analysis import formSpanNet, getDownstream, getUpstream, upstream_weather_stations
+
+
+@pytest.fixture(scope='module')
+def networks(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    merged = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                data_sources['windspeed_snapshot'])
+    spans = process_conductor_data(data_sources['dev_wings_agg_span'])
+    nx_graph, merged_spans = formSpanNet(merged, spans, 'networkx')
+    array_network, _ = formSpanNet(merged, spans, 'array')
+    return spans, merged_spans, nx_graph, array_network
+
+
+def test_backends_traverse_the_same_spans(networks):
+    spans, _, nx_graph, array_network = networks
+    span_ids = spans['globalid'].tolist()
+    for span_id in span_ids[::7]:
+        upstream = getUpstream(array_network, span_id)
+        downstream = getDownstream(array_network, span_id)
+        assert upstream == getUpstream(nx_graph, span_id)
+        assert downstream == getDownstream(nx_graph, span_id)
+        assert all(type(other) is str for other in upstream + downstream)
+    # Feeder tops have no upstream span and feed the whole feeder
+    top = spans.loc[spans['upstream_span_id'].isna(), 'globalid'].iloc[0]
+    assert getUpstream(nx_graph, top) == getUpstream(array_network, top) == []
+    assert len(getDownstream(nx_graph, top)) > 0
+    assert sorted(getDownstream(nx_graph, top, 'bfs')) == sorted(getDownstream(nx_graph, top))
+
+
+def test_backends_give_the_same_upstream_stations(networks):
+    spans, merged_spans, nx_graph, array_network = networks
+    nx_lists, nx_sets = upstream_weather_stations(spans, nx_graph, merged_spans)
+    array_lists, array_sets = upstream_weather_stations(spans, array_network, merged_spans)
+    assert nx_sets == array_sets
+    assert {span: list(stations) for span, stations in nx_lists.items()} == \
+        {span: list(stations) for span, stations in array_lists.items()}
+
+
+def test_reachability_index_matches_both_backends(networks):
+    spans, _, nx_graph, array_network = networks
+    from_nx, from_array = ReachabilityIndex.from_network(nx_graph), ReachabilityIndex.from_network(array_network)
+    for span_id in spans['globalid'].tolist()[::11]:
+        assert from_nx.downstream(span_id).tolist() == from_array.downstream(span_id).tolist() == getDownstream(nx_graph, span_id)
+
+
+def baseline_graph(spans):
+    """The networkx graph as formSpanNet built it before the array backend: one edge per row, NaN included."""
+    import networkx as nx
+    G = nx.DiGraph()
+    for row in spans.itertuples(index=True, name='Pandas'):
+        G.add_edge(row.globalid, row.upstream_span_id)
+    return G
+
+
+def test_nan_upstream_node_was_a_bug(tmp_path):
+    import networkx as nx
+    import pandas as pd
+    # Two feeders, A -> B and C -> D, read back from CSV as the snapshots are
+    path = tmp_path / 'spans.csv'
+    pd.DataFrame({'globalid': list('ABCD'), 'upstream_span_id': [None, 'A', None, 'C'],
+                  'station': ['s1', 's2', 's3', 's1']}).to_csv(path, index=False)
+    spans = pd.read_csv(path)
+    merged = pd.DataFrame({'weatherstationcode': ['s1', 's2', 's3'], 'wind_speed': [5.0, 1.0, 3.0],
+                           'alert': [2.0, 2.0, 2.0], 'date': pd.to_datetime(['2020-01-01'] * 3)})
+    G, merged_spans = formSpanNet(merged, spans, 'networkx')
+    old = baseline_graph(spans)
+
+    # The old graph listed NaN as the upstream span of every feeder top, and joined all
+    # feeders through that one node, so everything looked downstream of "nan"
+    assert pd.isna(getUpstream(old, 'B')[-1])
+    assert nx.number_weakly_connected_components(old) == 1
+    assert getUpstream(G, 'B') == ['A'] and getUpstream(G, 'A') == []
+    assert nx.number_weakly_connected_components(G) == 2
+    assert getDownstream(G, 'A') == ['B'] and getDownstream(G, 'C') == ['D']
+    # The NaN node never had a station, so the upstream stations are unchanged
+    assert upstream_weather_stations(spans, G, merged_spans)[1] == upstream_weather_stations(spans, old, merged_spans)[1]
@@ -0,0 +1,76 @@
+import os
+import shutil
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from data_vri_conductor import process_conductor_data, process_vri_data
+from spatial_index import SpatialIndex, load_spatial_index, span_index, vri_index
+
+
+@pytest.fixture
+def sources(tmp_path, synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    return {name: shutil.copy(data_sources[name], tmp_path) for name in ('src_vri_snapshot', 'dev_wings_agg_span')}
+
+
+def sorted_pairs(frame, columns):
+    return frame[columns].sort_values(columns).reset_index(drop=True)
+
+
+def test_reloaded_index_matches_the_geopandas_join(sources):
+    vri_path = sources['src_vri_snapshot']
+    built = vri_index(vri_path)
+    vri = process_vri_data(vri_path)
+    spans = process_conductor_data(sources['dev_wings_agg_span'], built.crs)
+    points = spans.geometry.centroid
+
+    expected = gpd.sjoin(gpd.GeoDataFrame(geometry=points.reset_index(drop=True)), vri.reset_index(drop=True),
+                         predicate='within')
+    expected = pd.DataFrame({'input': expected.index.to_numpy(), 'position': expected['index_right'].to_numpy()})
+    loaded = vri_index(vri_path)
+    assert loaded is not built
+    for index in (built, loaded):
+        result = index.containing(points)
+        assert sorted_pairs(result, ['input', 'position']).equals(sorted_pairs(expected, ['input', 'position']))
+        assert (result['id'].to_numpy() == vri['globalid'].to_numpy(dtype=object)[result['position']]).all()
+
+    # The reloaded tree holds the same geometries, ids and CRS as the built one
+    assert loaded.crs == built.crs
+    assert (loaded.ids == built.ids).all() and (loaded.positions == built.positions).all()
+    assert gpd.GeoSeries(loaded.geometries).geom_equals_exact(gpd.GeoSeries(built.geometries), tolerance=0).all()
+    pd.testing.assert_frame_equal(loaded.nearest(points[:50]), built.nearest(points[:50]))
+
+
+def test_index_is_reused_until_the_source_changes(sources):
+    path = sources['dev_wings_agg_span']
+    builds = []
+
+    def build():
+        builds.append(1)
+        return process_conductor_data(path)
+
+    first = load_spatial_index(path, 'conductor', build, 'globalid')
+    second = load_spatial_index(path, 'conductor', build, 'globalid')
+    assert len(builds) == 1
+    assert (second.ids == first.ids).all()
+    assert second.intersecting(first.geometries[:20]).equals(first.intersecting(first.geometries[:20]))
+
+    # A touched but unchanged file keeps the index; edited content rebuilds it
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    load_spatial_index(path, 'conductor', build, 'globalid')
+    assert len(builds) == 1
+    data = pd.read_csv(path)
+    data.iloc[:-1].to_csv(path, index=False)
+    rebuilt = load_spatial_index(path, 'conductor', build, 'globalid')
+    assert len(builds) == 2 and len(rebuilt) == len(first) - 1
+
+
+def test_empty_and_missing_geometries_are_left_out(sources):
+    spans = process_conductor_data(sources['dev_wings_agg_span']).reset_index(drop=True)
+    spans.loc[3, 'geometry'] = None
+    index = SpatialIndex.from_geodataframe(spans, 'globalid')
+    assert len(index) == len(spans) - 1 and 3 not in index.positions
+    assert np.array_equal(np.sort(index.positions), np.delete(np.arange(len(spans)), 3))
+    assert span_index(sources['dev_wings_agg_span']).crs == spans.crs.to_wkt()
@@ -0,0 +1,77 @@
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import box
+from snapshot_diff import incremental_sjoin
+from spatial_join import parallel_sjoin
+
+# parallel_sjoin and patch_sjoin rebuild the row order of gpd.sjoin from serial_match_rank,
+# which follows the traversal order of the STRtree. These tests pin that order, so a
+# shapely or geopandas upgrade that changes it fails here instead of reordering merge_vri.
+
+
+def random_boxes(rng, n, size, prefix):
+    x, y = rng.uniform(0, 100, n), rng.uniform(0, 100, n)
+    widths, heights = rng.uniform(0.1, size, n), rng.uniform(0.1, size, n)
+    return gpd.GeoDataFrame({'globalid': [f"{prefix}{i}" for i in range(n)], 'value': rng.integers(0, 10, n)},
+                            geometry=[box(*b) for b in zip(x, y, x + widths, y + heights)], crs='EPSG:4326',
+                            index=pd.Index(rng.permutation(n) * 3, name='row'))
+
+
+@pytest.fixture(scope='module')
+def sides():
+    rng = np.random.default_rng(0)
+    return random_boxes(rng, 3000, 2.0, 'L'), random_boxes(rng, 2000, 8.0, 'R')
+
+
+@pytest.mark.parametrize('predicate', ['intersects', 'within', 'contains'])
+@pytest.mark.parametrize('partition', ['left', 'right'])
+@pytest.mark.parametrize('n_workers', [2, 4])
+def test_parallel_sjoin_matches_sjoin(sides, predicate, partition, n_workers):
+    left, right = sides
+    if predicate == 'contains':
+        left, right = right, left
+    expected = gpd.sjoin(left, right, how='inner', predicate=predicate)
+    joined = parallel_sjoin(left, right, predicate=predicate, n_workers=n_workers, partition=partition, min_tile_rows=100)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(joined, expected)
+
+
+def test_incremental_sjoin_matches_rejoin(tmp_path, sides):
+    left, right = sides
+    state_path = str(tmp_path / 'join.pkl')
+    incremental_sjoin(left, right, 'intersects', state_path, n_workers=2)
+
+    # Move some left boxes, drop some right ones and add new ones
+    rng = np.random.default_rng(1)
+    new_left = left.copy()
+    moved = rng.choice(len(new_left), 100, replace=False)
+    new_left.iloc[moved, new_left.columns.get_loc('geometry')] = new_left.geometry.iloc[moved].translate(5, 5).to_numpy()
+    new_right = pd.concat([right.drop(right.index[:50]), random_boxes(rng, 60, 8.0, 'N').set_axis(pd.Index(np.arange(60) * 3 + 1, name='row'))])
+
+    joined = incremental_sjoin(new_left, new_right, 'intersects', state_path, n_workers=2)
+    pd.testing.assert_frame_equal(joined, gpd.sjoin(new_left, new_right, how='inner', predicate='intersects'))
+
+
+def test_failed_verification_keeps_the_previous_state(tmp_path, sides, monkeypatch):
+    import snapshot_diff
+    left, right = sides
+    state_path = str(tmp_path / 'join.pkl')
+    incremental_sjoin(left, right, 'intersects', state_path, n_workers=2)
+    with open(state_path, 'rb') as fh:
+        saved = fh.read()
+
+    # A patch that loses a row must fail verification without replacing the saved result
+    patch_sjoin = snapshot_diff.patch_sjoin
+
+    def lossy_patch(*args):
+        joined, left_diff, right_diff = patch_sjoin(*args)
+        return joined.iloc[1:], left_diff, right_diff
+
+    monkeypatch.setattr(snapshot_diff, 'patch_sjoin', lossy_patch)
+    new_left = left.drop(left.index[:10])
+    with pytest.raises(AssertionError):
+        incremental_sjoin(new_left, right, 'intersects', state_path, n_workers=2, verify=True)
+    with open(state_path, 'rb') as fh:
+        assert fh.read() == saved
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+from etl import load_data, merge_weather_data, stream_merge_weather_data
+from exceedance import ExceedanceMatrix
+from psps import calculate_psps_probability
+from psps_sweep import sweep_station_probabilities
+
+
+@pytest.fixture(scope='module')
+def sources(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    return data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'], data_sources['windspeed_snapshot']
+
+
+@pytest.fixture(scope='module')
+def in_memory(sources):
+    return merge_weather_data(*sources)
+
+
+# A tiny budget and row groups spread the output over many chunks
+@pytest.mark.parametrize('file_name, partition_by', [
+    ('merged.parquet', None),
+    ('merged.parquet', ['weatherstationcode']),
+    ('merged.csv', None),
+])
+def test_stream_merge_matches_in_memory_merge(tmp_path, sources, in_memory, file_name, partition_by):
+    path = stream_merge_weather_data(*sources, str(tmp_path / file_name), memory_budget_mb=0.05,
+                                     partition_by=partition_by, row_group_size=500)
+    streamed = load_data(path, schema='merged_weather')
+    pd.testing.assert_frame_equal(streamed, in_memory.reset_index(drop=True), check_categorical=False)
+
+
+def test_consumers_fold_streamed_merge(tmp_path, sources, in_memory, synthetic_config):
+    path = stream_merge_weather_data(*sources, str(tmp_path / 'merged.parquet'), memory_budget_mb=0.05, row_group_size=500)
+    gis = load_data(synthetic_config['data_sources']['gis_weatherstation'], schema='gis_weatherstation')
+    # Station codes of several chunks are combined as plain values instead of one categorical
+    pd.testing.assert_frame_equal(calculate_psps_probability(path, gis, 'alert'),
+                                  calculate_psps_probability(in_memory, gis, 'alert'), check_dtype=False, check_categorical=False)
+    pd.testing.assert_frame_equal(sweep_station_probabilities(path, ['alert'], [0.9, 1.0]),
+                                  sweep_station_probabilities(in_memory, ['alert'], [0.9, 1.0]))
+
+    stations_to_span = {'a': [(code,) for code in gis['weatherstationcode'][:2]],
+                        'b': [(gis['weatherstationcode'].iloc[3],)]}
+    assert (ExceedanceMatrix.from_merged_data(path).span_probabilities(stations_to_span)
+            == ExceedanceMatrix.from_merged_data(in_memory).span_probabilities(stations_to_span))
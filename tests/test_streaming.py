@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_vri_conductor import process_conductor_data
+from etl import merge_weather_data
+from exceedance import ExceedanceMatrix
+from span_analysis import formSpanNet, upstream_weather_stations
+from streaming import RollingStationWindows
+
+WINDOWS = {'last_30_days': 30, 'last_90_days': 90, 'all_time': None}
+
+
+@pytest.fixture(scope='module')
+def rolled(synthetic_config):
+    """Windows fed the synthetic readings in date order, in micro-batches, with the spans' upstream stations."""
+    data_sources = synthetic_config['data_sources']
+    merged = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                data_sources['windspeed_snapshot'])
+    spans = process_conductor_data(data_sources['dev_wings_agg_span'])
+    G, merged_spans = formSpanNet(merged, spans)
+    stations_to_span = upstream_weather_stations(spans, G, merged_spans)[1]
+    readings = pd.read_csv(data_sources['windspeed_snapshot'])
+    readings = readings.iloc[np.argsort(pd.to_datetime(readings['date']).to_numpy(), kind='stable')].reset_index(drop=True)
+
+    windows = RollingStationWindows.from_sources(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                                 'alert', WINDOWS, stations_to_span)
+    previous = windows.span_probabilities()
+    for update in windows.process(readings.iloc[start:start + 97] for start in range(0, len(readings), 97)):
+        # Spans left out of an update keep their probabilities
+        current = windows.span_probabilities()
+        unchanged = ~current['span'].isin(update['spans']['span'])
+        pd.testing.assert_frame_equal(current[unchanged], previous[unchanged])
+        previous = current
+    return data_sources, stations_to_span, readings, windows
+
+
+@pytest.mark.parametrize('window', list(WINDOWS))
+def test_rolled_window_matches_a_fresh_computation(rolled, window):
+    data_sources, stations_to_span, readings, windows = rolled
+    days = pd.to_datetime(readings['date']).to_numpy().astype('datetime64[D]').astype(np.int64)
+    in_window = readings[days >= windows.window_start(window)] if WINDOWS[window] else readings
+    fresh = RollingStationWindows.from_sources(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                               'alert', {'all_time': None}, stations_to_span)
+    fresh.update(in_window)
+
+    def table(probabilities, name):
+        return probabilities[probabilities['window'] == name].drop(columns='window').reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(table(windows.station_probabilities(), window), table(fresh.station_probabilities(), 'all_time'))
+    spans = table(windows.span_probabilities(), window)
+    pd.testing.assert_frame_equal(spans, table(fresh.span_probabilities(), 'all_time'))
+
+    # The same probabilities as the exceedance matrix of the window's readings
+    rows = fresh.station_info.merge(in_window, left_on='weatherstationcode', right_on='station')
+    rows = rows[rows['wind_speed'].notna()].assign(date=lambda frame: pd.to_datetime(frame['date']),
+                                                   exceed_threshold=lambda frame: (frame['wind_speed'] > frame['alert']).astype('int8'))
+    expected = ExceedanceMatrix.from_merged_data(rows).span_probabilities(stations_to_span)
+    assert dict(zip(spans['span'], spans['probability'])) == pytest.approx(expected)
+    assert spans['probability'].gt(0).any()
@@ -0,0 +1,14 @@
+import json
+import os
+from synthetic_data import write_dataset
+
+
+def test_data_sources_resolve_from_any_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    params_path = write_dataset(os.path.join('data', 'synthetic'), 200, years=1)
+    # The README runs the pipeline from inside the output directory
+    monkeypatch.chdir(os.path.dirname(params_path))
+    with open('data-params.json', 'r') as fh:
+        data_sources = json.load(fh)['data_sources']
+    for name in ('gis_weatherstation', 'station_summary_snapshot', 'windspeed_snapshot', 'src_vri_snapshot', 'dev_wings_agg_span'):
+        assert os.path.isabs(data_sources[name]) and os.path.exists(data_sources[name])
@@ -0,0 +1,98 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import table_store
+from data_cache import PARQUET_AVAILABLE
+from table_store import TableWriter, iter_table, read_table
+
+FORMATS = [pytest.param('spans.parquet', marks=pytest.mark.skipif(not PARQUET_AVAILABLE, reason='needs pyarrow')),
+           'spans.csv']
+
+
+@pytest.fixture
+def table():
+    """Spans of several feeders, ids needing URL encoding and a missing key included."""
+    rng = np.random.default_rng(0)
+    feeders = np.array(['F1', 'F 2', 'F/3', None], dtype=object)
+    return pd.DataFrame({
+        'globalid': [f"S{number}" for number in range(400)],
+        'parent_feederid': feeders[rng.integers(0, len(feeders), 400)],
+        'circuit': rng.choice(['R1', 'R2'], 400),
+        'cust_total': rng.integers(0, 100, 400),
+        'probability': rng.random(400),
+    })
+
+
+def in_write_order(df, keys):
+    """Rows as a partitioned table returns them: partitions in order of first appearance."""
+    codes = df.groupby(keys, sort=False, dropna=False).ngroup()
+    return df.iloc[np.argsort(codes.to_numpy(), kind='stable')].reset_index(drop=True)
+
+
+def write_chunks(df, path, file_name, partition_by, n_chunks=5):
+    with TableWriter(str(path), file_name, partition_by, row_group_size=20) as writer:
+        for bounds in np.array_split(np.arange(len(df)), n_chunks):
+            writer.write(df.iloc[bounds])
+    return writer.path
+
+
+@pytest.mark.parametrize('file_name', FORMATS)
+@pytest.mark.parametrize('partition_by', [['parent_feederid'], ['parent_feederid', 'circuit']])
+def test_partitioned_table_reads_back(tmp_path, monkeypatch, table, file_name, partition_by):
+    # Few open writers make partitions written again after their file was closed get new part files
+    monkeypatch.setattr(table_store, 'MAX_OPEN_WRITERS', 2)
+    path = write_chunks(table, tmp_path, file_name, partition_by)
+    assert os.path.isdir(path) and os.listdir(tmp_path) == [os.path.basename(path)]
+    with open(os.path.join(path, table_store.MANIFEST_NAME), 'r') as fh:
+        manifest = json.load(fh)
+    if manifest['format'] == 'parquet':
+        assert max(len(partition['files']) for partition in manifest['partitions']) > 1
+    expected = in_write_order(table, partition_by)
+    check_dtype = file_name.endswith('.parquet')
+
+    pd.testing.assert_frame_equal(read_table(path), expected, check_dtype=check_dtype)
+    pd.testing.assert_frame_equal(pd.concat(list(iter_table(path)), ignore_index=True), expected, check_dtype=check_dtype)
+
+    # Partitions are pruned by key, missing keys included; other columns are filtered while reading
+    selected = read_table(path, filters={'parent_feederid': ['F 2', None], 'cust_total': [1, 2, 3]},
+                          columns=['globalid', 'parent_feederid', 'cust_total'])
+    wanted = expected[expected['parent_feederid'].isin(['F 2', None]) & expected['cust_total'].isin([1, 2, 3])]
+    pd.testing.assert_frame_equal(selected, wanted[['globalid', 'parent_feederid', 'cust_total']].reset_index(drop=True),
+                                  check_dtype=check_dtype)
+    partition = read_table(path, filters={'parent_feederid': ['F/3']})
+    pd.testing.assert_frame_equal(partition, expected[expected['parent_feederid'] == 'F/3'].reset_index(drop=True),
+                                  check_dtype=check_dtype)
+
+    # No matching partition still gives the table's columns
+    empty = read_table(path, filters={'parent_feederid': ['no-such-feeder']})
+    assert empty.empty and list(empty.columns) == list(table.columns)
+
+
+@pytest.mark.parametrize('file_name', FORMATS)
+def test_rewritten_table_replaces_the_previous_one(tmp_path, table, file_name):
+    write_chunks(table, tmp_path, file_name, ['parent_feederid'])
+    smaller = table[table['parent_feederid'] == 'F1']
+    path = write_chunks(smaller, tmp_path, file_name, ['parent_feederid'], n_chunks=2)
+    pd.testing.assert_frame_equal(read_table(path), smaller.reset_index(drop=True), check_dtype=False)
+
+    # A failed write keeps the previous version and leaves no temporary files
+    with pytest.raises(RuntimeError):
+        with TableWriter(str(tmp_path), file_name, ['parent_feederid']) as writer:
+            writer.write(table)
+            raise RuntimeError('interrupted')
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    pd.testing.assert_frame_equal(read_table(path), smaller.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='needs pyarrow')
+def test_partitioned_geodataframe_reads_back(tmp_path, table):
+    import geopandas as gpd
+    gdf = gpd.GeoDataFrame(table, geometry=gpd.points_from_xy(np.arange(len(table)), np.zeros(len(table))), crs='EPSG:4326')
+    path = write_chunks(gdf, tmp_path, 'spans.parquet', ['parent_feederid'], n_chunks=3)
+    result = read_table(path)
+    assert isinstance(result, gpd.GeoDataFrame) and result.crs == gdf.crs
+    expected = in_write_order(gdf, ['parent_feederid'])
+    assert result['globalid'].tolist() == expected['globalid'].tolist()
+    assert result.geometry.geom_equals_exact(expected.geometry, tolerance=0).all()
@@ -0,0 +1,113 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pytest
+from data_vri_conductor import process_conductor_data
+from etl import merge_weather_data
+from incidence import SpanStationIncidence
+from reachability import ReachabilityIndex
+from span_analysis import (formSpanNet, getDownstream, getUpstream, span_station_incidence,
+                           upstream_weather_stations)
+
+
+def per_span_upstream_stations(spans, G, merged_spans):
+    """The baseline mapping: one depth-first search per span row."""
+    span_weather_station = dict()
+    for row in merged_spans.itertuples(index=True, name='Pandas'):
+        span_weather_station[row.globalid] = (row.station, row.PSPS_probability, row.above_threshold_count, row.wind_speed_count)
+    lists, sets = dict(), dict()
+    for row in spans.itertuples(index=True, name='Pandas'):
+        upstream_spans = getUpstream(G, row.globalid, 'dfs') + [row.globalid]
+        weather_stations = [span_weather_station[span] for span in upstream_spans if span in span_weather_station]
+        lists[row.globalid] = weather_stations
+        sets[row.globalid] = set(weather_stations)
+    return lists, sets
+
+
+def as_lists(mapping):
+    return {span: list(stations) for span, stations in mapping.items()}
+
+
+def test_propagation_matches_per_span_search(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    merged = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                data_sources['windspeed_snapshot'])
+    spans = process_conductor_data(data_sources['dev_wings_agg_span'])
+    G, merged_spans = formSpanNet(merged, spans, 'networkx')
+    expected_lists, expected_sets = per_span_upstream_stations(spans, G, merged_spans)
+    for backend in ('networkx', 'array'):
+        network = formSpanNet(merged, spans, backend)[0]
+        lists, sets = upstream_weather_stations(spans, network, merged_spans)
+        assert as_lists(lists) == expected_lists
+        assert sets == expected_sets
+
+
+@pytest.fixture
+def duplicated_spans():
+    """Spans listed in several rows: B has two upstream spans, C is repeated and D has a missing upstream first."""
+    spans = pd.DataFrame({
+        'globalid': ['T1', 'T2', 'A', 'B', 'B', 'C', 'C', 'D', 'D', 'E'],
+        'upstream_span_id': [None, None, 'T1', 'A', 'T2', 'B', 'B', None, 'A', 'D'],
+        'station': ['s1', 's2', 's3', 's1', 's1', 's2', 's2', 's3', 's3', 's1'],
+    })
+    merged = pd.DataFrame({'weatherstationcode': ['s1', 's2', 's3', 's1'], 'wind_speed': [5.0, 1.0, 3.0, 1.0],
+                           'alert': [2.0, 2.0, 2.0, 2.0], 'date': pd.to_datetime(['2020-01-01', '2020-01-01', '2020-01-01', '2020-01-02'])})
+    return merged, spans
+
+
+def test_duplicated_spans_agree_across_backends(duplicated_spans):
+    merged, spans = duplicated_spans
+    G, merged_spans = formSpanNet(merged, spans, 'networkx')
+    network = formSpanNet(merged, spans, 'array')[0]
+    assert network.extra_parents
+
+    for span_id in spans['globalid'].unique():
+        assert getUpstream(network, span_id) == getUpstream(G, span_id)
+        assert getDownstream(network, span_id) == getDownstream(G, span_id)
+    # getUpstream keeps the first span reached from each span on the search, so T2 is left out
+    assert getUpstream(network, 'C') == ['B', 'A', 'T1']
+    assert getUpstream(network, 'D') == ['A', 'T1']
+
+    expected_lists, expected_sets = per_span_upstream_stations(spans, G, merged_spans)
+    for graph in (G, network):
+        lists, sets = upstream_weather_stations(spans, graph, merged_spans)
+        assert as_lists(lists) == expected_lists and sets == expected_sets
+        incidence = span_station_incidence(spans, graph, merged_spans)
+        assert incidence.distinct_counts().to_dict() == {span: len(stations) for span, stations in expected_sets.items()}
+        with pytest.raises(ValueError):
+            ReachabilityIndex.from_network(graph)
+
+
+def test_saved_network_keeps_extra_upstream_spans(tmp_path, duplicated_spans):
+    from span_network import SpanNetwork
+    merged, spans = duplicated_spans
+    network = formSpanNet(merged, spans, 'array')[0]
+    loaded = SpanNetwork.load(network.save(str(tmp_path / 'network.npz')))
+    assert loaded.extra_parents == network.extra_parents
+    assert [loaded.upstream(span_id) for span_id in spans['globalid']] == [network.upstream(span_id) for span_id in spans['globalid']]
+
+
+def test_incidence_matches_per_span_search(synthetic_config):
+    data_sources = synthetic_config['data_sources']
+    merged = merge_weather_data(data_sources['gis_weatherstation'], data_sources['station_summary_snapshot'],
+                                data_sources['windspeed_snapshot'])
+    spans = process_conductor_data(data_sources['dev_wings_agg_span'])
+    G, merged_spans = formSpanNet(merged, spans, 'networkx')
+    expected_lists = per_span_upstream_stations(spans, G, merged_spans)[0]
+    stations = pd.unique(merged_spans['station'].dropna().astype(object))
+    metric = pd.Series(np.random.default_rng(0).random(len(stations)), index=stations)
+
+    from_lists = SpanStationIncidence.from_upstream_map(expected_lists)
+    for backend in ('networkx', 'array'):
+        incidence = span_station_incidence(spans, formSpanNet(merged, spans, backend)[0], merged_spans)
+        assert list(incidence.spans) == list(expected_lists)
+        # Built from the parent pointers, not the lists
+        assert (incidence.matrix != from_lists.matrix[:, from_lists.stations.get_indexer(incidence.stations)]).nnz == 0
+        for span, records in expected_lists.items():
+            row = incidence.matrix[incidence.spans.get_loc(span)]
+            assert dict(zip(incidence.stations[row.indices], row.data)) == Counter(record[0] for record in records)
+        values = {span: [metric[record[0]] for record in records] for span, records in expected_lists.items()}
+        assert incidence.counts().to_dict() == {span: len(vals) for span, vals in values.items()}
+        assert incidence.total(metric).to_dict() == pytest.approx({span: sum(vals) for span, vals in values.items()})
+        assert incidence.mean(metric).to_dict() == pytest.approx({span: np.mean(vals) if vals else 0 for span, vals in values.items()})
+        assert incidence.max(metric).to_dict() == {span: max(vals, default=0) for span, vals in values.items()}
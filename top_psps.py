@@ -1,5 +1,7 @@
 import pandas as pd
+from profiling import instrument
 
+@instrument
 def filter_top_psps_stations(psps_data, threshold):
     """Filters weather stations with PSPS probability above the given threshold.
 